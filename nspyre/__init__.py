@@ -1,6 +1,6 @@
 from nspyre.utils import load_all_spyrelets, drop_all_spyrelets
 
-from nspyre.views import Plot1D, Plot2D, PlotFormatInit, PlotFormatUpdate
+from nspyre.views import Plot1D, Plot2D, Plot1DIncremental, Plot2DIncremental, PlotFormatInit, PlotFormatUpdate
 from nspyre.spyrelet import Spyrelet
 from nspyre.widgets.plotting import LinePlotWidget, HeatmapPlotWidget
 from nspyre.data_handling import load_data
@@ -10,7 +10,7 @@ import numpy as np
 import time
 from lantz import Q_
 
-__all__ = ['Plot1D', 'Plot2D', 'PlotFormatInit', 'PlotFormatUpdate', 
+__all__ = ['Plot1D', 'Plot2D', 'Plot1DIncremental', 'Plot2DIncremental', 'PlotFormatInit', 'PlotFormatUpdate', 
            'Spyrelet', 'LinePlotWidget', 'HeatmapPlotWidget', 'Q_', 
            'load_data', 'instrument_manager', 'load_all_spyrelets', 
            'drop_all_spyrelets', 'np', 'time']
\ No newline at end of file
@@ -0,0 +1,300 @@
+"""
+    nspyre.columnar.py
+    ~~~~~~~~~~~~~~~~~~
+
+    Growable, append-optimized columnar storage for rows of data (dicts) which are later consumed as a pandas DataFrame.
+
+    Each column is a NumPy array with amortized doubling.  Numeric and boolean values are stored in typed arrays, while
+    anything else (strings, ndarrays, lists, ObjectIds, ...) goes in object columns.  A column is upcasted (int -> float -> object)
+    when a value which doesn't fit is appended, the same way pandas would have inferred the dtype from a list of dicts.
+    Like in pandas, None is a missing value (NaN) in numeric columns, so an int column with a None becomes a float column.
+    The rows where a None was stored are remembered, so the None is restored if the column is upcasted to object (as pandas would
+    have inferred it) and row() returns None rather than NaN (like the original document).
+
+    The data version (version attribute, also in the attrs of the DataFrames) changes whenever existing rows are modified, but not when
+    rows are appended, so the consumers which only process the new rows know when they need to start over.
+
+    The DataFrame is built on top of read-only views of the column arrays (without copying them) and cached until rows are appended.
+    Each call to to_dataframe returns a shallow copy of the cached DataFrame, so modifying it (with copy-on-write) never changes the buffer.
+"""
+
+from collections import OrderedDict
+import itertools
+import numpy as np
+import pandas as pd
+
+# Data versions are unique in the process, so a new buffer never has the version of another one
+_VERSIONS = itertools.count(1)
+
+
+class Columnar_Buffer():
+    INITIAL_CAPACITY = 64
+
+    def __init__(self):
+        self._cols = OrderedDict()
+        self._len = 0
+        self._capacity = self.INITIAL_CAPACITY
+        self._schema_version = 0
+        self.version = next(_VERSIONS)
+        # Column name -> set of the rows where a None is stored as NaN (numeric columns only)
+        self._nones = dict()
+
+        # DataFrame cache
+        self._df = None
+        self._df_len = 0
+        self._df_schema_version = -1
+        # True when a DataFrame was built on top of the current column arrays
+        self._shared = False
+
+    def __len__(self):
+        return self._len
+
+    @property
+    def columns(self):
+        return list(self._cols.keys())
+
+    @staticmethod
+    def _infer_dtype(val):
+        if val is None:
+            # Missing value, which becomes a NaN unless something else than numbers is appended later
+            return np.dtype(np.float64)
+        elif isinstance(val, (bool, np.bool_)):
+            return np.dtype(bool)
+        elif isinstance(val, (int, np.integer)):
+            return np.dtype(np.int64)
+        elif isinstance(val, (float, np.floating)):
+            return np.dtype(np.float64)
+        return np.dtype(object)
+
+    @staticmethod
+    def _fits(dtype, val):
+        if dtype == object:
+            return True
+        elif dtype == np.float64:
+            return val is None or (isinstance(val, (int, float, np.integer, np.floating)) and not isinstance(val, (bool, np.bool_)))
+        elif dtype == np.int64:
+            return isinstance(val, (int, np.integer)) and not isinstance(val, (bool, np.bool_))
+        elif dtype == bool:
+            return isinstance(val, (bool, np.bool_))
+        return False
+
+    @staticmethod
+    def _upcast_dtype(dtype, val):
+        # int + float -> float, everything else goes to object
+        if dtype == np.int64 and (val is None or isinstance(val, (float, np.floating))):
+            return np.dtype(np.float64)
+        return np.dtype(object)
+
+    def _grow(self, min_capacity):
+        capacity = self._capacity
+        while capacity < min_capacity:
+            capacity *= 2
+        if capacity == self._capacity:
+            return
+        for name, arr in self._cols.items():
+            new_arr = np.empty(capacity, dtype=arr.dtype)
+            new_arr[:self._len] = arr[:self._len]
+            self._cols[name] = new_arr
+        self._capacity = capacity
+
+    def _add_column(self, name, dtype):
+        if self._len > 0 and dtype in (np.int64, bool):
+            # Previous rows are missing this value, so it needs to be able to hold a NaN
+            dtype = np.dtype(np.float64) if dtype == np.int64 else np.dtype(object)
+        arr = np.empty(self._capacity, dtype=dtype)
+        if self._len > 0:
+            arr[:self._len] = np.nan
+        self._cols[name] = arr
+        self._schema_version += 1
+
+    def _change_dtype(self, name, dtype):
+        arr = self._cols[name]
+        new_arr = np.empty(self._capacity, dtype=dtype)
+        if dtype == object:
+            # Keep python scalars rather than numpy ones in the object column
+            new_arr[:self._len] = arr[:self._len].tolist()
+            for i in self._nones.pop(name, ()):
+                new_arr[i] = None
+        else:
+            new_arr[:self._len] = arr[:self._len]
+        self._cols[name] = new_arr
+        self._schema_version += 1
+
+    def _set(self, name, i, val):
+        arr = self._cols[name]
+        if not self._fits(arr.dtype, val):
+            self._change_dtype(name, self._upcast_dtype(arr.dtype, val))
+            arr = self._cols[name]
+        if arr.dtype == object:
+            arr[i] = val
+        elif val is None:
+            arr[i] = np.nan
+            self._nones.setdefault(name, set()).add(i)
+        else:
+            self._discard_none(name, i)
+            try:
+                arr[i] = val
+            except OverflowError:
+                self._change_dtype(name, np.dtype(object))
+                self._cols[name][i] = val
+
+    def _discard_none(self, name, i):
+        nones = self._nones.get(name)
+        if nones:
+            nones.discard(i)
+
+    def _set_missing(self, name, i):
+        arr = self._cols[name]
+        if arr.dtype in (np.int64, bool):
+            self._change_dtype(name, self._upcast_dtype(arr.dtype, None))
+            arr = self._cols[name]
+        arr[i] = np.nan
+        self._discard_none(name, i)
+
+    def append(self, row):
+        """Append a row (dict of column name -> value)"""
+        i = self._len
+        if i >= self._capacity:
+            self._grow(i+1)
+        for name, val in row.items():
+            if not name in self._cols:
+                self._add_column(name, self._infer_dtype(val))
+            self._set(name, i, val)
+        if len(row) != len(self._cols):
+            for name in self._cols:
+                if not name in row:
+                    self._set_missing(name, i)
+        self._len += 1
+        return i
+
+    def extend(self, rows):
+        self._grow(self._len + len(rows))
+        for row in rows:
+            self.append(row)
+
+    def column(self, name):
+        """Returns a view of the valid part of a column (should not be modified)"""
+        return self._cols[name][:self._len]
+
+    @staticmethod
+    def _readonly_view(arr):
+        view = arr.view()
+        view.setflags(write=False)
+        return view
+
+    def _frame(self, start, stop):
+        # The rows before _len are never modified by append, so the DataFrame can share the column arrays (through read-only views)
+        data = OrderedDict((name, self._readonly_view(arr[start:stop])) for name, arr in self._cols.items())
+        self._shared = True
+        return pd.DataFrame(data, index=pd.RangeIndex(start, stop), columns=list(self._cols.keys()), copy=False)
+
+    def _detach(self):
+        """Copy the column arrays if a DataFrame shares them (must be called before modifying rows in place)"""
+        if self._shared:
+            for name, arr in self._cols.items():
+                self._cols[name] = arr.copy()
+            self._shared = False
+
+    def to_dataframe(self):
+        """
+        Returns a DataFrame with all the rows.  The DataFrame shares its (read-only) memory with the buffer, the values are copied
+        when the DataFrame is modified.  It is cached and rebuilt (without copying the data) after rows are appended.
+        """
+        if self._len == 0:
+            df = pd.DataFrame()
+        else:
+            if self._df is None or self._df_schema_version != self._schema_version or self._df_len != self._len:
+                self._df = self._frame(0, self._len)
+            self._df_len = self._len
+            self._df_schema_version = self._schema_version
+            df = self._df.copy(deep=False)
+        df.attrs['version'] = self.version
+        return df
+
+    def clear(self):
+        self.__init__()
+
+
+class Keyed_Columnar_Buffer(Columnar_Buffer):
+    """
+    Columnar_Buffer where each row is identified by a unique key (taken from the <key_col> field of the appended rows, '_id' by default).
+    The key is used as the index of the DataFrame and allows for updating individual values in place.
+    Since updates modify existing rows, the column arrays are copied first if a DataFrame shares them (so the DataFrames
+    already returned don't change) and the cached DataFrame is rebuilt on the next to_dataframe call.
+    """
+    def __init__(self, key_col='_id'):
+        super().__init__()
+        self.key_col = key_col
+        self._keys = list()
+        self._pos = dict()
+
+    def __contains__(self, key):
+        return key in self._pos
+
+    def append(self, row):
+        row = dict(row)
+        key = row.pop(self.key_col)
+        if key in self._pos:
+            # Replace the existing row
+            self._detach()
+            i = self._pos[key]
+            for name in self._cols:
+                if name in row:
+                    self._set(name, i, row.pop(name))
+                else:
+                    self._set_missing(name, i)
+            for name, val in row.items():
+                self._add_column(name, self._infer_dtype(val))
+                self._set(name, i, val)
+            self._df = None
+            self.version = next(_VERSIONS)
+            return i
+        i = super().append(row)
+        self._keys.append(key)
+        self._pos[key] = i
+        return i
+
+    def get_value(self, key, name):
+        return self._cols[name][self._pos[key]]
+
+    def set_value(self, key, name, val):
+        self._detach()
+        if not name in self._cols:
+            self._add_column(name, self._infer_dtype(val))
+        self._set(name, self._pos[key], val)
+        self._df = None
+        self.version = next(_VERSIONS)
+
+    def invalidate(self):
+        """Should be called when a value returned by get_value was modified in place"""
+        self._df = None
+        self.version = next(_VERSIONS)
+
+    def row(self, key):
+        i = self._pos[key]
+        return OrderedDict((name, None if i in self._nones.get(name, ()) else arr[i]) for name, arr in self._cols.items())
+
+    def delete(self, key):
+        i = self._pos.pop(key)
+        keep = np.ones(self._len, dtype=bool)
+        keep[i] = False
+        for name, arr in self._cols.items():
+            new_arr = np.empty(self._capacity, dtype=arr.dtype)
+            new_arr[:self._len-1] = arr[:self._len][keep]
+            self._cols[name] = new_arr
+        self._keys.pop(i)
+        self._len -= 1
+        for name, nones in self._nones.items():
+            self._nones[name] = {j if j < i else j-1 for j in nones if j != i}
+        for j in range(i, self._len):
+            self._pos[self._keys[j]] = j
+        self._df = None
+        self.version = next(_VERSIONS)
+
+    def _frame(self, start, stop):
+        df = super()._frame(start, stop)
+        df.index = pd.Index(self._keys[start:stop], name=self.key_col)
+        return df
+
+    def clear(self):
+        self.__init__(key_col=self.key_col)
@@ -1,11 +1,13 @@
-from nspyre.utils import custom_encode, custom_decode, get_mongo_client, get_configs
+from nspyre.utils import custom_encode, custom_decode, get_mongo_client, get_configs, encode_ndarray
 from collections import OrderedDict
+import io
 import json
 import pymongo
 import pandas as pd
 from nspyre.instrument_manager import Instrument_Manager
 import traceback
 import time
+import numpy as np
 
 def get_exp_state_from_db(mongodb_addr=None, debug=False):
     c = get_mongo_client(mongodb_addr=mongodb_addr)
@@ -103,15 +105,37 @@ def save_data(spyrelet, filename, name=None, description=None, save_state_mode='
                 results = json.dump(data_dict, f, indent=4)
             return results
 
-def load_data(filename, load_to_mongo=False, mongodb_addr=None, db_name='Spyre_Data_Loaded'):
+def encode_record(record, array_encoding='binary'):
+    """
+    Encode (in place) the array values of a record for MongoDB (see encode_ndarray).  Only the lists which make a rectangular
+    numeric (or boolean) array are encoded, the others (ragged or mixed lists) are kept as they are.
+    """
+    for k, val in record.items():
+        if isinstance(val, (list, np.ndarray)):
+            try:
+                arr = np.asarray(val)
+            except ValueError:
+                # Ragged list
+                arr = None
+            if not arr is None and arr.dtype.kind in 'biufc':
+                record[k] = encode_ndarray(arr, array_encoding=array_encoding)
+            elif isinstance(val, np.ndarray):
+                record[k] = val.tolist()
+    return record
+
+def load_data(filename, load_to_mongo=False, mongodb_addr=None, db_name='Spyre_Data_Loaded', array_encoding='binary'):
+    """
+    Load a data file generated by save_data.  If load_to_mongo is True the data is also written to the <db_name> database (which
+    can be viewed with the View_Manager).  Array columns (stored as lists in the file) are encoded with <array_encoding> (see encode_record).
+    """
     with open(filename, 'r') as f:
         ans = json.load(f)
-    ans['data'] = pd.read_json(ans['data']).rename(columns={i:x for i,x in enumerate(ans['data_col'])})
+    ans['data'] = pd.read_json(io.StringIO(ans['data'])).rename(columns={i:x for i,x in enumerate(ans['data_col'])})
 
     for c_name, c_dict in ans['children'].items():
         data_list = list()
         for d in c_dict['data_list']:
-            data_list.append(pd.read_json(d).rename(columns={i:x for i,x in enumerate(c_dict['data_col'])}))
+            data_list.append(pd.read_json(io.StringIO(d)).rename(columns={i:x for i,x in enumerate(c_dict['data_col'])}))
         ans['children'][c_name]['data_list'] = data_list
 
     if load_to_mongo:
@@ -121,7 +145,8 @@ def load_data(filename, load_to_mongo=False, mongodb_addr=None, db_name='Spyre_D
         def add_spyrelet_data(sname, sclass, data):
             reg_entry = {'_id':sname,'class':sclass}
             db['Register'].update_one({'_id':sname},{'$set':reg_entry}, upsert=True)
-            db[sname].insert_many(data.to_dict(orient='records'))
+            records = [encode_record(r, array_encoding=array_encoding) for r in data.to_dict(orient='records')]
+            db[sname].insert_many(records)
         
         add_spyrelet_data(ans['spyrelet_name'], ans['spyrelet_class'], ans['data'])
         for c_name, c_dict in ans['children'].items():
@@ -9,23 +9,62 @@
 """
 
 import pymongo
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-from nspyre.instrument_server import Instrument_Server_Client, load_remote_device
+from nspyre.instrument_server import Instrument_Server_Client, InstrumentServerError, load_remote_device
 from nspyre.mongo_listener import Synched_Mongo_Database
-from nspyre.utils import get_configs, get_mongo_client
+from nspyre.utils import get_configs, get_mongo_client, close_mongo_clients
 
-class Instrument_Manager():
+# Process-wide registry of Instrument_Manager (one per set of servers)
+_MANAGERS = dict()
+_MANAGERS_LOCK = threading.Lock()
+
+def get_instrument_manager(instrument_servers_addrs=None, timeout=10000):
+    """
+    Returns the Instrument_Manager shared by the whole process for a set of servers (the instrument_servers_addrs from the config by default).
+    It is created (with the given timeout) on the first call, the following calls reuse it until close_instrument_managers is called.
+    """
+    if instrument_servers_addrs is None:
+        instrument_servers_addrs = get_configs()['instrument_servers_addrs']
+    key = tuple(sorted((str(server['ip']), str(server['port'])) for server in instrument_servers_addrs))
+    with _MANAGERS_LOCK:
+        if not key in _MANAGERS:
+            clients = [Instrument_Server_Client(**server, recv_timeout=timeout) for server in instrument_servers_addrs]
+            _MANAGERS[key] = Instrument_Manager(clients)
+        return _MANAGERS[key]
+
+def close_instrument_managers():
+    with _MANAGERS_LOCK:
+        managers = list(_MANAGERS.values())
+        _MANAGERS.clear()
+    for manager in managers:
+        manager.close()
 
+def teardown():
+    """Close the shared Instrument_Manager and MongoClient of the process"""
+    close_instrument_managers()
+    close_mongo_clients()
+
+class Instrument_Manager():
+    """
+    Gives access to the devices of a set of instrument servers.
+    At startup, every server is asked for its full inventory (DESCRIBE) in parallel, so it only takes one round trip per server.
+    A dname -> server index is kept so get doesn't need to query the servers unless the device is unknown.
+    """
     def __init__(self, instrument_server_client_list=None, timeout=10000):
         if instrument_server_client_list is None:
             instrument_server_client_list = []
             for server in get_configs()['instrument_servers_addrs']:
                 instrument_server_client_list.append(Instrument_Server_Client(**server, recv_timeout=timeout))
+
+        descriptions = self.describe_all(instrument_server_client_list)
+
         # Compile a list of zmq and mongo client objects
         self.clients = list()
         self.fully_mongo = True
-        for c in instrument_server_client_list:
-            db = c.get_mongodb()
+        for c, desc in zip(instrument_server_client_list, descriptions):
+            db = desc['mongodb']
             if db is None:
                 self.fully_mongo = False
                 self.clients.append({'zmq':c,'mongo':None})
@@ -35,11 +74,70 @@ class Instrument_Manager():
 
         # Create the instrument list
         self.instr = dict()
-        for c in self.clients:
-            for dname in c['zmq'].list_instr():
-                self.update_instr(dname, c)
+        self.index = dict()
+        for c, desc in zip(self.clients, descriptions):
+            self.load_description(c, desc)
 
-        
+    @staticmethod
+    def describe(zmq_client):
+        try:
+            return zmq_client.describe()
+        except InstrumentServerError:
+            # Older server without DESCRIBE (the schemas will be requested for each device)
+            return {'mongodb':zmq_client.get_mongodb(), 'instr':{dname:None for dname in zmq_client.list_instr()}}
+
+    @classmethod
+    def describe_in_pool(cls, zmq_client):
+        try:
+            return cls.describe(zmq_client)
+        finally:
+            # The socket was created for this pool thread, which won't be used anymore
+            if hasattr(zmq_client, 'reset_socket'):
+                zmq_client.reset_socket()
+
+    @classmethod
+    def describe_all(cls, zmq_clients):
+        """Returns the description of each server (requested in parallel)"""
+        if len(zmq_clients) <= 1:
+            return [cls.describe(c) for c in zmq_clients]
+        with ThreadPoolExecutor(max_workers=len(zmq_clients)) as pool:
+            return list(pool.map(cls.describe_in_pool, zmq_clients))
+
+    def load_description(self, client, desc):
+        """Update the devices of a server from its description (the existing proxies, and their cache, are kept if the info and schema didn't change)"""
+        for dname in [dname for dname, c in self.index.items() if c is client and not dname in desc['instr']]:
+            self.index.pop(dname)
+            self.remove_device(dname)
+        for dname, d in desc['instr'].items():
+            if dname in self.instr and self.index.get(dname) is client and not d is None and self.instr[dname]['info'] == d['info'] \
+               and self.instr[dname]['dev'].schema == d['schema']:
+                continue
+            self.add_device(dname, client, d)
+
+    def remove_device(self, dname):
+        d = self.instr.pop(dname, None)
+        if not d is None:
+            d['dev']._cache.stop()
+
+    def add_device(self, dname, client, desc=None):
+        dev = load_remote_device(client['zmq'], dname, mongo_col=None if client['mongo'] is None else client['mongo'][dname],
+                                 info=None if desc is None else desc['info'], schema=None if desc is None else desc['schema'])
+        self.remove_device(dname)
+        self.instr[dname] = {
+            'zmq': client['zmq'],
+            'mongo': None if client['mongo'] is None else client['mongo'][dname],
+            'class': dev.info['class'],
+            'info': dev.info,
+            'dev': dev,
+        }
+        self.index[dname] = client
+        return self.instr[dname]
+
+    def refresh(self, clients=None):
+        """Update the device list from the servers (all of them by default)"""
+        clients = self.clients if clients is None else clients
+        for c, desc in zip(clients, self.describe_all([c['zmq'] for c in clients])):
+            self.load_description(c, desc)
 
     def launch_watchers(self):
         for c in self.clients:
@@ -49,30 +147,41 @@ class Instrument_Manager():
 
 
     def update_instr(self, dname, client):
-        instr_dict = client['zmq'].list_instr()
-        if not dname in instr_dict:
-            if dname in self.instr:
-                self.instr.pop(dname)
-            return None
-        else:
-            self.instr[dname] = {
-                'zmq': client['zmq'],
-                'mongo': client['mongo'][dname],
-                'class': instr_dict[dname]['class'],
-                'dev': load_remote_device(client['zmq'], dname)
-            }
-            return self.instr[dname]
+        try:
+            ans = client['zmq'].get_schema(dname)
+        except InstrumentServerError:
+            if not dname in client['zmq'].list_instr():
+                if dname in self.instr:
+                    self.remove_device(dname)
+                    self.index.pop(dname, None)
+                return None
+            ans = None
+        return self.add_device(dname, client, ans)
 
     def del_instr(self, dname):
-        client = self.get(dname)
-        client['zmq'].del_instr(dname)
-        self.update_instr(dname, client)
+        client = self.index[dname] if dname in self.index else None
+        self.get(dname)['zmq'].del_instr(dname)
+        if client is None:
+            self.refresh()
+        else:
+            self.update_instr(dname, client)
         
     def add_instr(self, dname, client, dclass, *args, **kwargs):
         client['zmq'].add_instr(dname, dclass, *args, **kwargs)
         self.update_instr(dname, client)
         return 
 
+    def close(self):
+        """Close the connections to the servers and stop the watchers (the devices can't be used afterward)"""
+        for d in self.instr.values():
+            d['dev']._cache.stop()
+        for c in self.clients:
+            watcher = c.pop('watcher', None)
+            if not watcher is None:
+                watcher.stop()
+            if hasattr(c['zmq'], 'close'):
+                c['zmq'].close()
+
     def get_devices(self):
         return {dname : self.instr[dname]['dev'] for dname in self.instr}
 
@@ -80,7 +189,7 @@ class Instrument_Manager():
         if dname in self.instr:
             return self.instr[dname]
         else:
-            for c in self.clients:
-                if dname in c['zmq'].list_instr():
-                    return self.update_instr(dname, c)
-            raise Exception('Could not find device: {}'.format(dname))
\ No newline at end of file
+            self.refresh()
+            if dname in self.instr:
+                return self.instr[dname]
+            raise Exception('Could not find device: {}'.format(dname))
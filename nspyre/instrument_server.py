@@ -24,8 +24,18 @@ import time
 import zmq
 import traceback
 import socket
+import threading
+import queue
+import itertools
+import asyncio
+import concurrent.futures
+import functools
+import operator
+from collections import OrderedDict
+from pymongo import UpdateOne
   
 from nspyre.utils import get_mongo_client, get_class_from_str
+from nspyre.stats import Latency_Stats, Stats_Dumper
 
 
 ZMQ_CONTEXT = zmq.Context()
@@ -43,6 +53,48 @@ def custom_decode(obj):
         obj = Q_(obj[b'm'], obj[b'units'])
     return obj
 
+def serialize(obj):
+    return msgpack.packb(obj, use_bin_type=True, default=custom_encode)
+
+def deserialize(ser):
+    return msgpack.unpackb(ser, raw=False, object_hook=custom_decode)
+
+# Multipart transport: ndarrays larger than this are sent as separate frames (without copy) instead of inside the msgpack blob
+MULTIPART_MIN_BYTES = 1024
+
+def _extract_arrays(obj, buffers):
+    if isinstance(obj, np.ndarray) and obj.dtype != object and obj.nbytes >= MULTIPART_MIN_BYTES:
+        buffers.append(np.ascontiguousarray(obj))
+        return {b'__ndframe__': len(buffers), b'dtype': obj.dtype.str, b'shape': list(obj.shape)}
+    elif isinstance(obj, Q_):
+        return {b'__Quantity__': True, b'm': _extract_arrays(obj.m, buffers), b'units': str(obj.units)}
+    elif isinstance(obj, dict):
+        return {k:_extract_arrays(v, buffers) for k, v in obj.items()}
+    elif isinstance(obj, (list, tuple)):
+        return [_extract_arrays(v, buffers) for v in obj]
+    return obj
+
+def serialize_frames(obj):
+    """
+    Serialize obj as a list of frames: a msgpack header followed by the raw data of each large ndarray.
+    The array frames can be sent with copy=False, so they are never copied into a serialized blob.
+    """
+    buffers = list()
+    header = serialize(_extract_arrays(obj, buffers))
+    return [header] + buffers
+
+def deserialize_frames(frames):
+    """
+    Inverse of serialize_frames (also accepts a single frame produced by serialize).  The frames can be zmq.Frame (received with copy=False),
+    in which case the arrays are built on top of the received buffers with np.frombuffer.
+    """
+    buffers = [f.buffer if isinstance(f, zmq.Frame) else f for f in frames]
+    def object_hook(obj):
+        if b'__ndframe__' in obj:
+            return np.frombuffer(buffers[obj[b'__ndframe__']], dtype=np.dtype(obj[b'dtype'])).reshape(obj[b'shape'])
+        return custom_decode(obj)
+    return msgpack.unpackb(buffers[0], raw=False, object_hook=object_hook)
+
 class InstrumentServerError(Exception):
     pass
 
@@ -50,18 +102,449 @@ class ServerUnreachableError(Exception):
     pass
 
 
+def parse_device_spec(dev):
+    """
+    Parse a device_list entry, which is either a list [class, [args], {kwargs}] or a dict
+    {class:..., args:[...], kwargs:{...}, depends_on:[...]}
+    """
+    if isinstance(dev, dict):
+        spec = {'class':dev['class'], 'args':list(dev.get('args', [])), 'kwargs':dict(dev.get('kwargs', {})), 'depends_on':dev.get('depends_on', [])}
+    else:
+        dev = list(dev) + [[], {}]
+        spec = {'class':dev[0], 'args':list(dev[1]), 'kwargs':dict(dev[2]), 'depends_on':[]}
+    if isinstance(spec['depends_on'], str):
+        spec['depends_on'] = [spec['depends_on']]
+    return spec
+
+
+class Feat_Entry():
+    """
+    Precompiled description of a feat (or dictfeat) of a device: getter/setter callables, base units, readonly flag,
+    sorted keys with their index and a cache of the conversion factors to the base units.
+    """
+    def __init__(self, dev, name, feat):
+        params = feat.modifiers[MISSING][MISSING]
+        self.name = name
+        self.type = 'dictfeat' if isinstance(feat, DictFeat) else 'feat'
+        self.params = params
+        self.units = params['units']
+        self.readonly = dict(dev.feats.items())[name].feat.fset is None
+        if self.type == 'dictfeat':
+            accessor = getattr(dev, name)
+            self.get = accessor.__getitem__
+            self.set = accessor.__setitem__
+            keys = params.get('keys')
+            self.keys = sorted(keys) if not keys is None else None
+            self.key_index = {key:i for i, key in enumerate(self.keys)} if not keys is None else None
+        else:
+            self.get = functools.partial(operator.attrgetter(name), dev)
+            self.set = functools.partial(setattr, dev, name)
+            self.keys = None
+            self.key_index = None
+        self._base_units = Q_(1, self.units).units if not self.units is None else None
+        self._factors = dict()
+
+    def to_base(self, val):
+        """Returns the magnitude of val in the base units of the feat"""
+        if not isinstance(val, Q_) or self._base_units is None:
+            return val
+        units = val.units
+        if units == self._base_units:
+            return val.m
+        factor = self._factors.get(units)
+        if factor is None:
+            # Only multiplicative units can be cached (not offset units like degC)
+            if Q_(0, units).to(self._base_units).m == 0:
+                factor = self._factors[units] = Q_(1, units).to(self._base_units).m
+            else:
+                return val.to(self._base_units).m
+        return val.m * factor
+
+    def check_writable(self, dname):
+        if self.readonly:
+            raise Exception('{}.{} is read-only'.format(dname, self.name))
+
+
+def build_schema(dclass, readonly=None):
+    """
+    Serializable description of a driver class used to build the Remote_Device proxies without importing the driver on the client:
+        {'class':<class str>, 'mro':[<class str>, ...], 'actions':[<name>, ...],
+         'feats':{<name>:{'type', 'readonly', 'read_once', 'units', 'limits', 'values', 'keys'}}}
+    readonly is an optional dict feat name -> readonly flag (by default the feats without a setter are readonly)
+    """
+    feats = OrderedDict()
+    for feat_name, feat in dclass._lantz_features.items():
+        params = feat.modifiers[MISSING][MISSING]
+        values = list(params['values']) if not params['values'] is None else None
+        keys = sorted(params['keys']) if not params.get('keys') is None else None
+        limits = params['limits']
+        if not limits is None:
+            if len(limits) == 1:
+                limits = [0, limits[0]]
+            elif len(limits) == 3:
+                limits = [limits[0], limits[1]]
+                # step = limits[2] #Not used right now
+        feats[feat_name] = {
+            'type': 'dictfeat' if isinstance(feat, DictFeat) else 'feat',
+            'readonly': readonly[feat_name] if not readonly is None else getattr(feat, 'fset', None) is None,
+            'read_once': bool(getattr(feat, 'read_once', False)),
+            'units': params['units'],
+            'limits': limits,
+            'values': values,
+            'keys': keys,
+        }
+    return {
+        'class': '{}.{}'.format(dclass.__module__, dclass.__name__),
+        'mro': ['{}.{}'.format(c.__module__, c.__name__) for c in dclass.__mro__],
+        'feats': feats,
+        'actions': list(dclass._lantz_actions),
+    }
+
+
+class Device_Dispatch():
+    """
+    Dispatch table of a device (compiled once in add_instr): feats is a dict name -> Feat_Entry and actions a dict name -> bound method.
+    Also holds the schema of the device (see build_schema).
+    """
+    def __init__(self, dev):
+        c = type(dev)
+        self.feats = {name:Feat_Entry(dev, name, feat) for name, feat in c._lantz_features.items()}
+        self.actions = {name:getattr(dev, name) for name in c._lantz_actions}
+        self.schema = build_schema(c, readonly={name:entry.readonly for name, entry in self.feats.items()})
+
+
+class Device_Worker(threading.Thread):
+    """
+    Thread executing the requests for a device (or a group of devices sharing a lock) in the concurrent Instrument_Server.
+    Requests are executed in the order they were received and the serialized replies are pushed back to the server thread
+    (ZMQ sockets can't be shared between threads).
+    """
+    def __init__(self, server, group):
+        super().__init__(daemon=True, name='Device_Worker[{}]'.format(group))
+        self.server = server
+        self.group = group
+        self.queue = queue.Queue()
+
+    def run(self):
+        push = self.server.context.socket(zmq.PUSH)
+        push.connect(self.server.reply_addr)
+        while True:
+            envelope, req, deserialize_time = self.queue.get()
+            frames = self.server.reply_frames(req, deserialize_time, lock=self.server.device_lock(self.group))
+            push.send_multipart(envelope + frames, copy=False)
+
+
+class Monitor():
+    """
+    Server side monitoring of feats (see Instrument_Server.subscribe).
+
+    Each subscribed feat is polled at the requested rate by a thread dedicated to its lock group, and its value is published on a PUB socket
+    as [topic, serialize_frames(msg)] where topic is b'<dname>.<feat>' (or b'<dname>.<feat>[<key>]' for a dictfeat) and msg is a dict
+    with the dname, feat, key, value and time.  A value is only published when it changed (by more than the deadband if one is given).
+    Several subscriptions to the same feat are merged (fastest rate and smallest deadband).
+    """
+    def __init__(self, server, port):
+        self.server = server
+        self.port = port
+        self.socket = server.context.socket(zmq.PUB)
+        self.socket.bind("tcp://*:{}".format(port))
+        self.socket_lock = threading.Lock()
+        self.subs = dict()
+        self.threads = dict()
+        self._ids = itertools.count(1)
+        self._cond = threading.Condition()
+
+    @staticmethod
+    def get_topic(dname, feat, key=None):
+        return '{}.{}'.format(dname, feat) if key is None else '{}.{}[{}]'.format(dname, feat, key)
+
+    def to_base(self, dname, feat, val):
+        entry = self.server.dispatch[dname].feats.get(feat) if dname in self.server.dispatch else None
+        if not entry is None:
+            return entry.to_base(val)
+        return val.m if isinstance(val, Q_) else val
+
+    def subscribe(self, dname, feat, rate=1, deadband=None, key=None):
+        entry = self.server.get_feat_entry(dname, feat)
+        if entry is None:
+            raise ValueError('{} has no feat {}'.format(dname, feat))
+        if entry.type == 'dictfeat' and key is None:
+            raise ValueError('{}.{} is a dictfeat, a key is needed'.format(dname, feat))
+        if entry.type == 'feat' and not key is None:
+            raise ValueError('{}.{} is not a dictfeat'.format(dname, feat))
+        if not key is None and not entry.key_index is None and not key in entry.key_index:
+            raise ValueError('Invalid key for {}.{}: {}'.format(dname, feat, key))
+        if not isinstance(rate, (int, float, np.number)) or not rate > 0:
+            raise ValueError('The rate must be a positive number (got {})'.format(rate))
+        if not deadband is None:
+            deadband = abs(self.to_base(dname, feat, deadband))
+        topic = self.get_topic(dname, feat, key)
+        group = self.server.get_lock_group(dname)
+        with self._cond:
+            sub_id = next(self._ids)
+            if not topic in self.subs:
+                self.subs[topic] = {'dname':dname, 'feat':feat, 'key':key, 'group':group, 'requests':dict(), 'next':time.time(), 'errors':0}
+            sub = self.subs[topic]
+            sub['requests'][sub_id] = (rate, deadband)
+            self._update(sub)
+            # Publish the current value on the next poll even if it didn't change
+            sub['last'] = MISSING
+            sub['next'] = time.time()
+            if not group in self.threads:
+                self.threads[group] = threading.Thread(target=self._run, args=(group,), daemon=True, name='Monitor[{}]'.format(group))
+                self.threads[group].start()
+            self._cond.notify_all()
+        return {'sub_id':sub_id, 'topic':topic, 'pub_port':self.port}
+
+    def unsubscribe(self, sub_id):
+        with self._cond:
+            for topic, sub in list(self.subs.items()):
+                if sub_id in sub['requests']:
+                    sub['requests'].pop(sub_id)
+                    if sub['requests']:
+                        self._update(sub)
+                    else:
+                        self.subs.pop(topic)
+                    self._cond.notify_all()
+                    return True
+        return False
+
+    def list_subscriptions(self):
+        with self._cond:
+            return {topic:{'rate':sub['rate'], 'deadband':sub['deadband'], 'sub_ids':list(sub['requests']), 'errors':sub['errors']}
+                    for topic, sub in self.subs.items()}
+
+    def _update(self, sub):
+        rates, deadbands = zip(*sub['requests'].values())
+        sub['rate'] = max(rates)
+        sub['deadband'] = None if None in deadbands else min(deadbands)
+
+    def _run(self, group):
+        while True:
+            with self._cond:
+                subs = [sub for sub in self.subs.values() if sub['group'] == group]
+                now = time.time()
+                due = [sub for sub in subs if sub['next'] <= now]
+                if not due:
+                    self._cond.wait(min([sub['next'] for sub in subs]) - now if subs else None)
+                    continue
+                for sub in due:
+                    # Don't try to catch up on missed polls
+                    sub['next'] = max(sub['next'] + 1/sub['rate'], now)
+            for sub in due:
+                self.poll(sub)
+
+    def poll(self, sub):
+        dname, feat, key = sub['dname'], sub['feat'], sub['key']
+        try:
+            with self.server.device_lock(dname):
+                if key is None:
+                    val = self.server.get_feat(dname, feat)
+                else:
+                    val = self.server.get_dictfeat(dname, feat, key)
+        except Exception as e:
+            sub['errors'] += 1
+            if self.server.DEBUG:
+                traceback.print_exc()
+            return
+        if not self.changed(sub, val):
+            return
+        sub['last'] = val
+        msg = {'dname':dname, 'feat':feat, 'key':key, 'value':val, 'time':time.time()}
+        frames = [self.get_topic(dname, feat, key).encode()] + serialize_frames(msg)
+        with self.socket_lock:
+            self.socket.send_multipart(frames, copy=False)
+
+    def changed(self, sub, val):
+        last = sub['last']
+        if last is MISSING:
+            return True
+        try:
+            new, old = self.to_base(sub['dname'], sub['feat'], val), self.to_base(sub['dname'], sub['feat'], last)
+            if sub['deadband'] is None:
+                return not np.array_equal(new, old)
+            return bool(np.any(np.abs(np.subtract(new, old)) > sub['deadband']))
+        except Exception:
+            return True
+
+
+class SequenceStopped(Exception):
+    pass
+
+
+class Sequence(threading.Thread):
+    """
+    Sequence of steps executed by the server (see Instrument_Server.run_sequence), so tight loops don't pay a network round trip per point.
+    The steps are dicts with an 'op':
+        {'op':'set', 'dev':'sg', 'feat':'frequency', 'value':'$f'}                  (optional 'key' for a dictfeat)
+        {'op':'get', 'dev':'daq', 'feat':'ctr0', 'as':'counts'}                     (optional 'key', 'as' defaults to the feat name)
+        {'op':'action', 'dev':'daq', 'action':'read', 'args':[...], 'kwargs':{...}, 'as':'trace'}
+        {'op':'sleep', 'time':0.01}
+        {'op':'loop', 'var':'f', 'values':[...], 'steps':[...]}                       (or 'count':n to repeat n times)
+        {'op':'emit', 'vars':['f', 'counts']}                                       (vars defaults to all variables)
+    Strings starting with '$' in values, args and kwargs are replaced by the variable of that name ('$$' for a literal '$').
+    Each emit adds a row (dict) to the results, which are fetched (without waiting) by blocks of at most <block_size> rows.
+    Each device call holds the device lock (like the client requests), so other clients can still interleave their requests
+    between the steps but never during one.
+    """
+    def __init__(self, server, seq_id, steps, block_size=100):
+        super().__init__(daemon=True, name='Sequence[{}]'.format(seq_id))
+        self.server = server
+        self.seq_id = seq_id
+        self.steps = steps
+        self.block_size = block_size
+        self.rows = list()
+        self.n_rows = 0
+        self.done = False
+        self.error = None
+        self.start_time = None
+        self.stop_time = None
+        self._stop_event = threading.Event()
+        self._cond = threading.Condition()
+        self.validate(steps)
+
+    def validate(self, steps):
+        for step in steps:
+            if not isinstance(step, dict) or not 'op' in step:
+                raise ValueError('Invalid step (must be a dict with an op): {}'.format(step))
+            op = step['op']
+            required = {'set':['dev', 'feat', 'value'], 'get':['dev', 'feat'], 'action':['dev', 'action'], 'sleep':['time'], 'loop':['steps'], 'emit':[]}
+            if not op in required:
+                raise ValueError('Invalid op: {}'.format(op))
+            missing = [k for k in required[op] if not k in step]
+            if missing:
+                raise ValueError('Missing {} in {} step'.format(missing, op))
+            if op == 'loop':
+                if not 'count' in step and not ('var' in step and 'values' in step):
+                    raise ValueError("A loop needs a count or a var and values")
+                self.validate(step['steps'])
+
+    def resolve(self, val, variables):
+        if isinstance(val, str) and val.startswith('$'):
+            return val[1:] if val.startswith('$$') else variables[val[1:]]
+        elif isinstance(val, list):
+            return [self.resolve(v, variables) for v in val]
+        elif isinstance(val, dict):
+            return {k:self.resolve(v, variables) for k, v in val.items()}
+        return val
+
+    def run(self):
+        self.start_time = time.time()
+        try:
+            self.execute(self.steps, dict())
+        except SequenceStopped:
+            pass
+        except Exception as e:
+            if self.server.DEBUG:
+                traceback.print_exc()
+            self.error = traceback.format_exc()
+        finally:
+            with self._cond:
+                self.stop_time = time.time()
+                self.done = True
+                self._cond.notify_all()
+
+    def execute(self, steps, variables):
+        server = self.server
+        for step in steps:
+            if self._stop_event.is_set():
+                raise SequenceStopped()
+            op = step['op']
+            if op == 'set':
+                val = self.resolve(step['value'], variables)
+                with server.device_lock(step['dev']):
+                    if step.get('key') is None:
+                        server.set_feat(step['dev'], step['feat'], val)
+                    else:
+                        server.set_dictfeat(step['dev'], step['feat'], self.resolve(step['key'], variables), val)
+            elif op == 'get':
+                with server.device_lock(step['dev']):
+                    if step.get('key') is None:
+                        val = server.get_feat(step['dev'], step['feat'])
+                    else:
+                        val = server.get_dictfeat(step['dev'], step['feat'], self.resolve(step['key'], variables))
+                variables[step.get('as', step['feat'])] = val
+            elif op == 'action':
+                args = self.resolve(list(step.get('args', [])), variables)
+                kwargs = self.resolve(dict(step.get('kwargs', {})), variables)
+                with server.device_lock(step['dev']):
+                    val = server.run_action(step['dev'], step['action'], *args, **kwargs)
+                if 'as' in step:
+                    variables[step['as']] = val
+            elif op == 'sleep':
+                if self._stop_event.wait(self.resolve(step['time'], variables)):
+                    raise SequenceStopped()
+            elif op == 'loop':
+                if 'count' in step:
+                    values = range(self.resolve(step['count'], variables))
+                else:
+                    values = self.resolve(step['values'], variables)
+                for val in values:
+                    if 'var' in step:
+                        variables[step['var']] = val
+                    self.execute(step['steps'], variables)
+            elif op == 'emit':
+                names = step.get('vars')
+                row = dict(variables) if names is None else {name:variables[name] for name in names}
+                with self._cond:
+                    self.rows.append(row)
+                    self.n_rows += 1
+
+    def fetch(self):
+        """
+        Returns (without waiting, since it runs in the server thread) up to block_size of the rows emitted since the last fetch.
+        done is only True once the sequence is over and all its rows were fetched.
+        """
+        with self._cond:
+            rows, self.rows = self.rows[:self.block_size], self.rows[self.block_size:]
+            return {'rows':rows, 'done':self.done and not self.rows, 'error':self.error}
+
+    def stop(self):
+        self._stop_event.set()
+
+    def status(self):
+        return {'seq_id':self.seq_id, 'done':self.done, 'error':self.error, 'n_rows':self.n_rows, 'pending_rows':len(self.rows), 'start_time':self.start_time, 'stop_time':self.stop_time}
+
+
 class Instrument_Server():
     """
         This is the base instrument server without MongoDB signalling 
+
+        By default the server uses a REP socket and handles one request at a time.
+        With concurrent=True, it uses a ROUTER socket instead and every device gets its own worker thread, so requests to different
+        devices are executed concurrently while the requests to a given device are still executed in order.  Devices which can't be
+        accessed concurrently (for example if they share a bus) can be put in the same lock group with lock_groups={dname:group_name}.
+        Both modes are compatible with the (REQ based) Instrument_Server_Client.
+        In both modes, device requests hold the device lock (see device_lock), which is shared with the monitors and sequences
+        running on the server.
     """
     DEBUG = True
 
-    def __init__(self,  server_name, port):
+    # Commands where the first argument is the device name (these are executed by the device worker in concurrent mode)
+    DEVICE_COMMANDS = ['ADD_INSTR', 'DEL_INSTR', 'GET_INSTR_INFO', 'GET_SCHEMA', 'INITIALIZE', 'FINALIZE', 'GET_FEAT', 'SET_FEAT',
+                       'GET_DICTFEAT', 'SET_DICTFEAT', 'RUN_ACTION', 'READ', 'GET_NONE_FEAT']
+
+    def __init__(self,  server_name, port, concurrent=False, lock_groups=None, pub_port=None, stats_interval=None):
         self.name = server_name
         self.port = port
+        self.pub_port = port + 1 if pub_port is None else pub_port
+        self.monitor = None
+        self.sequences = dict()
+        self._sequence_ids = itertools.count(1)
+        self.stats = Latency_Stats()
+        self.stats_dumper = None
+        if stats_interval:
+            self.stats_dumper = Stats_Dumper(self.stats, interval=stats_interval)
+            self.stats_dumper.start()
+        self.concurrent = concurrent
+        self.lock_groups = dict() if lock_groups is None else dict(lock_groups)
         self.context = ZMQ_CONTEXT
-        self.socket = self.context.socket(zmq.REP)
+        self.socket = self.context.socket(zmq.ROUTER if concurrent else zmq.REP)
         self.socket.bind("tcp://*:{}".format(port))
+        self.reply_addr = 'inproc://instrument_server_replies_{}'.format(id(self))
+        self.workers = dict()
+        self._locks = dict()
+        self._locks_lock = threading.Lock()
 
         self.COMMANDS = {
             'ID':self.get_id,
@@ -80,33 +563,164 @@ class Instrument_Server():
             'RUN_ACTION': self.run_action,
             'GET_MONGODB':self.get_mongodb,
             'READ': self.read,
+            'BATCH': self.batch,
+            'LOAD_STATUS': self.get_load_status,
+            'SUBSCRIBE': self.subscribe,
+            'UNSUBSCRIBE': self.unsubscribe,
+            'LIST_SUBSCRIPTIONS': self.list_subscriptions,
+            'GET_PUB_PORT': self.get_pub_port,
+            'RUN_SEQUENCE': self.run_sequence,
+            'FETCH_SEQUENCE': self.fetch_sequence,
+            'STOP_SEQUENCE': self.stop_sequence,
+            'LIST_SEQUENCES': self.list_sequences,
+            'GET_SCHEMA': self.get_schema,
+            'DESCRIBE': self.describe,
+            'STATS': self.get_stats,
+            'RESET_STATS': self.reset_stats,
         }
 
         self.instr = {}
         self.instr_info = {}
+        self.dispatch = {}
+        self.load_report = OrderedDict()
 
     def get_mongodb(self):
         return None
     
-    def send(self, obj):
-        ser = msgpack.packb(obj, use_bin_type=True, default=custom_encode)
-        return self.socket.send(ser)
+    def send(self, obj, multipart=False):
+        if multipart:
+            return self.socket.send_multipart(serialize_frames(obj), copy=False)
+        return self.socket.send(serialize(obj))
 
     def recv(self):
-        ser = self.socket.recv()
-        return msgpack.unpackb(ser, raw=False, object_hook=custom_decode)
+        return deserialize_frames(self.socket.recv_multipart(copy=False))
+
+    def get_lock_group(self, dname):
+        return self.lock_groups.get(dname, dname)
+
+    def device_lock(self, dname):
+        """Returns the lock protecting a device (or its lock group).  It is held while the device executes a request"""
+        group = self.get_lock_group(dname)
+        with self._locks_lock:
+            if not group in self._locks:
+                self._locks[group] = threading.RLock()
+            return self._locks[group]
+
+    def request_lock(self, req):
+        """Returns the device lock to hold while executing a request (None if it isn't a device command)"""
+        if isinstance(req, dict) and req.get('cmd') in self.DEVICE_COMMANDS:
+            args = req.get('args', [])
+            if len(args) and isinstance(args[0], str):
+                return self.device_lock(args[0])
+        return None
+
+    def handle(self, req):
+        """Execute a request and return the reply dict"""
+        try:
+            return {'status':'ok', 'data':self.answer_request(req)}
+        except Exception as e:
+            if self.DEBUG:
+                traceback.print_exc()
+            return {'status':'error', 'data':traceback.format_exc()}
+
+    # Commands where the second argument is a feat (or action) name, used to key the latency stats
+    FEAT_COMMANDS = ['GET_FEAT', 'SET_FEAT', 'GET_DICTFEAT', 'SET_DICTFEAT', 'RUN_ACTION']
+
+    @classmethod
+    def stats_key(cls, req):
+        """Key of a request in the latency stats: (dname, cmd, feat)"""
+        if not isinstance(req, dict):
+            return (None, None, None)
+        cmd, args = req.get('cmd'), req.get('args', [])
+        dname = args[0] if cmd in cls.DEVICE_COMMANDS and len(args) > 0 else None
+        feat = args[1] if cmd in cls.FEAT_COMMANDS and len(args) > 1 else None
+        return (dname, cmd, feat)
+
+    def timed_handle(self, req, lock=None):
+        """Execute a request (holding <lock> if given) and return (reply, phases) with the device time and the phases added while handling it"""
+        outer = self.stats.start()
+        t = time.perf_counter()
+        if lock is None:
+            reply = self.handle(req)
+        else:
+            with lock:
+                reply = self.handle(req)
+        call_time = time.perf_counter() - t
+        # The phases added while handling the request (mirror) are not included in the device time
+        phases = self.stats.stop(outer)
+        phases['device'] = call_time - sum(phases.values())
+        return reply, phases
+
+    def reply_frames(self, req, deserialize_time=0, lock=None):
+        """Execute a request (holding <lock> if given) and return the serialized reply, recording the time spent in each phase"""
+        reply, phases = self.timed_handle(req, lock=lock)
+        phases['deserialize'] = deserialize_time
+        t = time.perf_counter()
+        if isinstance(req, dict) and req.get('multipart', False):
+            frames = serialize_frames(reply)
+        else:
+            frames = [serialize(reply)]
+        phases['serialize'] = time.perf_counter() - t
+        self.stats.record(self.stats_key(req), phases, error=reply['status'] != 'ok')
+        return frames
+
+    def get_stats(self):
+        return self.stats.snapshot()
+
+    def reset_stats(self):
+        self.stats.reset()
 
     def serve_forever(self):
+        if self.concurrent:
+            return self.serve_forever_concurrent()
         while True:
+            frames = self.socket.recv_multipart(copy=False)
+            t = time.perf_counter()
             try:
-                req = self.recv()
-                reply = self.answer_request(req)
-                self.send({'status':'ok', 'data':reply})
+                req = deserialize_frames(frames)
             except Exception as e:
                 if self.DEBUG:
                     traceback.print_exc()
-                error_str = traceback.format_exc()
-                self.send({'status':'error', 'data':error_str})
+                self.send({'status':'error', 'data':traceback.format_exc()})
+                continue
+            # The monitors and sequences access the devices from other threads, so the device lock is needed here too
+            self.socket.send_multipart(self.reply_frames(req, time.perf_counter() - t, lock=self.request_lock(req)), copy=False)
+
+    def serve_forever_concurrent(self):
+        replies = self.context.socket(zmq.PULL)
+        replies.bind(self.reply_addr)
+        poller = zmq.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        poller.register(replies, zmq.POLLIN)
+        while True:
+            events = dict(poller.poll())
+            if self.socket in events:
+                frames = self.socket.recv_multipart(copy=False)
+                # The envelope is everything up to (and including) the empty delimiter frame
+                i = next((i for i, f in enumerate(frames) if len(f.buffer) == 0), 0)
+                envelope, payload = [f.bytes for f in frames[:i+1]], frames[i+1:]
+                t = time.perf_counter()
+                try:
+                    req = deserialize_frames(payload)
+                except Exception as e:
+                    if self.DEBUG:
+                        traceback.print_exc()
+                    self.socket.send_multipart(envelope + [serialize({'status':'error', 'data':traceback.format_exc()})])
+                    continue
+                self.get_worker(req).queue.put((envelope, req, time.perf_counter() - t))
+            if replies in events:
+                self.socket.send_multipart(replies.recv_multipart(copy=False), copy=False)
+
+    def get_worker(self, req):
+        """Returns the worker which should execute a request (the device worker for device commands, a common server worker otherwise)"""
+        if isinstance(req, dict) and req.get('cmd') in self.DEVICE_COMMANDS and len(req.get('args', [])):
+            group = self.get_lock_group(req['args'][0])
+        else:
+            group = '__server__'
+        if not group in self.workers:
+            self.workers[group] = Device_Worker(self, group)
+            self.workers[group].start()
+        return self.workers[group]
     
     def answer_request(self, req):
         """
@@ -139,14 +753,91 @@ class Instrument_Server():
 
     def add_instr(self, dname, dclass, *args, **kwargs):
         c = get_class_from_str(dclass)
-        self.instr[dname] = c(*args, **kwargs)
-        self.instr_info[dname] = {'class':dclass, 'args':args, 'kwargs':kwargs}
-        self.initialize_instr(dname)
+        dev = c(*args, **kwargs)
+        dev.initialize()
+        self.publish_instr(dname, dev, {'class':dclass, 'args':args, 'kwargs':kwargs})
         return "Instrument added!"
 
+    def publish_instr(self, dname, dev, info, dispatch=None):
+        """Make an initialized device available to the clients (devices are only listed once they are ready)"""
+        self.dispatch[dname] = Device_Dispatch(dev) if dispatch is None else dispatch
+        self.instr_info[dname] = info
+        self.instr[dname] = dev
+
+    def load_devices(self, device_list, max_workers=8):
+        """
+        Add the devices of a device_list (see config.yaml) in parallel using a thread pool, and return a dict of dname -> Future.
+        A device is only loaded once all the devices listed in its depends_on are ready (it is skipped if one of them failed).
+        Devices in the same lock group are never initialized at the same time.
+        This doesn't block, so the server can answer requests for the ready devices while the others are still loading.
+        The status and load time of each device is kept in self.load_report (see the LOAD_STATUS command).
+        """
+        specs = OrderedDict((dname, parse_device_spec(dev)) for dname, dev in device_list.items())
+        for dname in specs:
+            self.load_report[dname] = {'status':'waiting', 'time':None, 'error':None}
+
+        # Order the devices so that the dependencies come first.  With a FIFO pool this guarantees that a device waiting
+        # on its dependencies never prevents them from running.
+        order, state = list(), dict()
+        def visit(dname, stack):
+            if state.get(dname) == 'done':
+                return True
+            if dname in stack:
+                raise ValueError('Circular dependency: {}'.format(' -> '.join(stack + [dname])))
+            if not dname in specs:
+                raise ValueError('Unknown dependency: {}'.format(dname))
+            for dep in specs[dname]['depends_on']:
+                visit(dep, stack + [dname])
+            state[dname] = 'done'
+            order.append(dname)
+        for dname in specs:
+            try:
+                visit(dname, [])
+            except ValueError as e:
+                print('Could not load {}: {}'.format(dname, e))
+                self.load_report[dname].update(status='failed', error=str(e))
+
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='device_loader')
+        futures = OrderedDict()
+        for dname in order:
+            deps = [futures[dep] for dep in specs[dname]['depends_on']]
+            futures[dname] = pool.submit(self._load_device, dname, specs[dname], deps)
+        pool.shutdown(wait=False)
+        return futures
+
+    def _load_device(self, dname, spec, deps):
+        report = self.load_report[dname]
+        concurrent.futures.wait(deps)
+        if not all(not dep.cancelled() and dep.exception() is None for dep in deps):
+            report.update(status='skipped', error='A dependency failed to load')
+            print('Skipped {} (a dependency failed to load)'.format(dname))
+            raise Exception('A dependency of {} failed to load'.format(dname))
+        with self.device_lock(dname):
+            report['status'] = 'loading'
+            t = time.time()
+            try:
+                self.add_instr(dname, spec['class'], *spec['args'], **spec['kwargs'])
+            except Exception as e:
+                report.update(status='failed', time=time.time()-t, error=traceback.format_exc())
+                print('Could not load {}'.format(dname))
+                traceback.print_exc()
+                raise
+        report.update(status='ready', time=time.time()-t)
+        print('Loaded {} in {:2f}s'.format(dname, report['time']))
+
+    def get_load_status(self):
+        return self.load_report
+
+    def print_load_report(self):
+        print('Device load report:')
+        for dname, report in sorted(self.load_report.items(), key=lambda x: -(x[1]['time'] or 0)):
+            t = '' if report['time'] is None else '{:.2f}s'.format(report['time'])
+            print('\t{:<20} {:<8} {}'.format(dname, report['status'], t))
+
     def del_instr(self, dname):
         try:
             self.instr_info.pop(dname)
+            self.dispatch.pop(dname, None)
             d = self.instr.pop(dname)
             d.finalize()
         finally:
@@ -158,57 +849,218 @@ class Instrument_Server():
     def get_instr_info(self, dname):
         return self.instr_info[dname]
 
+    def get_schema(self, dname):
+        """Returns the info and the schema of a device (see build_schema)"""
+        return {'info':self.instr_info[dname], 'schema':self.dispatch[dname].schema}
+
+    def describe(self):
+        """Full inventory of the server in a single request: {'name', 'mongodb', 'instr':{dname:{'info', 'schema'}}}"""
+        return {'name':self.name, 'mongodb':self.get_mongodb(), 'instr':{dname:self.get_schema(dname) for dname in list(self.instr)}}
+
     def initialize_instr(self, dname):
         return self.instr[dname].initialize()
 
     def finalize_instr(self, dname):
         return self.instr[dname].finalize()
 
-    # @TODO Maybe worth adding some checks here to verify these are valid feat, dictfeat or action
+    # The feats and actions go through the dispatch table of the device.  Other attributes are still accessed with getattr.
+    def get_feat_entry(self, dname, feat):
+        if not dname in self.instr:
+            raise KeyError(dname)
+        return self.dispatch[dname].feats.get(feat)
+
     def get_feat(self, dname, feat):
-        return getattr(self.instr[dname], feat)
+        entry = self.get_feat_entry(dname, feat)
+        if entry is None:
+            return getattr(self.instr[dname], feat)
+        return entry.get()
 
     def set_feat(self, dname, feat, val):
-        return setattr(self.instr[dname], feat, val)
+        entry = self.get_feat_entry(dname, feat)
+        if entry is None:
+            return setattr(self.instr[dname], feat, val)
+        entry.check_writable(dname)
+        return entry.set(val)
 
     def get_dictfeat(self, dname, feat, key):
-        return getattr(self.instr[dname], feat)[key]
+        entry = self.get_feat_entry(dname, feat)
+        if entry is None:
+            return getattr(self.instr[dname], feat)[key]
+        return entry.get(key)
 
     def set_dictfeat(self, dname, feat, key, val):
-        getattr(self.instr[dname], feat)[key] = val
+        entry = self.get_feat_entry(dname, feat)
+        if entry is None:
+            getattr(self.instr[dname], feat)[key] = val
+            return
+        entry.check_writable(dname)
+        entry.set(key, val)
 
     def run_action(self, dname, action, *args, **kwargs):
-        return getattr(self.instr[dname], action)(*args, **kwargs)
+        if not dname in self.instr:
+            raise KeyError(dname)
+        f = self.dispatch[dname].actions.get(action)
+        if f is None:
+            f = getattr(self.instr[dname], action)
+        return f(*args, **kwargs)
 
     def read(self, dname):
         return getattr(self.instr[dname], 'read')()
 
+    def get_monitor(self):
+        # The PUB socket is only bound when monitoring is first used
+        with self._locks_lock:
+            if self.monitor is None:
+                self.monitor = Monitor(self, self.pub_port)
+            return self.monitor
+
+    def get_pub_port(self):
+        return self.get_monitor().port
+
+    def subscribe(self, dname, feat, rate=1, deadband=None, key=None):
+        """
+        Poll a feat (or a key of a dictfeat) at <rate> Hz on the server and publish its value on the PUB socket whenever it changes
+        (by more than <deadband>, in base units or as a Quantity, if given).  Returns {'sub_id', 'topic', 'pub_port'}.
+        """
+        return self.get_monitor().subscribe(dname, feat, rate=rate, deadband=deadband, key=key)
+
+    def unsubscribe(self, sub_id):
+        return self.get_monitor().unsubscribe(sub_id)
+
+    def list_subscriptions(self):
+        return self.get_monitor().list_subscriptions()
+
+    def run_sequence(self, steps, block_size=100):
+        """Start executing a sequence of steps on the server (see Sequence) and return its id"""
+        seq_id = next(self._sequence_ids)
+        seq = Sequence(self, seq_id, steps, block_size=block_size)
+        self.sequences[seq_id] = seq
+        seq.start()
+        return seq_id
+
+    def fetch_sequence(self, seq_id):
+        """Returns {'rows', 'done', 'error'} with the new rows of a sequence.  A sequence is forgotten once it is done and all its rows were fetched"""
+        ans = self.sequences[seq_id].fetch()
+        if ans['done']:
+            self.sequences.pop(seq_id, None)
+        return ans
+
+    def stop_sequence(self, seq_id):
+        if seq_id in self.sequences:
+            self.sequences[seq_id].stop()
+
+    def list_sequences(self):
+        return [seq.status() for seq in list(self.sequences.values())]
+
+    def batch(self, calls, stop_on_error=False):
+        """
+        Execute an ordered list of calls in a single request.  Each call is a list of the form [<COMMAND str>, args, kwargs].
+        Returns a list with the {'status':..., 'data':...} reply of each call.  If stop_on_error, the calls following a failed
+        call are not executed (and are not included in the reply).
+        The time of each call is also recorded in the latency stats under the key of the call (on top of the BATCH itself).
+        """
+        replies = list()
+        for call in calls:
+            cmd, args, kwargs = (list(call) + [[], {}])[:3]
+            if cmd == 'BATCH':
+                reply = {'status':'error', 'data':'BATCH calls can not be nested'}
+            else:
+                req = {'cmd':cmd, 'args':args, 'kwargs':kwargs}
+                reply, phases = self.timed_handle(req, lock=self.request_lock(req))
+                self.stats.record(self.stats_key(req), phases, error=reply['status'] != 'ok')
+            replies.append(reply)
+            if stop_on_error and reply['status'] != 'ok':
+                break
+        return replies
+
 
 
 
 class Instrument_Server_Client():
-    def __init__(self, ip, port, recv_timeout=1000):
+    """
+    Client for the Instrument_Server.
+    The client can be shared between threads: each thread gets its own REQ socket, so the requests from different threads are sent in parallel.
+    When a request times out, the socket of that thread is closed and a new one is connected on the next request.
+    A socket is only closed by the thread which owns it (or once that thread is gone), since ZMQ sockets are not thread-safe.
+    With multipart=True, large ndarrays (in the requests and in the replies) are sent as separate ZMQ frames without being copied
+    into the msgpack blob.  The arrays received this way share their memory with the received ZMQ frames.
+    """
+    def __init__(self, ip, port, recv_timeout=1000, multipart=False):
         self.server_ip = ip
         self.server_port = port
+        self.multipart = multipart
+        self.recv_timeout = recv_timeout
         self.context = ZMQ_CONTEXT
-        self.socket = self.context.socket(zmq.REQ)
-        self.socket.connect("tcp://{}:{}".format(ip,port))
-        self.socket.RCVTIMEO = recv_timeout
-        self.socket.linger = recv_timeout
-    
+        self._local = threading.local()
+        self._sockets = dict()
+        self._sockets_lock = threading.Lock()
+        # Incremented by close, the sockets created before are closed by their thread on its next request
+        self._generation = 0
+        # Round trip times of the requests (compare with get_stats to separate the network overhead from the server time)
+        self.stats = Latency_Stats()
     
+    def make_request(self, cmd, args, kwargs):
+        req = {'cmd':cmd, 'args':args, 'kwargs':kwargs}
+        if self.multipart:
+            req['multipart'] = True
+        return req
+
+    def get_socket(self):
+        """Returns the REQ socket of the current thread (connecting a new one if needed)"""
+        sock = getattr(self._local, 'socket', None)
+        if not sock is None and self._local.generation != self._generation:
+            # The client was closed since this socket was connected
+            self.reset_socket()
+            sock = None
+        if sock is None:
+            sock = self.context.socket(zmq.REQ)
+            sock.connect("tcp://{}:{}".format(self.server_ip, self.server_port))
+            sock.RCVTIMEO = self.recv_timeout
+            sock.linger = self.recv_timeout
+            self._local.socket = sock
+            self._local.generation = self._generation
+            with self._sockets_lock:
+                # Close the sockets of the threads which are gone
+                for thread in [thread for thread in self._sockets if not thread.is_alive()]:
+                    self._sockets.pop(thread).close(linger=0)
+                self._sockets[threading.current_thread()] = sock
+        return sock
+
+    def reset_socket(self):
+        """Close the socket of the current thread (a REQ socket can't be used anymore after a timeout)"""
+        sock = getattr(self._local, 'socket', None)
+        if not sock is None:
+            self._local.socket = None
+            with self._sockets_lock:
+                self._sockets.pop(threading.current_thread(), None)
+            sock.close(linger=0)
+
+    def close(self):
+        """
+        Close the socket of the calling thread and of the threads which are gone.  The sockets of the other threads may be in use,
+        so they are closed by their thread on its next request (or once it is gone).  The client can still be used afterward.
+        """
+        self.reset_socket()
+        with self._sockets_lock:
+            self._generation += 1
+            for thread in [thread for thread in self._sockets if not thread.is_alive()]:
+                self._sockets.pop(thread).close(linger=0)
+
     def send(self, obj):
-        ser = msgpack.packb(obj, use_bin_type=True, default=custom_encode)
-        return self.socket.send(ser)
+        if self.multipart:
+            return self.get_socket().send_multipart(serialize_frames(obj), copy=False)
+        return self.get_socket().send(serialize(obj))
 
     def recv(self):
-        ser = self.socket.recv()
-        return msgpack.unpackb(ser, raw=False, object_hook=custom_decode)
+        return deserialize_frames(self.get_socket().recv_multipart(copy=False))
 
     def send_cmd(self, cmd, *args, **kwargs):
         try:
-            self.send({'cmd':cmd, 'args':args, 'kwargs':kwargs})
+            req = self.make_request(cmd, args, kwargs)
+            t = time.perf_counter()
+            self.send(req)
             reply = self.recv()
+            self.stats.record(Instrument_Server.stats_key(req), {'round_trip':time.perf_counter() - t}, error=reply.get('status') != 'ok')
             if 'status' in reply and 'data' in reply:
                 if reply['status'] == 'ok':
                     return reply['data']
@@ -218,12 +1070,35 @@ class Instrument_Server_Client():
                 raise InstrumentServerError('Invalid reply!')
         except (zmq.error.Again,zmq.error.ZMQError):
             print("Could not reach the server")
-            self.socket.close()
+            self.reset_socket()
             raise ServerUnreachableError("Could not reach the server")
 
     def get_id(self):
         return self.send_cmd('ID')
 
+    def get_stats(self):
+        return self.send_cmd('STATS')
+
+    def reset_stats(self):
+        self.stats.reset()
+        return self.send_cmd('RESET_STATS')
+
+    def get_overhead(self):
+        """
+        Compare the client round trip times with the server side stats.  Returns a list with a dict
+        {'key', 'count', 'round_trip', 'server', 'overhead'} (mean times in s) per key, where the overhead is the time spent outside
+        of the server (network, client serialization, queueing)
+        """
+        server = {tuple(entry['key']):entry for entry in self.get_stats()}
+        ans = list()
+        for entry in self.stats.snapshot():
+            key = tuple(entry['key'])
+            round_trip = entry['phases']['round_trip']['mean']
+            server_time = sum(h['mean'] for h in server[key]['phases'].values()) if key in server else None
+            ans.append({'key':list(key), 'count':entry['count'], 'round_trip':round_trip, 'server':server_time,
+                        'overhead':None if server_time is None else round_trip - server_time})
+        return ans
+
     def get_commands(self):
         return self.send_cmd('COMMAND_LIST')
 
@@ -243,9 +1118,18 @@ class Instrument_Server_Client():
     def list_instr(self):
         return self.send_cmd('LIST_INSTR')
 
+    def load_status(self):
+        return self.send_cmd('LOAD_STATUS')
+
     def get_instr_info(self, dname):
         return self.send_cmd('GET_INSTR_INFO', dname)
 
+    def get_schema(self, dname):
+        return self.send_cmd('GET_SCHEMA', dname)
+
+    def describe(self):
+        return self.send_cmd('DESCRIBE')
+
     def get_feat(self, dname, feat):
         return self.send_cmd('GET_FEAT', dname, feat)
 
@@ -276,67 +1160,826 @@ class Instrument_Server_Client():
     def read(self, dname):
         return self.send_cmd('READ', dname)
 
+    def get_pub_port(self):
+        return self.send_cmd('GET_PUB_PORT')
+
+    def subscribe(self, dname, feat, rate=1, deadband=None, key=None):
+        return self.send_cmd('SUBSCRIBE', dname, feat, rate=rate, deadband=deadband, key=key)
+
+    def unsubscribe(self, sub_id):
+        return self.send_cmd('UNSUBSCRIBE', sub_id)
+
+    def list_subscriptions(self):
+        return self.send_cmd('LIST_SUBSCRIPTIONS')
+
+    def run_sequence(self, steps, block_size=100):
+        """Start a sequence on the server (see Sequence) and return a Remote_Sequence to fetch its results"""
+        return Remote_Sequence(self, self.send_cmd('RUN_SEQUENCE', steps, block_size=block_size), block_size=block_size)
+
+    def fetch_sequence(self, seq_id):
+        return self.send_cmd('FETCH_SEQUENCE', seq_id)
+
+    def stop_sequence(self, seq_id):
+        return self.send_cmd('STOP_SEQUENCE', seq_id)
+
+    def list_sequences(self):
+        return self.send_cmd('LIST_SEQUENCES')
+
+    def monitor(self, callback=None, topics=None):
+        """Returns a Monitor_Subscriber connected to the PUB socket of the server (create it before subscribing to get the first values)"""
+        return Monitor_Subscriber(self.server_ip, self.get_pub_port(), callback=callback, topics=topics)
+
+    def send_batch(self, calls, stop_on_error=False, raise_errors=False):
+        """
+        Send an ordered list of calls ([<COMMAND str>, args, kwargs]) in a single round trip.
+        Returns the list of results, where the failed calls are replaced by an InstrumentServerError (or raised if raise_errors)
+        """
+        calls = [[cmd, list(args), dict(kwargs)] for cmd, args, kwargs in calls]
+        results = list()
+        for reply in self.send_cmd('BATCH', calls, stop_on_error=stop_on_error):
+            if reply['status'] == 'ok':
+                results.append(reply['data'])
+            elif raise_errors:
+                raise InstrumentServerError(reply['data'])
+            else:
+                results.append(InstrumentServerError(reply['data']))
+        return results
+
+    def batch(self, stop_on_error=False, raise_errors=False):
+        """
+        Returns a Batch which records calls and sends them all at once.  Can be used as a context manager:
+            with client.batch() as b:
+                b.set_feat('sg', 'frequency', Q_(1, 'GHz'))
+                f = b.get_feat('sg', 'frequency')
+            b.results[f]
+        """
+        return Batch(self, stop_on_error=stop_on_error, raise_errors=raise_errors)
+
+
+class Monitor_Subscriber():
+    """
+    Receives the values published by the monitors of an Instrument_Server (see Instrument_Server.subscribe).
+    The latest message of each topic is kept in self.latest, and callback(topic, msg) is called (from the receiving thread) for every message.
+    topics is an optional list of topic prefixes to receive (e.g. ['ws7.frequency']), everything is received by default.
+    """
+    def __init__(self, ip, port, callback=None, topics=None):
+        self.callback = callback
+        self.latest = dict()
+        self.socket = ZMQ_CONTEXT.socket(zmq.SUB)
+        self.socket.connect("tcp://{}:{}".format(ip, port))
+        for topic in ([''] if topics is None else topics):
+            self.socket.setsockopt(zmq.SUBSCRIBE, topic.encode())
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def get(self, dname, feat, key=None):
+        """Returns the latest published value (or None)"""
+        msg = self.latest.get(Monitor.get_topic(dname, feat, key))
+        return None if msg is None else msg['value']
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            if not self.socket.poll(100):
+                continue
+            frames = self.socket.recv_multipart(copy=False)
+            try:
+                topic, msg = frames[0].bytes.decode(), deserialize_frames(frames[1:])
+                self.latest[topic] = msg
+                if not self.callback is None:
+                    self.callback(topic, msg)
+            except Exception:
+                traceback.print_exc()
+        self.socket.close()
+
+
+class Remote_Sequence():
+    """
+    Handle on a sequence running on the server.  Iterating over it yields the blocks of rows as they are emitted:
+        for rows in client.run_sequence(steps):
+            ...
+    The server never waits for rows when fetching, so the waiting is done here: the rows are fetched again right away after a
+    full block, otherwise after <poll_interval> s.
+    """
+    def __init__(self, client, seq_id, block_size=100, poll_interval=0.05):
+        self.client = client
+        self.seq_id = seq_id
+        self.block_size = block_size
+        self.poll_interval = poll_interval
+        self.done = False
+
+    def fetch(self):
+        """Returns the new rows (raises an InstrumentServerError if the sequence failed)"""
+        if self.done:
+            return []
+        ans = self.client.fetch_sequence(self.seq_id)
+        self.done = ans['done']
+        if not ans['error'] is None:
+            raise InstrumentServerError(ans['error'])
+        return ans['rows']
+
+    def __iter__(self):
+        while not self.done:
+            rows = self.fetch()
+            if rows:
+                yield rows
+            if not self.done and len(rows) < self.block_size:
+                time.sleep(self.poll_interval)
+
+    def wait(self):
+        """Block until the sequence is done and return all the remaining rows"""
+        rows = list()
+        for block in self:
+            rows += block
+        return rows
+
+    def stop(self):
+        return self.client.stop_sequence(self.seq_id)
+
+
+class Batch():
+    """Ordered list of calls to be executed by the server in a single request (see Instrument_Server_Client.batch)"""
+    def __init__(self, client, stop_on_error=False, raise_errors=False):
+        self.client = client
+        self.stop_on_error = stop_on_error
+        self.raise_errors = raise_errors
+        self.calls = list()
+        self.results = None
+
+    def __len__(self):
+        return len(self.calls)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.execute()
+
+    def add(self, cmd, *args, **kwargs):
+        """Add a call and return its index in the results"""
+        self.calls.append([cmd, args, kwargs])
+        return len(self.calls) - 1
+
+    def get_feat(self, dname, feat):
+        return self.add('GET_FEAT', dname, feat)
+
+    def set_feat(self, dname, feat, val):
+        return self.add('SET_FEAT', dname, feat, val)
+
+    def get_dictfeat(self, dname, feat, key):
+        return self.add('GET_DICTFEAT', dname, feat, key)
+
+    def set_dictfeat(self, dname, feat, key, val):
+        return self.add('SET_DICTFEAT', dname, feat, key, val)
+
+    def run_action(self, dname, action, *args, **kwargs):
+        return self.add('RUN_ACTION', dname, action, *args, **kwargs)
+
+    def read(self, dname):
+        return self.add('READ', dname)
+
+    def execute(self):
+        self.results = self.client.send_batch(self.calls, stop_on_error=self.stop_on_error, raise_errors=self.raise_errors) if self.calls else []
+        self.calls = list()
+        return self.results
+
+
+
+class Reply_Future(concurrent.futures.Future):
+    """Future for a server reply.  It can be waited on with result() or awaited in a coroutine"""
+    def __await__(self):
+        return asyncio.wrap_future(self).__await__()
+
+
+class Async_Instrument_Server_Client(Instrument_Server_Client):
+    """
+    Pipelined client using a DEALER socket.  Any number of requests can be outstanding and replies are matched to the requests
+    using a request id.  The *_async methods return a Reply_Future, so the requests to several devices (or servers) can be
+    overlapped:
+        f1 = client1.get_feat_async('daq', 'ctr0')
+        f2 = client2.run_action_async('fp', 'trace')
+        a, b = f1.result(), f2.result()             # or: a, b = await asyncio.gather(f1, f2)
+    The blocking methods of Instrument_Server_Client are also available.
+    Compatible with both the REP and the concurrent (ROUTER) Instrument_Server.
+    """
+    def __init__(self, ip, port, recv_timeout=1000, multipart=False):
+        super().__init__(ip, port, recv_timeout=recv_timeout, multipart=multipart)
+        self.socket = self.context.socket(zmq.DEALER)
+        self.socket.connect("tcp://{}:{}".format(ip,port))
+        self.socket.linger = recv_timeout
+
+        self._ids = itertools.count()
+        self._outbox = queue.Queue()
+        self._pending = dict()
+        self._closed = False
+        # Socket pair used to wake the io thread when a request is queued (can be polled along with the ZMQ socket)
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._io_thread = threading.Thread(target=self._io_loop, daemon=True)
+        self._io_thread.start()
+
+    def send_cmd_async(self, cmd, *args, **kwargs):
+        fut = Reply_Future()
+        if self._closed:
+            fut.set_exception(ServerUnreachableError("Client is closed"))
+            return fut
+        req_id = next(self._ids).to_bytes(8, 'little')
+        req = self.make_request(cmd, args, kwargs)
+        frames = serialize_frames(req) if self.multipart else [serialize(req)]
+        self._outbox.put((req_id, frames, fut, Instrument_Server.stats_key(req)))
+        self._wake_w.send(b'\x00')
+        return fut
+
+    def send_cmd(self, cmd, *args, **kwargs):
+        return self.send_cmd_async(cmd, *args, **kwargs).result()
+
+    def get_feat_async(self, dname, feat):
+        return self.send_cmd_async('GET_FEAT', dname, feat)
+
+    def set_feat_async(self, dname, feat, val):
+        return self.send_cmd_async('SET_FEAT', dname, feat, val)
+
+    def get_dictfeat_async(self, dname, feat, key):
+        return self.send_cmd_async('GET_DICTFEAT', dname, feat, key)
+
+    def set_dictfeat_async(self, dname, feat, key, val):
+        return self.send_cmd_async('SET_DICTFEAT', dname, feat, key, val)
+
+    def run_action_async(self, dname, action, *args, **kwargs):
+        return self.send_cmd_async('RUN_ACTION', dname, action, *args, **kwargs)
+
+    def read_async(self, dname):
+        return self.send_cmd_async('READ', dname)
+
+    def close(self):
+        """Stop the io thread (the pending requests fail with ServerUnreachableError) and close the sockets"""
+        if self._closed:
+            return
+        self._closed = True
+        self._wake_w.send(b'\x00')
+        self._io_thread.join()
+        self._wake_r.close()
+        self._wake_w.close()
+        super().close()
+
+    def _io_loop(self):
+        poller = zmq.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        poller.register(self._wake_r, zmq.POLLIN)
+        while not self._closed:
+            # Wait until a reply, a new request or the next timeout
+            now = time.time()
+            deadlines = [pending[0] for pending in self._pending.values()]
+            timeout = max(0, 1000*(min(deadlines)-now)) if deadlines else None
+            events = dict(poller.poll(timeout))
+
+            if self._wake_r.fileno() in events:
+                try:
+                    while self._wake_r.recv(4096):
+                        pass
+                except BlockingIOError:
+                    pass
+            while True:
+                try:
+                    req_id, frames, fut, key = self._outbox.get_nowait()
+                except queue.Empty:
+                    break
+                if fut.set_running_or_notify_cancel():
+                    self._pending[req_id] = (time.time() + self.recv_timeout/1000, fut, key, time.perf_counter())
+                    self.socket.send_multipart([req_id, b''] + frames, copy=False)
+
+            while self.socket.poll(0):
+                frames = self.socket.recv_multipart(copy=False)
+                req_id, payload = frames[0].bytes, frames[2:]
+                if not req_id in self._pending:
+                    # Reply to a request which already timed out
+                    continue
+                deadline, fut, key, t = self._pending.pop(req_id)
+                try:
+                    reply = deserialize_frames(payload)
+                    self.stats.record(key, {'round_trip':time.perf_counter() - t}, error=reply.get('status') != 'ok')
+                    if 'status' in reply and 'data' in reply:
+                        if reply['status'] == 'ok':
+                            fut.set_result(reply['data'])
+                        else:
+                            fut.set_exception(InstrumentServerError(reply['data']))
+                    else:
+                        fut.set_exception(InstrumentServerError('Invalid reply!'))
+                except Exception as e:
+                    fut.set_exception(e)
+
+            now = time.time()
+            for req_id in [req_id for req_id, pending in self._pending.items() if pending[0] <= now]:
+                fut = self._pending.pop(req_id)[1]
+                fut.set_exception(ServerUnreachableError("Could not reach the server"))
+
+        for deadline, fut, key, t in self._pending.values():
+            fut.set_exception(ServerUnreachableError("Client is closed"))
+        self._pending.clear()
+        self.socket.close()
+
+
+class Mirror_Watcher():
+    """
+    Watches the change stream of an Instrument_Server[...] mirror database and forwards the changes to the Feat_Cache of the
+    devices of that server.  There is a single thread and change stream per database (see get_mirror_watcher), which stops
+    once the last cache is removed.
+    """
+    def __init__(self, db):
+        self.db = db
+        self.caches = dict() # dname -> set of Feat_Cache
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True, name='Mirror_Watcher[{}]'.format(db.name))
+        self._thread.start()
+
+    def add(self, cache):
+        with self._lock:
+            self.caches.setdefault(cache.dname, set()).add(cache)
+
+    def remove(self, cache):
+        """Remove a cache and returns True if it was the last one (the watcher is then stopped)"""
+        with self._lock:
+            caches = self.caches.get(cache.dname, set())
+            caches.discard(cache)
+            if not caches:
+                self.caches.pop(cache.dname, None)
+            if self.caches:
+                return False
+        self._stop.set()
+        return True
+
+    def wait(self, timeout=None):
+        """Wait for the thread to exit (after the last cache was removed)"""
+        self._thread.join(timeout)
+
+    def get_caches(self, dname=None):
+        with self._lock:
+            if dname is None:
+                return [cache for caches in self.caches.values() for cache in caches]
+            return list(self.caches.get(dname, ()))
+
+    def _run(self):
+        resume_token = None
+        while not self._stop.is_set():
+            try:
+                with self.db.watch(full_document='updateLookup', max_await_time_ms=500, resume_after=resume_token) as stream:
+                    while not self._stop.is_set() and stream.alive:
+                        change = stream.try_next()
+                        if change is None:
+                            continue
+                        resume_token = stream.resume_token
+                        dname = change.get('ns', dict()).get('coll')
+                        if dname is None:
+                            # Database dropped or stream invalidated
+                            for cache in self.get_caches():
+                                cache.invalidate()
+                            resume_token = None
+                            continue
+                        for cache in self.get_caches(dname):
+                            cache.on_change(change.get('fullDocument'), change.get('operationType'))
+            except Exception:
+                traceback.print_exc()
+                # Changes could have been missed
+                for cache in self.get_caches():
+                    cache.invalidate()
+                resume_token = None
+                self._stop.wait(1)
+
+
+# Process-wide registry of Mirror_Watcher, keyed by (MongoClient, database name)
+_MIRROR_WATCHERS = dict()
+_MIRROR_WATCHERS_LOCK = threading.Lock()
+
+def get_mirror_watcher(db):
+    """Returns the Mirror_Watcher of a database (started on the first call)"""
+    key = (id(db.client), db.name)
+    with _MIRROR_WATCHERS_LOCK:
+        if not key in _MIRROR_WATCHERS:
+            _MIRROR_WATCHERS[key] = Mirror_Watcher(db)
+        return _MIRROR_WATCHERS[key]
+
+def release_mirror_watcher(db, cache):
+    """Remove a cache from the Mirror_Watcher of a database (which is stopped when no cache uses it anymore)"""
+    key = (id(db.client), db.name)
+    with _MIRROR_WATCHERS_LOCK:
+        watcher = _MIRROR_WATCHERS.get(key)
+        if watcher is None or not watcher.remove(cache):
+            return
+        _MIRROR_WATCHERS.pop(key)
+    # Wait for the change stream to be closed, so the MongoClient can be closed afterward
+    watcher.wait(1)
+
+
+class Feat_Cache():
+    """
+    Client side cache of the feat values of a Remote_Device.  Caching is opt-in per feat (see Remote_Device.cache_feat):
+        - Values are kept for <ttl> seconds, or forever if ttl is None (the default for the read_once feats), in which case
+          the value is assumed to never change
+        - Sets are written through (and optionally skipped when the value didn't change)
+        - If the Instrument_Server[...] mirror collection of the device is given, the cached values with a ttl which were changed
+          by other clients are invalidated (the mirror database is watched by a Mirror_Watcher shared by all the devices of the server).
+          All the values, including the read_once ones, are invalidated when the device is removed from or added back to the server.
+    """
+    def __init__(self, dname, units=None, mongo_col=None):
+        self.dname = dname
+        self.units = dict() if units is None else units
+        self.mongo_col = mongo_col
+        self.ttl = dict()
+        self.skip_unchanged = set()
+        self.values = dict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._watched = False
+
+    def enable(self, feat, ttl=None, skip_unchanged=False):
+        with self._lock:
+            self.ttl[feat] = ttl
+            if skip_unchanged:
+                self.skip_unchanged.add(feat)
+            else:
+                self.skip_unchanged.discard(feat)
+            watch = not self.mongo_col is None and not self._watched
+            self._watched = self._watched or watch
+        if watch:
+            get_mirror_watcher(self.mongo_col.database).add(self)
+
+    def disable(self, feat):
+        with self._lock:
+            self.ttl.pop(feat, None)
+            self.skip_unchanged.discard(feat)
+            self.values.pop(feat, None)
+
+    def is_cached(self, feat):
+        return feat in self.ttl
+
+    def get(self, feat):
+        """Returns (True, value) on a hit, (False, None) otherwise"""
+        with self._lock:
+            if feat in self.values:
+                val, t = self.values[feat]
+                ttl = self.ttl.get(feat)
+                if ttl is None or time.time() - t < ttl:
+                    self.hits += 1
+                    return True, val
+                self.values.pop(feat)
+            self.misses += 1
+            return False, None
+
+    def put(self, feat, val):
+        with self._lock:
+            if feat in self.ttl:
+                self.values[feat] = (val, time.time())
+
+    def is_unchanged(self, feat, val):
+        """True if the set of <feat> to <val> can be skipped"""
+        if not feat in self.skip_unchanged:
+            return False
+        hit, cached = self.get(feat)
+        try:
+            return hit and bool(np.all(cached == val))
+        except Exception:
+            return False
+
+    def invalidate(self, feat=None):
+        with self._lock:
+            if feat is None:
+                self.values.clear()
+            else:
+                self.values.pop(feat, None)
+
+    def on_change(self, doc, operation=None):
+        """Called by the Mirror_Watcher with the full document of a changed feat (None if it was deleted) and the operation type"""
+        if doc is None or not 'name' in doc:
+            # Deleted or dropped (the device was removed), we can't know which feats changed
+            self.invalidate()
+        elif operation == 'insert':
+            # The device was (re)published, even the read_once values could have changed
+            self.invalidate(doc['name'])
+        elif not self.ttl.get(doc['name']) is None:
+            self.on_mirror_change(doc['name'], doc.get('value'))
+
+    def on_mirror_change(self, feat, value):
+        # The mirror holds the magnitude in base units. Keep the cached value if it is the same (for example the mirror of our own set).
+        with self._lock:
+            if not feat in self.values:
+                return
+            cached = self.values[feat][0]
+        try:
+            if isinstance(cached, Q_):
+                cached = cached.to(self.units[feat]).m if not self.units.get(feat) is None else cached.m
+            if bool(np.all(cached == value)):
+                return
+        except Exception:
+            pass
+        self.invalidate(feat)
+
+    def stop(self):
+        with self._lock:
+            watched, self._watched = self._watched, False
+        if watched:
+            release_mirror_watcher(self.mongo_col.database, self)
+
+
+class Remote_DictFeat():
+    """Accessor for a dictfeat of a Remote_Device (dev.<feat>[key])"""
+    def __init__(self, dev, feat):
+        self.dev, self.feat = dev, feat
+
+    def __getitem__(self, key):
+        return self.dev.client.get_dictfeat(self.dev.dname, self.feat, key)
+
+    def __setitem__(self, key, val):
+        return self.dev.client.set_dictfeat(self.dev.dname, self.feat, key, val)
+
+
+class Remote_DictFeat_Descriptor():
+    def __init__(self, feat):
+        self.feat = feat
+
+    def __get__(self, dev, owner=None):
+        if dev is None:
+            return self
+        return Remote_DictFeat(dev, self.feat)
+
+
+class Remote_Feat():
+    """Descriptor for a feat of a Remote_Device (going through the feat cache of the device)"""
+    def __init__(self, feat):
+        self.feat = feat
+
+    def __get__(self, dev, owner=None):
+        if dev is None:
+            return self
+        feat = self.feat
+        if dev._cache.is_cached(feat):
+            hit, val = dev._cache.get(feat)
+            if hit:
+                return val
+            val = dev.client.get_feat(dev.dname, feat)
+            dev._cache.put(feat, val)
+            return val
+        return dev.client.get_feat(dev.dname, feat)
+
+    def __set__(self, dev, val):
+        feat = self.feat
+        if dev._cache.is_cached(feat):
+            if dev._cache.is_unchanged(feat, val):
+                return
+            dev._cache.invalidate(feat)
+            dev.client.set_feat(dev.dname, feat, val)
+            dev._cache.put(feat, val)
+            return
+        dev.client.set_feat(dev.dname, feat, val)
+
+
+def remote_action(action):
+    def f_(self, *args, **kwargs):
+        return self.client.run_action(self.dname, action, *args, **kwargs)
+    f_.__name__ = action
+    return f_
+
+def remote_action_async(action):
+    def f_(self, *args, **kwargs):
+        return self.client.run_action_async(self.dname, action, *args, **kwargs)
+    f_.__name__ = action + '_async'
+    return f_
 
 
 class Remote_Device():
-    pass
+    """
+    Base class of the device proxies built by load_remote_device.  The proxy classes are generated from the schema published by
+    the server (see build_schema) and shared by all the devices of the same driver class.
+    """
+    # Set on the generated classes
+    schema = None
+    mro_names = frozenset()
+
+    def __init__(self, client, dname, info, mongo_col=None):
+        self.client, self.dname, self.info = client, dname, info
+        units = {name:feat['units'] for name, feat in self.schema['feats'].items()}
+        self._cache = Feat_Cache(dname, units=units, mongo_col=mongo_col)
+
+    @classmethod
+    def driver_isinstance(cls, dclass):
+        """Equivalent of issubclass(<driver class>, dclass) without importing the driver (dclass can be a class or a 'module.Class' str)"""
+        if not isinstance(dclass, str):
+            dclass = '{}.{}'.format(dclass.__module__, dclass.__name__)
+        return dclass in cls.mro_names
+
+    def __repr__(self):
+        return '<Remote {} {}>'.format(self.schema['class'], self.dname)
+
+    def cache_feat(self, feat, ttl=None, skip_unchanged=False):
+        """
+        Cache the value of a feat on the client for <ttl> seconds with write-through on set.  With ttl=None the value is cached
+        until the device is removed or added back to the server, so it should only be used for feats which don't change (it isn't
+        invalidated by the changes of other clients).
+        With skip_unchanged, setting the feat to its cached value doesn't send anything to the server.
+        """
+        self._cache.enable(feat, ttl=ttl, skip_unchanged=skip_unchanged)
 
+    def uncache_feat(self, feat):
+        self._cache.disable(feat)
 
-def load_remote_device(instr_server_client, dname):
+    def invalidate_cache(self, feat=None):
+        self._cache.invalidate(feat)
 
-    info = instr_server_client.get_instr_info(dname)
 
-    driver_class = get_class_from_str(info['class'])
+class Async_Remote_Device(Remote_Device):
+    """
+    Remote_Device built from an Async_Instrument_Server_Client.  On top of the usual (blocking) feats and actions, it has
+    *_async methods returning awaitable Reply_Future (each action <name> also gets a <name>_async method).
+    """
+    def get_feat_async(self, feat):
+        return self.client.get_feat_async(self.dname, feat)
 
-    class Remote_Device_Instance(Remote_Device):
-        def __init__(self):
-            self.client, self.dname, self.info = instr_server_client, dname, info 
+    def set_feat_async(self, feat, val):
+        return self.client.set_feat_async(self.dname, feat, val)
 
-    for feat_name, feat in driver_class._lantz_features.items():
-        if isinstance(feat, DictFeat):
-            def get_remote_dictfeat(_feat_name):
-                class Remote_DictFeat():
-                    # This is not ideal, but it will do for now
-                    # Ideally I would have a _self reference here instead of the more static instr_server_client and dname
-                    def __getitem__(self, key):
-                        return instr_server_client.get_dictfeat(dname, _feat_name, key)
-                    def __setitem__(self, key, val):
-                        return instr_server_client.set_dictfeat(dname, _feat_name, key, val)
-                return Remote_DictFeat
-            setattr(Remote_Device_Instance, feat_name, get_remote_dictfeat(feat_name)())
-        elif isinstance(feat, Feat):
-            def get_fun(_feat_name):
-                def f_(_self):
-                    return _self.client.get_feat(_self.dname, _feat_name)
-                return f_
+    def get_dictfeat_async(self, feat, key):
+        return self.client.get_dictfeat_async(self.dname, feat, key)
 
-            def set_fun(_feat_name):
-                def f_(_self, val):
-                    return _self.client.set_feat(_self.dname, _feat_name, val)
-                return f_ 
+    def set_dictfeat_async(self, feat, key, val):
+        return self.client.set_dictfeat_async(self.dname, feat, key, val)
 
-            setattr(Remote_Device_Instance, feat_name, property(get_fun(feat_name), set_fun(feat_name)))
+    def run_action_async(self, action, *args, **kwargs):
+        return self.client.run_action_async(self.dname, action, *args, **kwargs)
 
-    for action_name, action in driver_class._lantz_actions.items():
-        def execute(_action_name):
-            def f_(_self, *args, **kwargs):
-                return _self.client.run_action(_self.dname, _action_name, *args, **kwargs)
-            return f_
-        setattr(Remote_Device_Instance, action_name, execute(action_name))
 
-    return Remote_Device_Instance()
+def load_remote_device(instr_server_client, dname, mongo_col=None, cache=None, info=None, schema=None):
+    """
+    Build a proxy for a device of an instrument server, from the schema published by the server (the driver is not imported).
+    info and schema can be given if they are already known (see GET_SCHEMA), otherwise they are requested from the server.
+    cache is an optional dict feat -> ttl of feats to cache on the client (see Remote_Device.cache_feat), the read_once feats are always cached.
+    mongo_col is the Instrument_Server[...] mirror collection of the device, used to invalidate the cached feats with a ttl when other
+    clients change them.
+    """
+
+    if schema is None:
+        try:
+            ans = instr_server_client.get_schema(dname)
+            info, schema = ans['info'], ans['schema']
+        except InstrumentServerError:
+            # Older server without GET_SCHEMA, build the schema from the driver class
+            info = instr_server_client.get_instr_info(dname)
+            schema = build_schema(get_class_from_str(info['class']))
+
+    is_async = isinstance(instr_server_client, Async_Instrument_Server_Client)
+    dev = get_proxy_class(schema, is_async=is_async)(instr_server_client, dname, info, mongo_col=mongo_col)
+    for feat_name, feat in schema['feats'].items():
+        if feat['read_once'] and feat['type'] == 'feat':
+            dev.cache_feat(feat_name, ttl=None)
+    for feat_name, ttl in (dict() if cache is None else cache).items():
+        dev.cache_feat(feat_name, ttl=ttl)
+    return dev
+
+
+_PROXY_CLASSES = dict()
+_PROXY_CLASSES_LOCK = threading.Lock()
+
+def get_proxy_class(schema, is_async=False):
+    """Returns the (cached) Remote_Device subclass for a schema"""
+    key = (schema['class'], is_async, serialize([schema['mro'], schema['feats'], schema['actions']]))
+    with _PROXY_CLASSES_LOCK:
+        if key in _PROXY_CLASSES:
+            return _PROXY_CLASSES[key]
+        attrs = {'schema':schema, 'mro_names':frozenset(schema['mro'])}
+        for feat_name, feat in schema['feats'].items():
+            attrs[feat_name] = Remote_DictFeat_Descriptor(feat_name) if feat['type'] == 'dictfeat' else Remote_Feat(feat_name)
+        for action_name in schema['actions']:
+            attrs[action_name] = remote_action(action_name)
+            if is_async:
+                attrs[action_name+'_async'] = remote_action_async(action_name)
+        name = 'Remote_' + schema['class'].split('.')[-1]
+        cls = type(name, (Async_Remote_Device if is_async else Remote_Device,), attrs)
+        _PROXY_CLASSES[key] = cls
+        return cls
+
+
+
+class Mirror_Writer():
+    """
+    Write-behind mirror of the feat values in the Instrument_Server database.
+
+    Updates are kept in a pending dict keyed by (device, feat) where repeated updates to the same value are coalesced (last value wins).
+    A daemon thread writes them with one bulk_write per device at most <max_lag> seconds after the oldest pending update,
+    so the request path never waits for MongoDB.  Write errors are printed and the last one is raised by the next flush.
+    """
+    def __init__(self, db, max_lag=0.1):
+        self.db = db
+        self.max_lag = max_lag
+        self.pending = OrderedDict()
+        self.last_error = None
+        self.n_updates = 0
+        self.n_writes = 0
+        self._oldest = None
+        self._writing = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def set(self, dname, name, field, val):
+        """Set <field> ('value' or 'value.<index>') of the <name> document in the <dname> collection"""
+        with self._cond:
+            fields = self.pending.setdefault((dname, name), dict())
+            if field == 'value':
+                fields.clear()
+            elif 'value' in fields and isinstance(fields['value'], list):
+                # A full value is already pending, so update it instead of adding a conflicting path
+                fields['value'] = list(fields['value'])
+                fields['value'][int(field.split('.')[1])] = val
+                field, val = None, None
+            if not field is None:
+                fields[field] = val
+            self.n_updates += 1
+            if self._oldest is None:
+                self._oldest = time.time()
+                self._cond.notify_all()
+
+    def discard(self, dname):
+        """
+        Drop the pending updates of a device and wait for the write in progress (if any), so no update of the device can be written
+        after this returns.  Must be called before its collection is dropped, otherwise stale documents could be upserted back.
+        """
+        with self._cond:
+            for key in [key for key in self.pending if key[0] == dname]:
+                self.pending.pop(key)
+            if not self.pending:
+                self._oldest = None
+            while self._writing:
+                self._cond.wait()
+
+    @property
+    def lag(self):
+        """Age (in s) of the oldest update not yet written to the database"""
+        oldest = self._oldest
+        return 0 if oldest is None else time.time() - oldest
+
+    def flush(self):
+        """Block until every pending update has been written (raises the last write error, if there was one since the last flush)"""
+        with self._cond:
+            self._cond.notify_all()
+            while self.pending or self._writing:
+                self._cond.wait()
+            err, self.last_error = self.last_error, None
+        if not err is None:
+            raise err
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self.pending:
+                    self._cond.wait()
+                remaining = self._oldest + self.max_lag - time.time()
+                if remaining > 0:
+                    self._cond.wait(remaining)
+                pending, self.pending = self.pending, OrderedDict()
+                self._oldest = None
+                self._writing = True
+            try:
+                requests = dict()
+                for (dname, name), fields in pending.items():
+                    if fields:
+                        requests.setdefault(dname, list()).append(UpdateOne({'name':name}, {'$set':fields}, upsert=True))
+                for dname, reqs in requests.items():
+                    try:
+                        self.db[dname].bulk_write(reqs, ordered=False)
+                        self.n_writes += 1
+                    except Exception as e:
+                        print('Could not write the mirror of device "{}"'.format(dname))
+                        traceback.print_exc()
+                        self.last_error = e
+            finally:
+                with self._cond:
+                    self._writing = False
+                    self._cond.notify_all()
 
 
 class MongoDB_Instrument_Server(Instrument_Server):
-    def __init__(self, server_name, port, mongodb_addr=None):
-        super().__init__(server_name=server_name, port=port)
+    """
+        Instrument server which mirrors the feat values in a MongoDB database (used by the Instrument_Manager_Widget)
+
+        The mirror is written in the background by a Mirror_Writer, so the values in the database lag the devices by at most
+        mirror_lag seconds.  Use mirror_lag=0 to update the database synchronously before replying.
+    """
+    def __init__(self, server_name, port, mongodb_addr=None, mirror_lag=0.1, **kwargs):
+        super().__init__(server_name=server_name, port=port, **kwargs)
         self.db_name = 'Instrument_Server[{}]'.format(self.name)
         self.client = get_mongo_client(mongodb_addr)
         self.db = self.client[self.db_name]
         self.client.drop_database(self.db_name)
+        self.mirror_writer = Mirror_Writer(self.db, max_lag=mirror_lag) if mirror_lag else None
 
         self.COMMANDS.update({
             'GET_NONE_FEAT':self.get_none_feat,
+            'GET_MIRROR_LAG':self.get_mirror_lag,
         })
 
     # def connect_to_master(self):
@@ -349,71 +1992,58 @@ class MongoDB_Instrument_Server(Instrument_Server):
     #             return client
     #     raise Exception('Could not find Mongo Master!')
 
-    def serve_forever(self):
-        while True:
-            try:
-                req = self.recv()
-                reply = self.answer_request(req)
-                self.send({'status':'ok', 'data':reply})
-            except Exception as e:
-                if self.DEBUG:
-                    traceback.print_exc()
-                error_str = traceback.format_exc()
-                self.send({'status':'error', 'data':error_str})
-
     def get_mongodb(self):
         addr = 'mongodb://{}:{}/'.format(*self.client.primary)
         return {'db_name':self.db_name, 'server_addr':addr}
 
+    def mirror(self, dname, name, field, val):
+        t = time.perf_counter()
+        if self.mirror_writer is None:
+            self.db[dname].update_one({'name':name},{'$set':{field:val}}, upsert=True)
+        else:
+            self.mirror_writer.set(dname, name, field, val)
+        self.stats.add_time('mirror', time.perf_counter() - t)
+
+    def get_mirror_lag(self):
+        return 0 if self.mirror_writer is None else self.mirror_writer.lag
+
     def get_id(self):
         hostname = socket.gethostname()    
         IPAddr = socket.gethostbyname(hostname) 
         return "{}\n\tMongoDB instrument server v{}\n\tIP: {} ({})\n\tPort: {}\n\tDatabase name: {}".format(self.name, VERSION, IPAddr, hostname, self.port, self.db_name)      
 
-    def add_instr(self, dname, dclass, *args, **kwargs):
-        ans = super().add_instr(dname, dclass, *args, **kwargs)
+    def publish_instr(self, dname, dev, info, dispatch=None):
+        # The documents are written before the device is published so the clients never see a device without its feats
+        dispatch = Device_Dispatch(dev) if dispatch is None else dispatch
+        if not self.mirror_writer is None:
+            self.mirror_writer.discard(dname)
         self.db[dname].drop()
 
-        c = get_class_from_str(dclass)
-
         doc_list = list()
-        for feat_name, feat in c._lantz_features.items():
-            params = feat.modifiers[MISSING][MISSING]
-            values = list(params['values']) if not params['values'] is None else None
-            if 'keys' in params and not params['keys'] is None:
-                keys = list(params['keys'])
-                keys.sort()
-            else:
-                keys = None
-            limits = params['limits']
-            if not limits is None:
-                if len(limits) == 1:
-                    limits = [0, limits[0]]
-                elif len(limits) == 3:
-                    limits = [limits[0], limits[1]]
-                    # step = limits[2] #Not used right now
-
+        for feat_name, feat in dispatch.schema['feats'].items():
+            keys = feat['keys']
             doc_list.append({
                                 'name':feat_name,
-                                'type': 'dictfeat' if isinstance(feat, DictFeat) else 'feat',
-                                'readonly': dict(self.instr[dname].feats.items())[feat_name].feat.fset is None,
-                                'units': params['units'],
-                                'limits': limits,
-                                'values': values,
+                                'type': feat['type'],
+                                'readonly': feat['readonly'],
+                                'units': feat['units'],
+                                'limits': feat['limits'],
+                                'values': feat['values'],
                                 'keys': keys,
-                                'value': [None]*len(params['keys']) if isinstance(feat, DictFeat) \
-                                    and params['keys'] is not None else None,
+                                'value': [None]*len(keys) if not keys is None else None,
                             })
-        for action_name, action in c._lantz_actions.items():
+        for action_name in dispatch.actions:
             doc_list.append({
                                 'name':action_name,
                                 'type': 'action',
                             })
 
         self.db[dname].insert_many(doc_list)
-        return ans
+        super().publish_instr(dname, dev, info, dispatch=dispatch)
 
     def get_none_feat(self, dname):
+        if not self.mirror_writer is None:
+            self.mirror_writer.flush()
         feats = self.db[dname].find({},{'_id':False, 'name':True, 'value':True, 'type':True, 'keys':True})
         for feat in feats:
                 if feat['type'] == 'feat' and feat['value'] is None:
@@ -432,37 +2062,32 @@ class MongoDB_Instrument_Server(Instrument_Server):
 
     def del_instr(self, dname):
         ans = super().del_instr(dname)
+        if not self.mirror_writer is None:
+            self.mirror_writer.discard(dname)
         self.db[dname].drop()
         return ans
 
     def get_feat(self, dname, feat):
         ans = super().get_feat(dname, feat)
         val = ans.m if isinstance(ans, Q_) else ans
-        self.db[dname].update_one({'name':feat},{'$set':{'value':val}}, upsert=True)
+        self.mirror(dname, feat, 'value', val)
         return ans
 
     def set_feat(self, dname, feat, val):
         ans = super().set_feat(dname, feat, val)
-        base_units = self.instr[dname]._lantz_features[feat].modifiers[MISSING][MISSING]['units']
-        val = val.to(base_units).m if isinstance(val, Q_) else val
-        self.db[dname].update_one({'name':feat},{'$set':{'value':val}}, upsert=True)
+        self.mirror(dname, feat, 'value', self.dispatch[dname].feats[feat].to_base(val))
         return ans
 
     def get_dictfeat(self, dname, feat, key):
         ans = super().get_dictfeat(dname, feat, key)
         val = ans.m if isinstance(ans, Q_) else ans
-        keys = list(self.instr[dname]._lantz_features[feat].modifiers[MISSING][MISSING]['keys'])
-        keys.sort()
-        self.db[dname].update_one({'name':feat},{'$set':{'value.{}'.format(keys.index(key)):val}}, upsert=True)
+        self.mirror(dname, feat, 'value.{}'.format(self.dispatch[dname].feats[feat].key_index[key]), val)
         return ans
 
     def set_dictfeat(self, dname, feat, key, val):
         ans = super().set_dictfeat(dname, feat, key, val)
-        base_units = self.instr[dname]._lantz_features[feat].modifiers[MISSING][MISSING]['units']
-        val = val.to(base_units).m if isinstance(val, Q_) else val
-        keys = list(self.instr[dname]._lantz_features[feat].modifiers[MISSING][MISSING]['keys'])
-        keys.sort()
-        self.db[dname].update_one({'name':feat},{'$set':{'value.{}'.format(keys.index(key)):val}}, upsert=True)
+        entry = self.dispatch[dname].feats[feat]
+        self.mirror(dname, feat, 'value.{}'.format(entry.key_index[key]), entry.to_base(val))
         return ans
 
 
@@ -474,14 +2099,13 @@ if __name__ == '__main__':
     cfg = get_configs(filename = filename)
     server = MongoDB_Instrument_Server(**cfg['instrument_server'], mongodb_addr=cfg['mongodb_addr'])
     
-    # Add the different instruments
-    for dname, dev in cfg['device_list'].items():
-        try:
-            t = time.time()
-            server.add_instr(dname, dev[0], *dev[1], **dev[2])
-            print('Loaded {} in {:2f}s'.format(dname, time.time()-t))
-        except:
-            print('Could not load {}'.format(dname))
-            traceback.print_exc()
+    # Add the different instruments (in the background, the server answers for the ready devices in the meantime)
+    t = time.time()
+    futures = server.load_devices(cfg['device_list'], max_workers=cfg.get('device_load_workers', 8))
+    def report():
+        concurrent.futures.wait(list(futures.values()))
+        server.print_load_report()
+        print('All devices loaded in {:2f}s'.format(time.time()-t))
+    threading.Thread(target=report, daemon=True).start()
     print("Server ready...")
     server.serve_forever()
\ No newline at end of file
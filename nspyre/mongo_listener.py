@@ -3,8 +3,11 @@ from PyQt5 import QtCore
 import pandas as pd
 
 import time
+import threading
 from bson.objectid import ObjectId
-from nspyre.utils import get_mongo_client
+from nspyre.utils import get_mongo_client, decode_row, decode_ndarray, is_encoded_ndarray
+from nspyre.columnar import Keyed_Columnar_Buffer
+from collections.abc import Mapping
 import traceback
 
 class DropEvent():
@@ -13,68 +16,133 @@ class DropEvent():
         self.db, self.col = db, col
 
 
-def modify_df(df, change):
-    # print(change)
+class Row_Record(dict):
+    """
+    Lightweight representation of a row emitted after a change (instead of building a pd.Series for every event).
+    The fields are accessed as a dict and the name attribute holds the _id of the document (like the name of a row Series).
+    """
+    def __init__(self, name, fields):
+        super().__init__(fields)
+        self.name = name
+
+
+def apply_change(buf, change):
+    """
+    Apply a change stream event to a Keyed_Columnar_Buffer (in place).
+    Returns either (buf, row) where row is a Row_Record of the modified row (or None if the row was deleted)
+    or (DropEvent, None) if the collection was dropped.
+    """
     if change['operationType'] == 'drop':
         return DropEvent(change['ns']['db'], change['ns']['coll']), None
     key  = change['documentKey']['_id']
     if change['operationType'] == 'update':
         for k, val in change['updateDescription']['updatedFields'].items():
+            if is_encoded_ndarray(val):
+                val = decode_ndarray(val)
             ks = k.split('.')
             if len(ks) == 1:
-                df.loc[key, k] = val
+                buf.set_value(key, k, val)
             elif len(ks) == 2:
-                # TODO: Figure out a more reliable way of doing this
-                
+                # This modifies the list (or dict) stored in the column in place
                 if ks[1].isdigit():
                     # Assume an array here... Will see if we can get away with this
-                    df.loc[key,ks[0]][int(ks[1])] = val
+                    buf.get_value(key, ks[0])[int(ks[1])] = val
                 else:
-                    df.loc[key,ks[0]][ks[1]] = val
-                    
+                    buf.get_value(key, ks[0])[ks[1]] = val
+                buf.invalidate()
             else:
                 raise NotImplementedError('Cannot use a dept of more then 2 in the documents')
-    elif change['operationType'] == 'insert':
-        doc = change['fullDocument']
-        _id = doc.pop('_id')
-        s = pd.Series(doc, name=_id)
-        df = df.append(s)
-
+    elif change['operationType'] in ['insert', 'replace']:
+        buf.append(decode_row(change['fullDocument']))
+    elif change['operationType'] == 'delete':
+        buf.delete(key)
+        return buf, None
     else:
         raise NotImplementedError('Cannot modify df with operationType: {}'.format(change['operationType']))
-    return df, df.loc[key]
+    return buf, Row_Record(key, buf.row(key))
+
+
+def load_buffer(col):
+    """Load the whole content of a collection in a Keyed_Columnar_Buffer"""
+    buf = Keyed_Columnar_Buffer()
+    for doc in col.find():
+        buf.append(decode_row(doc))
+    return buf
 
 
 class Mongo_Listenner(QtCore.QThread):
-    """Qt Thread which monitors for changes to qither a collection or a database and emits a signal when something happens"""
+    """
+    Qt Thread which monitors for changes to qither a collection or a database and emits a signal when something happens
+
+    The change stream blocks server-side for up to max_await_time_ms waiting for changes, so an idle listener does not use any CPU.
+    The resume token of the last event is kept so the stream can be reopened where it left off after an invalidate event or a network error.
+    If the stream can't be resumed (for example if the oplog rolled over) it is restarted from now and the resynced signal is emitted,
+    so the owner knows it may have missed changes.
+    """
     updated = QtCore.pyqtSignal(object)
-    def __init__(self, db_name, col_name=None, mongodb_addr=None):
+    resynced = QtCore.pyqtSignal()
+    def __init__(self, db_name, col_name=None, mongodb_addr=None, max_await_time_ms=500, retry_delay=1):
         super().__init__()
         self.db_name = db_name
         self.col_name = col_name
         self.mongodb_addr = mongodb_addr
+        self.max_await_time_ms = max_await_time_ms
+        self.retry_delay = retry_delay
+        self.resume_token = None
         self.exit_flag = False
+        self._wakeup = threading.Event()
+
+    def stop(self, wait=True):
+        """Ask the listener to exit.  It will stop within max_await_time_ms"""
+        self.exit_flag = True
+        self._wakeup.set()
+        if wait:
+            self.wait()
 
     def run(self):
         self.exit_flag = False
+        self._wakeup.clear()
         # Connect
         client = get_mongo_client(self.mongodb_addr)
         mongo_obj = client[self.db_name]
         if not self.col_name is None:
             mongo_obj = mongo_obj[self.col_name]
 
-        with mongo_obj.watch() as stream:
-            while stream.alive:
-                doc = stream.try_next()
-                if doc is not None:
-                    self.updated.emit(doc)
+        while not self.exit_flag:
+            kwargs = {'max_await_time_ms':self.max_await_time_ms}
+            if not self.resume_token is None:
+                # start_after (unlike resume_after) also works with the token of an invalidate event
+                kwargs['start_after'] = self.resume_token
+            try:
+                with mongo_obj.watch(**kwargs) as stream:
+                    while stream.alive and not self.exit_flag:
+                        doc = stream.try_next()
+                        if doc is not None:
+                            self.resume_token = stream.resume_token
+                            self.updated.emit(doc)
+            except pymongo.errors.OperationFailure:
                 if self.exit_flag:
                     return
-        if not self.exit_flag:
-            self.run() #This takes care of the invalidate event which stops the change_stream cursor
+                traceback.print_exc()
+                if not self.resume_token is None:
+                    # The stream could not be resumed from the token, so start again from now
+                    print('Could not resume the change stream on {}, restarting it'.format(mongo_obj.name))
+                    self.resume_token = None
+                    self.resynced.emit()
+                else:
+                    self._wakeup.wait(self.retry_delay)
+            except pymongo.errors.PyMongoError:
+                if self.exit_flag:
+                    return
+                traceback.print_exc()
+                self._wakeup.wait(self.retry_delay)
 
 class Synched_Mongo_Collection(QtCore.QObject):
-    updated_row = QtCore.pyqtSignal(object) # Emit the updated row
+    """
+    Local copy of a MongoDB collection which is kept in sync through a change stream.
+    The data is stored in a Keyed_Columnar_Buffer, so inserts are appended in place (amortized O(1)) and the DataFrame is only built when requested.
+    """
+    updated_row = QtCore.pyqtSignal(object) # Emit the updated row (as a Row_Record)
     # mutex = QtCore.QMutex()
     def __init__(self, db_name, col_name, mongodb_addr=None):
         super().__init__()
@@ -85,14 +153,16 @@ class Synched_Mongo_Collection(QtCore.QObject):
 
         self.watcher.start()
         self.watcher.updated.connect(self._update_df)
+        self.watcher.resynced.connect(self.refresh_all)
     
     def refresh_all(self):
-        col = list(self.col.find())
-        if col == []:
-            self.df = None
-        else:
-            self.df = pd.DataFrame(col)
-            self.df.set_index('_id', inplace=True)
+        self.buffer = load_buffer(self.col)
+
+    @property
+    def df(self):
+        if len(self.buffer) == 0:
+            return None
+        return self.buffer.to_dataframe()
 
     def get_df(self):
         # self.mutex.lock()
@@ -100,12 +170,15 @@ class Synched_Mongo_Collection(QtCore.QObject):
 
     @QtCore.pyqtSlot(object)
     def _update_df(self, change):
-        if self.db is None:
-            self.refresh_all()
         # print(change)
         try:
-            self.df, row = modify_df(self.df, change)
-            self.updated_row.emit(row)
+            if change['operationType'] == 'invalidate':
+                return
+            buf, row = apply_change(self.buffer, change)
+            if isinstance(buf, DropEvent):
+                self.buffer = Keyed_Columnar_Buffer()
+            elif not row is None:
+                self.updated_row.emit(row)
         except:
             traceback.print_exc()
             print('Refreshing the entire collection')
@@ -113,10 +186,37 @@ class Synched_Mongo_Collection(QtCore.QObject):
         
         # self.refresh_all() #I will make this a little more efficient later on
 
+    def stop(self, wait=True):
+        """Stop listening to the changes (must be done before closing the MongoClient)"""
+        self.watcher.stop(wait=wait)
+
     def __del__(self):
-        self.watcher.exit_flag = True
+        self.watcher.stop(wait=False)
+
+
+class DataFrame_Dict(Mapping):
+    """Read-only dict-like view of a dict of Keyed_Columnar_Buffer which returns the DataFrames (built lazily)"""
+    def __init__(self, buffers):
+        self._buffers = buffers
+
+    def __getitem__(self, col_name):
+        return self._buffers[col_name].to_dataframe()
+
+    def __contains__(self, col_name):
+        return col_name in self._buffers
+
+    def __iter__(self):
+        return iter(self._buffers)
+
+    def __len__(self):
+        return len(self._buffers)
+
 
 class Synched_Mongo_Database(QtCore.QObject):
+    """
+    Local copy of all the collections of a MongoDB database which is kept in sync through a change stream.
+    Each collection is stored in a Keyed_Columnar_Buffer (see Synched_Mongo_Collection).
+    """
     updated_row = QtCore.pyqtSignal(object, object) # Emit the updated row in the format (col_name, row)
     col_added = QtCore.pyqtSignal(object) # Emit the name of the collection which was added
     col_dropped = QtCore.pyqtSignal(object) # Emit the name of the collection which was dropped
@@ -131,52 +231,51 @@ class Synched_Mongo_Database(QtCore.QObject):
 
         self.watcher.start()
         self.watcher.updated.connect(self._update)
+        self.watcher.resynced.connect(self.refresh_all)
     
     def refresh_all(self):
-        self.dfs = dict()
+        self.buffers = dict()
         for col in self.db.list_collection_names():
-            col_data = list(self.db[col].find())
-            if not col_data == []:
-                self.dfs[col] = pd.DataFrame(col_data)
-                self.dfs[col].set_index('_id', inplace=True)
+            buf = load_buffer(self.db[col])
+            if len(buf):
+                self.buffers[col] = buf
 
-    def get_df(self, col_name, timeout=0.1):
-        try:
-            if not self.dfs[col_name] is None:
-                return self.dfs[col_name]
-        finally:
-            t = time.time()
-            while time.time()-t<timeout:
-                if col_name in self.dfs:
-                    return self.dfs[col_name]
+    @property
+    def dfs(self):
+        return DataFrame_Dict(self.buffers)
 
+    def get_df(self, col_name, timeout=0.1):
+        t = time.time()
+        while True:
+            if col_name in self.buffers:
+                return self.buffers[col_name].to_dataframe()
+            if time.time()-t >= timeout:
+                return None
+            time.sleep(0.001)
 
     @QtCore.pyqtSlot(object)
     def _update(self, change):
         # print(change)
         try:
             if change['operationType'] == 'dropDatabase':
-                self.dfs = dict()
+                self.buffers = dict()
                 self.db_dropped.emit()
                 return
             elif change['operationType'] == 'invalidate':
                 return
             col = change['ns']['coll']
-            if col in self.dfs:
-                df, row = modify_df(self.dfs[col], change)
-                if isinstance(df, DropEvent):
-                    self.dfs.pop(col)
+            if col in self.buffers:
+                buf, row = apply_change(self.buffers[col], change)
+                if isinstance(buf, DropEvent):
+                    self.buffers.pop(col)
                     self.col_dropped.emit(col)
                     return
-                
-                self.dfs[col] = df
-                self.updated_row.emit(col, row)
-                
-            else:
-                doc = change['fullDocument']
-                row = pd.Series(doc)
-                self.dfs[col] = pd.DataFrame([row])
-                self.dfs[col].set_index('_id', inplace=True)
+                if not row is None:
+                    self.updated_row.emit(col, row)
+
+            elif change['operationType'] in ['insert', 'replace']:
+                buf, row = apply_change(Keyed_Columnar_Buffer(), change)
+                self.buffers[col] = buf
                 self.col_added.emit(col)
                 self.updated_row.emit(col, row)
         except:
@@ -187,11 +286,9 @@ class Synched_Mongo_Database(QtCore.QObject):
         
         # self.refresh_all() #I will make this a little more efficient later on
 
-    def __del__(self):
-        self.watcher.exit_flag = True
-
-    
-
+    def stop(self, wait=True):
+        """Stop listening to the changes (must be done before closing the MongoClient)"""
+        self.watcher.stop(wait=wait)
 
-    
-            
\ No newline at end of file
+    def __del__(self):
+        self.watcher.stop(wait=False)
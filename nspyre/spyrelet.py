@@ -1,7 +1,7 @@
 import pymongo
-from nspyre.instrument_manager import Instrument_Manager
+from nspyre.instrument_manager import Instrument_Manager, get_instrument_manager
 from nspyre.utils import *
-# from instrument_server import Remote_Device
+from nspyre.instrument_server import Remote_Device
 import pandas as pd
 import numpy as np
 
@@ -12,7 +12,11 @@ import inspect
 from collections import OrderedDict
 from tqdm.auto import tqdm
 from nspyre.data_handling import save_data
+from nspyre.columnar import Columnar_Buffer
+from bson import ObjectId
 import threading
+import queue
+import time
 
 class MissingDeviceError(Exception):
     pass
@@ -23,6 +27,84 @@ class MissingSpyreletError(Exception):
 class StopRunning(Exception):
     pass
 
+class Batched_Writer():
+    """
+    Background writer which pushes acquired rows to a MongoDB collection with insert_many.
+
+    Rows are put on a bounded queue and flushed by a daemon thread whenever <batch_size> rows are pending
+    or <flush_interval> seconds have passed since the first pending row (so live views see the data within
+    roughly flush_interval).  When the queue is full, put() blocks until the writer catches up (backpressure).
+    close() writes the pending rows and stops the thread.
+    """
+    _CLOSE = object()
+
+    def __init__(self, col, flush_interval=0.1, batch_size=500, max_queue=10000):
+        self.col = col
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.last_error = None
+        self.closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def put(self, doc):
+        if self.closed:
+            raise RuntimeError('Batched_Writer is closed')
+        self.queue.put(doc)
+
+    def flush(self, timeout=None, raise_errors=True):
+        """
+        Block until every row put so far has been written (or <timeout> s have passed).  Returns True if everything was written.
+        If a write failed since the last flush, the error is raised (or only printed if not raise_errors).
+        """
+        with self.queue.all_tasks_done:
+            done = self.queue.all_tasks_done.wait_for(lambda: self.queue.unfinished_tasks == 0, timeout)
+        if not self.last_error is None and done:
+            err, self.last_error = self.last_error, None
+            if raise_errors:
+                raise err
+        return done
+
+    def close(self, timeout=None):
+        """Write the pending rows and stop the writer thread.  Returns True if the thread stopped within <timeout> s"""
+        if not self.closed:
+            self.closed = True
+            self.queue.put(self._CLOSE)
+        self._thread.join(timeout)
+        return not self._thread.is_alive()
+
+    def _run(self):
+        closing = False
+        while not closing:
+            doc = self.queue.get()
+            if doc is self._CLOSE:
+                self.queue.task_done()
+                break
+            batch = [doc]
+            deadline = time.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    doc = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if doc is self._CLOSE:
+                    self.queue.task_done()
+                    closing = True
+                    break
+                batch.append(doc)
+            try:
+                self.col.insert_many(batch, ordered=True)
+            except Exception as e:
+                traceback.print_exc()
+                self.last_error = e
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
 class Spyrelet():
     # A dict with the names and associated class of the devices required to run this spyrelet
     REQUIRED_DEVICES = dict()
@@ -45,10 +127,22 @@ class Spyrelet():
         - All sub-spyrelet must also be listed in the REQUIRED_SPYRELETS dict
         - Upon instanciation the class will check the __init__ arguments devices and spyrelets to make sure they satisfy these requirements
 
-        - For higher performance we will store the data internally as a list instead of a dataframe.  Quicker to append to a list.
+        - For higher performance we will store the data internally in a Columnar_Buffer (per-column NumPy arrays) instead of a dataframe.
+          Appending is amortized O(1) and the data property only converts the rows acquired since it was last accessed.
+
+        - By default every acquire does a synchronous insert_one to MongoDB.  Passing writer='batched' instead queues the rows
+          and writes them from a background thread with insert_many (see Batched_Writer).  The pending rows are flushed
+          at the end of run and before clearing the data.  flush() can also be called explicitly and close() stops the writer thread.
+
+        - ndarrays in acquired rows are stored in MongoDB as BSON Binary (with dtype and shape) by default.
+          Use array_encoding='list' to store them as lists instead (see encode_ndarray).
+
+        - When no manager is given, the spyrelet uses the Instrument_Manager shared by the process (see get_instrument_manager),
+          so the server handshake is only done once.  manager_timeout is only used if that manager doesn't exist yet.
 
     """
-    def __init__(self, unique_name, spyrelets={}, device_alias={}, mongodb_addr=None, manager=None, manager_timeout=30000, **consts):
+    def __init__(self, unique_name, spyrelets={}, device_alias={}, mongodb_addr=None, manager=None, manager_timeout=30000,
+                 writer='sync', flush_interval=0.1, batch_size=500, max_queue=10000, array_encoding='binary', **consts):
         self.name = unique_name
         self.progress = tqdm
         self.spyrelets = spyrelets
@@ -57,9 +151,10 @@ class Spyrelet():
         self.last_kwargs = dict()
 
         if manager is None:
-            manager = Instrument_Manager(timeout=manager_timeout)
+            manager = get_instrument_manager(timeout=manager_timeout)
 
         self.mongodb_addr = mongodb_addr
+        self.array_encoding = array_encoding
         self.validate()
         
         reg_entry = {
@@ -70,26 +165,25 @@ class Spyrelet():
         self.client = get_mongo_client(mongodb_addr)
         self.col = self.client['Spyre_Live_Data'][unique_name]
         self.client['Spyre_Live_Data']['Register'].update_one({'_id':unique_name},{'$set':reg_entry}, upsert=True)
+        if writer == 'batched':
+            self.writer = Batched_Writer(self.col, flush_interval=flush_interval, batch_size=batch_size, max_queue=max_queue)
+        elif writer == 'sync':
+            self.writer = None
+        else:
+            raise ValueError("Invalid writer mode: {} (must be 'sync' or 'batched')".format(writer))
         self.clear_data()
 
-        # This is imported here otherwise the import may occur before the Remote_Device_Instance is dynamically generated...
-        # from instrument_server import Remote_Device
-
         devices = manager.get_devices()
         for dname, dclass in self.REQUIRED_DEVICES.items():
             real_dname = device_alias[dname] if dname in device_alias else dname
             if real_dname in devices:
-                # isRemoteDevice = issubclass(type(devices[dname]), Remote_Device)
-                #This is a convoluted way of checking subclass
-                isRemoteDevice = any(['spyre.instrument_server.Remote_Device' in str(c) for c in inspect.getmro(type(devices[real_dname]))])
-
-                if isRemoteDevice :
-                    inst_dclass = get_class_from_str(devices[real_dname].info['class'])
-                    dev = devices[real_dname]
+                dev = devices[real_dname]
+                # Remote devices know the class hierarchy of their driver (so it doesn't need to be imported)
+                if isinstance(dev, Remote_Device):
+                    is_valid = dev.driver_isinstance(dclass)
                 else:
-                    inst_dclass = type(devices[real_dname])
-                    dev = devices[real_dname]
-                if issubclass(inst_dclass, dclass):
+                    is_valid = isinstance(dev, dclass)
+                if is_valid:
                     setattr(self, dname, dev)
             else:
                 raise MissingDeviceError("Device requirements for this spyrelets ({}) was not met.  Misssing: {}".format(self.name, dname))
@@ -123,7 +217,13 @@ class Spyrelet():
         except:
             traceback.print_exc()
         finally:
-            self.finalize(*args, **kwargs)
+            try:
+                self.finalize(*args, **kwargs)
+            finally:
+                try:
+                    self.flush()
+                except:
+                    traceback.print_exc()
 
     def bg_run(self, *args, **kwargs):
         t = threading.Thread(target=lambda: self.run(*args, **kwargs))
@@ -195,19 +295,35 @@ class Spyrelet():
 
 
     def stop(self):
+        # This is usually called from the GUI thread, so it doesn't wait for the pending rows (run flushes them when it exits)
         self._stop_flag = True
         for sname in self.REQUIRED_SPYRELETS:
             getattr(self, sname).stop()
 
+    def flush(self, timeout=None):
+        """
+        Wait for all the acquired rows to be written to MongoDB (only relevant for the batched writer).
+        Returns False if they were not all written within <timeout> s.
+        """
+        if not self.writer is None:
+            return self.writer.flush(timeout=timeout)
+        return True
+
+    def close(self, timeout=None):
+        """Write the pending rows and stop the writer thread (the spyrelet can't acquire anymore after this)"""
+        if not self.writer is None:
+            self.writer.close(timeout=timeout)
+
     def clear_data(self):
+        self.flush()
         self.col.drop()
-        self._data = list()
+        self._data = Columnar_Buffer()
         self._child_data = dict()
 
     CASTING_DICT = {np.int32:int, np.float64:float}
     def acquire(self, row):
         # Cleanup row
-        # Here we will keep numpy arrays as is for local copy, but change it to list for MongoDB
+        # Here we will keep numpy arrays as is for local copy, but encode them for MongoDB
         if not row is None:
             restore_row = dict()
             for k, val in row.items():
@@ -216,11 +332,17 @@ class Spyrelet():
                     row[k] = row[k].to(Q_(base_unit)).m
                 if type(val) == np.ndarray:
                     restore_row[k] = row[k]
-                    row[k] = row[k].tolist()
+                    row[k] = encode_ndarray(row[k], array_encoding=self.array_encoding)
                 if type(val) in self.CASTING_DICT:
                     row[k] = self.CASTING_DICT[type(val)](row[k])
 
-            self.col.insert_one(row)
+            if self.writer is None:
+                self.col.insert_one(row)
+            else:
+                # The _id is generated here so the local copy has it even though the insert happens later
+                if not '_id' in row:
+                    row['_id'] = ObjectId()
+                self.writer.put(dict(row))
 
             for k, val in restore_row.items():
                 row[k] = val
@@ -250,7 +372,8 @@ class Spyrelet():
 
     @property
     def data(self):
-        return pd.DataFrame(self._data)
+        """DataFrame of the acquired rows.  This is cached between calls, so it should not be modified in place"""
+        return self._data.to_dataframe()
 
     def save(self, filename, **kwargs):
         return save_data(self, filename, **kwargs)
@@ -0,0 +1,143 @@
+"""
+    nspyre.stats.py
+    ~~~~~~~~~~~~~~~
+
+    Latency statistics for the instrument server and its clients.
+
+    Durations are accumulated in log-spaced histograms (4 bins per decade from 1us to 100s) per key and per phase,
+    so recording is O(1) and the memory used doesn't grow with the number of requests.
+"""
+
+import bisect
+import threading
+import time
+import traceback
+import numpy as np
+
+
+class Latency_Histogram():
+    EDGES = list(np.logspace(-6, 2, 33))
+
+    def __init__(self):
+        self.bins = [0]*(len(self.EDGES)+1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, dt):
+        self.bins[bisect.bisect_right(self.EDGES, dt)] += 1
+        self.count += 1
+        self.total += dt
+        self.min = dt if self.min is None else min(self.min, dt)
+        self.max = dt if self.max is None else max(self.max, dt)
+
+    def percentile(self, q):
+        """Estimate of the q-th percentile (upper edge of the bin containing it)"""
+        if self.count == 0:
+            return None
+        target = q/100*self.count
+        n = 0
+        for i, c in enumerate(self.bins):
+            n += c
+            if n >= target and c:
+                return min(self.EDGES[i], self.max) if i < len(self.EDGES) else self.max
+        return self.max
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'mean': self.total/self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'bins': list(self.bins),
+        }
+
+
+class Latency_Stats():
+    """
+    Thread-safe collection of Latency_Histogram, per key (a tuple, for example (dname, cmd, feat)) and per phase.
+    Phases measured deep in the call stack (like the Mongo mirror) can be added to the request being timed in the
+    current thread with add_time.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.entries = dict()
+            self.since = time.time()
+
+    def record(self, key, phases, error=False):
+        """Record the durations (dict phase -> s) of one request"""
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self.entries[key] = {'count':0, 'errors':0, 'phases':dict()}
+            entry['count'] += 1
+            if error:
+                entry['errors'] += 1
+            for phase, dt in phases.items():
+                hist = entry['phases'].get(phase)
+                if hist is None:
+                    hist = entry['phases'][phase] = Latency_Histogram()
+                hist.add(dt)
+
+    def start(self):
+        """Start collecting the add_time phases of the current thread.  Returns the phases which were being collected (see stop)"""
+        outer = getattr(self._local, 'phases', None)
+        self._local.phases = dict()
+        return outer
+
+    def stop(self, outer=None):
+        """Returns the phases collected in the current thread since start (and resumes collecting <outer>, as returned by start)"""
+        phases = getattr(self._local, 'phases', None)
+        self._local.phases = outer
+        return dict() if phases is None else phases
+
+    def add_time(self, phase, dt):
+        phases = getattr(self._local, 'phases', None)
+        if not phases is None:
+            phases[phase] = phases.get(phase, 0) + dt
+
+    def snapshot(self):
+        """Returns a list with a dict {'key', 'count', 'errors', 'phases':{phase:histogram dict}} per key"""
+        with self._lock:
+            return [{'key':list(key), 'count':entry['count'], 'errors':entry['errors'],
+                     'phases':{phase:hist.to_dict() for phase, hist in entry['phases'].items()}}
+                    for key, entry in self.entries.items()]
+
+    def format(self, snapshot=None):
+        """Text table of a snapshot (mean / p99 in ms for each phase)"""
+        snapshot = self.snapshot() if snapshot is None else snapshot
+        lines = ['Latency stats since {} (mean/p99 in ms)'.format(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.since)))]
+        for entry in sorted(snapshot, key=lambda e: -e['count']):
+            phases = ', '.join('{} {:.3f}/{:.3f}'.format(phase, 1000*h['mean'], 1000*h['p99']) for phase, h in entry['phases'].items())
+            key = '.'.join(str(k) for k in entry['key'] if not k is None)
+            lines.append('\t{:<40} n={:<8} err={:<4} {}'.format(key, entry['count'], entry['errors'], phases))
+        return '\n'.join(lines)
+
+
+class Stats_Dumper(threading.Thread):
+    """Periodically print (or pass to <output>) the formatted stats"""
+    def __init__(self, stats, interval=60, output=print):
+        super().__init__(daemon=True, name='Stats_Dumper')
+        self.stats = stats
+        self.interval = interval
+        self.output = output
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.output(self.stats.format())
+            except Exception:
+                traceback.print_exc()
+
+    def stop(self):
+        self._stop_event.set()
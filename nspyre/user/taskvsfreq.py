@@ -75,22 +75,20 @@ class TaskVsFreq(Spyrelet):
             self.daq.stop(name)
             self.daq.clear_task(name)
         
-    @Plot1D
-    def avg(df, cache):
-        g = df.groupby('f')
-        fs = g.ch1.mean().index
-        return {'ch1':[fs, g.ch1.mean()],'ch2':[fs, g.ch2.mean()]}
+    @Plot1DIncremental
+    def avg(new_df, state, cache):
+        g = state.groupby('f', ['ch1', 'ch2'])
+        return {'ch1':[g.keys, g.mean('ch1')],'ch2':[g.keys, g.mean('ch2')]}
 
     @Plot1D
     def latest(df, cache):
         latest = df[df.i == df.i.max()]
         return {'ch1':[latest.f, latest.ch1],'ch2':[latest.f, latest.ch2]}
 
-    @Plot1D
-    def diff_avg(df, cache):
-        g = df.groupby('f')
-        fs = g.ch1.mean().index
-        return {'ch1-ch2':[fs, g.ch1.mean()-g.ch2.mean()]}
+    @Plot1DIncremental
+    def diff_avg(new_df, state, cache):
+        g = state.groupby('f', ['ch1', 'ch2'])
+        return {'ch1-ch2':[g.keys, g.mean('ch1')-g.mean('ch2')]}
 
     @Plot1D
     def diff_latest(df, cache):
@@ -42,6 +42,8 @@ class TaskVsFSM(Spyrelet):
             
     def initialize(self, xs, ys, daq_ch, sweeps=1, acq_rate=Q_(5000, 'Hz'), pts_per_pixel=10):
         self.fsm.new_input_task([daq_ch])
+        # This lets the views know the full size of the scan before it is acquired
+        self.reg_cache_store(xs=xs.to('um').m, ys=ys.to('um').m)
         
     def finalize(self, xs, ys, daq_ch, sweeps=1, acq_rate=Q_(5000, 'Hz'), pts_per_pixel=10):
         pass
@@ -53,18 +55,30 @@ class TaskVsFSM(Spyrelet):
 
     @PlotFormatUpdate(HeatmapPlotWidget, ['latest', 'avg'])
     def update_format(p, df, cache):
-        xs, ys     = df.x_vals[0],    df.y.unique()
+        if 'xs' in cache and 'ys' in cache:
+            xs, ys = cache['xs'], cache['ys']
+        else:
+            xs, ys = df.x_vals[0],    df.y.unique()
         diff       = [xs[-1]-xs[0] , ys[-1]-ys[0]]
         p.im_pos   = [np.mean(xs) - diff[0]/2 , np.mean(ys) - diff[1]/2]
         p.im_scale = [diff[0]/len(xs) , diff[1]/len(ys)]
-        p.set(p.w.image) #We have to redraw for the scaling to take effect
 
-    @Plot2D
-    def latest(df, cache):
-        latest = df[df.sweep_idx == df.sweep_idx.max()]
-        im = np.vstack(latest.sort_values('column_idx')['row_data'])
-        max_rows = len(df.x_vals[0])
-        return np.pad(im, (0, max_rows - im.shape[1]), mode='constant', constant_values=0)
+    @Plot2DIncremental
+    def latest(new_df, state, cache):
+        # Only the rows acquired since the last update are sent, they are written in place in the heatmap (which is cleared on a new sweep)
+        rows = dict()
+        for sweep_idx, column_idx, row_data, x_vals in zip(new_df.sweep_idx, new_df.column_idx, new_df.row_data, new_df.x_vals):
+            if sweep_idx != state.get('sweep_idx'):
+                state['sweep_idx'] = sweep_idx
+                rows = dict()
+            rows[column_idx] = row_data
+            state['n_rows'] = max(state.get('n_rows', 0), column_idx+1)
+            state['n_cols'] = len(x_vals)
+        if 'xs' in cache and 'ys' in cache:
+            shape = (len(cache['ys']), len(cache['xs']))
+        else:
+            shape = (state.get('n_rows', 0), state.get('n_cols', 0))
+        return {'shape':shape, 'rows':rows, 'id':state.get('sweep_idx')}
 
     @Plot2D
     def avg(df, cache):
@@ -3,17 +3,45 @@ from lantz import Q_
 from collections.abc import Iterable
 import numpy as np
 import inspect
-from bson import ObjectId
+from bson import ObjectId, Binary
 import yaml
 import os
 from importlib import import_module
 import traceback
-
-def get_mongo_client(mongodb_addr=None):
+import threading
+
+# Process-wide registry of MongoClient (one per address)
+_MONGO_CLIENTS = dict()
+_MONGO_CLIENTS_LOCK = threading.Lock()
+
+def get_mongo_client(mongodb_addr=None, shared=True):
+    """
+    Returns a MongoClient connected to mongodb_addr (the one from the config by default).
+    Each MongoClient has its own connection pool and monitor threads, so the clients are shared by the whole process (one per address).
+    Use shared=False to get a private client (which should then be closed by the caller).  The shared clients are closed by close_mongo_clients.
+    """
     if mongodb_addr is None:
         cfg = get_configs()
         mongodb_addr = cfg['mongodb_addr']
-    return pymongo.MongoClient(mongodb_addr, replicaset='NSpyreSet')
+    if not shared:
+        return pymongo.MongoClient(mongodb_addr, replicaset='NSpyreSet')
+    # MongoClient are not fork-safe, so a forked process gets its own clients
+    key = (os.getpid(), mongodb_addr)
+    with _MONGO_CLIENTS_LOCK:
+        if not key in _MONGO_CLIENTS:
+            _MONGO_CLIENTS[key] = pymongo.MongoClient(mongodb_addr, replicaset='NSpyreSet')
+        return _MONGO_CLIENTS[key]
+
+def close_mongo_clients():
+    """Close all the shared MongoClient (a new one is created by the next get_mongo_client)"""
+    with _MONGO_CLIENTS_LOCK:
+        clients = list(_MONGO_CLIENTS.values())
+        _MONGO_CLIENTS.clear()
+    for client in clients:
+        try:
+            client.close()
+        except Exception:
+            traceback.print_exc()
     # for addr in mongodb_addrs:
     #     client = pymongo.MongoClient(addr, re)
     #     if client.is_primary:
@@ -23,23 +51,55 @@ def get_mongo_client(mongodb_addr=None):
 
 def cleanup_register(client):
     if type(client) is str:
-        client = pymongo.MongoClient(client)
+        client = get_mongo_client(client)
     db_list = client['Spyre_Live_Data'].list_collection_names()
     reg_list = [x['_id'] for x in client['Spyre_Live_Data']['Register'].find({},{'_id':True})]
     for name in reg_list:
         if not name in db_list:
             client['Spyre_Live_Data']['Register'].delete_one({'_id': name})
 
-def custom_encode(d):
+def encode_ndarray(arr, array_encoding='binary'):
+    """
+    Encode a ndarray for MongoDB.  With array_encoding='binary' the raw buffer is stored as BSON Binary along with its dtype and shape,
+    which is much smaller and faster than a list of python numbers.  array_encoding='list' stores a plain list, exactly like
+    before the binary encoding was added (object arrays always use it).
+    """
+    if not array_encoding in ['binary', 'list']:
+        raise ValueError("Invalid array encoding: {} (must be 'binary' or 'list')".format(array_encoding))
+    if array_encoding == 'binary' and arr.dtype != object:
+        return {'__type__':'ndarray', 'dtype':arr.dtype.str, 'shape':list(arr.shape), 'bin':Binary(arr.tobytes())}
+    return arr.tolist()
+
+def decode_ndarray(val):
+    """Decode an encoded ndarray (see encode_ndarray or the list format of custom_encode).  The returned array is writable"""
+    if 'bin' in val:
+        return np.frombuffer(bytearray(val['bin']), dtype=np.dtype(val['dtype'])).reshape(tuple(val['shape']))
+    return np.array(val['val'])
+
+def is_encoded_ndarray(val):
+    return isinstance(val, dict) and val.get('__type__') == 'ndarray'
+
+def decode_row(doc):
+    """Decode (in place) the top level fields of a MongoDB document which contain encoded ndarrays"""
+    for k, val in doc.items():
+        if is_encoded_ndarray(val):
+            doc[k] = decode_ndarray(val)
+    return doc
+
+def custom_encode(d, array_encoding='list'):
     out = dict()
     for k,val in d.items():
         if type(val) == Q_:
             out[k] = {'__type__':'Quantity', 'm':val.m, 'units':str(val.units)}
         elif type(val) == RangeDict:
             out[k] = {'__type__':'RangeDict'}
-            out[k].update(custom_encode(val))
+            out[k].update(custom_encode(val, array_encoding=array_encoding))
         elif type(val) == np.ndarray:
-            out[k] = {'__type__':'ndarray', 'val':val.tolist()}
+            if array_encoding == 'binary' and val.dtype != object:
+                out[k] = encode_ndarray(val, array_encoding=array_encoding)
+            else:
+                # Tagged list, so custom_decode gives back an ndarray
+                out[k] = {'__type__':'ndarray', 'val':val.tolist()}
         else:
             out[k] = val
     return out
@@ -53,7 +113,7 @@ def custom_decode(d):
             elif val['__type__'] == 'RangeDict':
                 out[k] = custom_decode(val)
             elif val['__type__'] == 'ndarray':
-                out[k] = np.array(val['val'])
+                out[k] = decode_ndarray(val)
         else:
             out[k] = val
     return out
@@ -117,7 +177,11 @@ def get_class_from_str(class_str):
     mod = import_module(class_str.replace('.'+class_name, ''))
     return getattr(mod, class_name)
 
-def load_all_spyrelets():
+def load_all_spyrelets(manager=None):
+    # All the spyrelets share the same Instrument_Manager (the process-wide one by default)
+    if manager is None:
+        from nspyre.instrument_manager import get_instrument_manager
+        manager = get_instrument_manager()
     cfg = get_configs()
     names = list(cfg['experiment_list'].keys())
 
@@ -134,6 +198,7 @@ def load_all_spyrelets():
                     subs = {name:ans[inst_name] for name, inst_name in subs.items()}
                     args = exp['args'] if 'args' in exp else {}
                     args = custom_decode(args)
+                    args.setdefault('manager', manager)
                     ans[sname] = sclass(sname, spyrelets=subs, **args)
                 except:
                     print("Could not instanciate spyrelet {}...".format(sname))
@@ -1,11 +1,17 @@
 from nspyre.mongo_listener import Synched_Mongo_Collection
 from nspyre.widgets.plotting import LinePlotWidget
 from nspyre.utils import get_class_from_str
+import numpy as np
+import pandas as pd
 
 class View():
-    def __init__(self, f, plot_type):
+    def __init__(self, f, plot_type, incremental=False):
         self.update_fun = f
         self.type = plot_type
+        self.incremental = incremental
+        # These are filled in by Spyrelet_Views, so the view can be looked up by name (for example from another process)
+        self.name = f.__name__
+        self.spyrelet_class = None
         self.init_formatters = dict()
         self.update_formatters = dict()
 
@@ -35,9 +41,131 @@ def Plot1D(fun):
 
 def Plot2D(fun):
     """Functions marked with this decorators should take a single argument (beyond self) which will be the dataframe representing the data
-       The function marked must return a 2D ndarray to be plotted"""
+       The function marked must return a 2D ndarray to be plotted.
+       It can also return a dict {'shape':(rows, columns), 'rows':{row_index:row_data}} to only update some rows of the image
+       in place (this is mostly useful with Plot2DIncremental for line scans).  An optional 'id' (for example the sweep index)
+       can be added to the dict, the image is cleared whenever it changes."""
     return View(fun, '2D')
 
+def Plot1DIncremental(fun):
+    """Incremental version of Plot1D.  Functions marked with this decorator take 3 arguments: (new_df, state, cache)
+       new_df only contains the rows acquired since the last call and state is an Incremental_State which persists between
+       calls (it is reset when the data is cleared or when existing rows are modified).  The running aggregations of the state make the cost of an update
+       proportional to the new data instead of the total data:
+
+       @Plot1DIncremental
+       def avg(new_df, state, cache):
+           g = state.groupby('f', ['ch1', 'ch2'])
+           return {'ch1':[g.keys, g.mean('ch1')], 'ch2':[g.keys, g.mean('ch2')]}
+
+       The function must return the same format as a Plot1D function"""
+    return View(fun, '1D', incremental=True)
+
+def Plot2DIncremental(fun):
+    """Incremental version of Plot2D (see Plot1DIncremental).  The function must return the same format as a Plot2D function"""
+    return View(fun, '2D', incremental=True)
+
+class Running_Aggregate():
+    """
+    Running count, sum, min and max (and thus mean) of some columns grouped by the value of a key column (like df.groupby(by)[columns]).
+    Each update only processes the new rows.  NaN values are ignored.  The results are sorted by key (like a groupby).
+    """
+    def __init__(self, by, columns):
+        self.by = by
+        self.columns = list(columns)
+        self._col_index = {c:i for i, c in enumerate(self.columns)}
+        self._keys = list()
+        self._pos = dict()
+        n = len(self.columns)
+        self._count = np.zeros((0, n))
+        self._sum = np.zeros((0, n))
+        self._min = np.zeros((0, n))
+        self._max = np.zeros((0, n))
+        self._order = None
+
+    def _add_groups(self, n_new):
+        n = len(self.columns)
+        self._count = np.concatenate([self._count, np.zeros((n_new, n))])
+        self._sum = np.concatenate([self._sum, np.zeros((n_new, n))])
+        self._min = np.concatenate([self._min, np.full((n_new, n), np.inf)])
+        self._max = np.concatenate([self._max, np.full((n_new, n), -np.inf)])
+
+    def update(self, df):
+        if df is None or len(df) == 0:
+            return
+        unique_keys, inv = np.unique(df[self.by].values, return_inverse=True)
+        pos = np.empty(len(unique_keys), dtype=int)
+        n_new = 0
+        for i, key in enumerate(unique_keys):
+            if not key in self._pos:
+                self._pos[key] = len(self._keys)
+                self._keys.append(key)
+                n_new += 1
+            pos[i] = self._pos[key]
+        if n_new:
+            self._add_groups(n_new)
+            self._order = None
+        idx = pos[inv.ravel()]
+        vals = df[self.columns].values.astype(float)
+        valid = ~np.isnan(vals)
+        np.add.at(self._count, idx, valid)
+        np.add.at(self._sum, idx, np.where(valid, vals, 0))
+        np.minimum.at(self._min, idx, np.where(valid, vals, np.inf))
+        np.maximum.at(self._max, idx, np.where(valid, vals, -np.inf))
+
+    def _sorted(self, arr, col):
+        if self._order is None:
+            self._order = np.argsort(np.array(self._keys), kind='stable')
+        return pd.Series(arr[self._order, self._col_index[col]], index=pd.Index(self.keys, name=self.by), name=col)
+
+    @property
+    def keys(self):
+        if self._order is None:
+            self._order = np.argsort(np.array(self._keys), kind='stable')
+        return np.array(self._keys)[self._order]
+
+    def count(self, col):
+        return self._sorted(self._count, col)
+
+    def sum(self, col):
+        return self._sorted(self._sum, col)
+
+    def mean(self, col):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self._sorted(self._sum/self._count, col)
+
+    def min(self, col):
+        return self._sorted(np.where(self._count > 0, self._min, np.nan), col)
+
+    def max(self, col):
+        return self._sorted(np.where(self._count > 0, self._max, np.nan), col)
+
+class Incremental_State(dict):
+    """
+    Persistent state passed to the incremental views.  It can be used as a dict to store anything between calls.
+    groupby(by, columns) returns a Running_Aggregate which is updated with the new rows of every batch (whether or not groupby is
+    called for that batch).  An aggregate requested for the first time is computed from all the rows received so far.
+    """
+    def __init__(self):
+        super().__init__()
+        self.aggregates = dict()
+        self.new_rows = None
+        self.df = None
+
+    def next_batch(self, new_rows, df=None):
+        """Process a batch of new rows (df is all the rows received so far, including the new ones)"""
+        self.new_rows = new_rows
+        self.df = new_rows if df is None else df
+        for agg in self.aggregates.values():
+            agg.update(new_rows)
+
+    def groupby(self, by, columns):
+        key = (by, tuple(columns))
+        if not key in self.aggregates:
+            agg = self.aggregates[key] = Running_Aggregate(by, columns)
+            agg.update(self.df)
+        return self.aggregates[key]
+
 def PlotFormatInit(class_type_handled, view_list):
     """Functions marked with this decorators will be called once when initializing the views.
        They should declare in the decorators argument what type of class they will handle.
@@ -70,6 +198,9 @@ class Spyrelet_Views():
             spyrelet_class =get_class_from_str(spyrelet_class)
         
         self.views = {x:getattr(spyrelet_class, x) for x in dir(spyrelet_class) if type(getattr(spyrelet_class, x)) is View}
+        for name, view in self.views.items():
+            view.name = name
+            view.spyrelet_class = "{}.{}".format(spyrelet_class.__module__, spyrelet_class.__name__)
         formatters = [getattr(spyrelet_class, x) for x in dir(spyrelet_class) if type(getattr(spyrelet_class, x)) is Formatter]
 
         # Associate format_init and format_update functions
@@ -1,7 +1,8 @@
 from PyQt5 import QtWidgets, QtCore
 import pyqtgraph as pg
 from lantz import Q_
-from collections import OrderedDict, Iterable
+from collections import OrderedDict
+from collections.abc import Iterable
 
 from nspyre.widgets.spinbox import SpinBox
 
@@ -8,12 +8,13 @@
     Date: 10/30/2019
 """
 
-from collections import OrderedDict, Hashable
+from collections import OrderedDict
+from collections.abc import Hashable
 import traceback
 
 import pyqtgraph as pg
 from PyQt5 import QtWidgets, QtCore
-import sip
+from PyQt5 import sip
 
 from nspyre.instrument_server import Instrument_Server_Client, load_remote_device
 from nspyre.instrument_manager import Instrument_Manager
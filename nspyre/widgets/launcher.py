@@ -177,8 +177,11 @@ class Combined_Launcher(QtWidgets.QWidget):
         self.setLayout(layout)
 
 
-        #Create the launchers
-        spyrelets = load_all_spyrelets() if spyrelets is None else spyrelets
+        #Create the launchers (the spyrelets loaded here are closed with the widget)
+        self.owned_spyrelets = list()
+        if spyrelets is None:
+            spyrelets = load_all_spyrelets()
+            self.owned_spyrelets = list(spyrelets.values())
         self.launchers = {name: Spyrelet_Launcher_Widget(s) for name, s in spyrelets.items()}
         # cfg = get_configs()
         # names = list(cfg['experiment_list'].keys())
@@ -218,6 +221,11 @@ class Combined_Launcher(QtWidgets.QWidget):
         self.container_layout.setCurrentWidget(self.launchers[name])
         # self.container_layout.
 
+    def closeEvent(self, ev):
+        for s in self.owned_spyrelets:
+            s.close(timeout=1)
+        super().closeEvent(ev)
+
 if __name__=='__main__':
     from nspyre.widgets.app import NSpyreApp
     app = NSpyreApp([])
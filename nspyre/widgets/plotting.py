@@ -1,6 +1,6 @@
 import itertools as it
 
-from PyQt5 import QtWidgets, QtCore
+from PyQt5 import QtWidgets, QtCore, QtGui
 
 import pyqtgraph as pg
 from pyqtgraph.graphicsItems.GraphicsObject import GraphicsObject
@@ -18,6 +18,7 @@ from nspyre.widgets.code_editor import Scintilla_Code_Editor, Monokai_Python_Lex
 
 import traceback
 import inspect
+import time
 from scipy.optimize import curve_fit
 
 from collections import OrderedDict
@@ -151,7 +152,12 @@ class BasePlotWidget(QtWidgets.QWidget):
 
 class HeatmapPlotWidget(BasePlotWidget):
 
-    def __init__(self, parent=None, cmap=None):
+    def __init__(self, parent=None, cmap=None, levels_interval=0.5):
+        """
+        Besides setting the whole image (set), rows can be written in place in a preallocated buffer (set_rows), which avoids
+        rebuilding the image for every new line of a scan.  In that mode the levels and histogram are only
+        recomputed every <levels_interval> seconds.
+        """
         plot_item = pg.PlotItem(enableMouse=False)
         w = pg.ImageView(view=plot_item)
         super().__init__(parent=parent, w=w, plot_item=plot_item)
@@ -170,6 +176,13 @@ class HeatmapPlotWidget(BasePlotWidget):
         self._pos = None
         self._scale = None
 
+        # Row buffer
+        self.levels_interval = levels_interval
+        self._buffer = None
+        self._buffer_range = [np.inf, -np.inf]
+        self._last_levels_update = 0
+        self._buffer_id = None
+
         self.invertY = True
         return
 
@@ -208,6 +221,16 @@ class HeatmapPlotWidget(BasePlotWidget):
         self.plot_item.showGrid(x=toggle, y=toggle, alpha=alpha)
         return
 
+    def clear(self):
+        super().clear()
+        self.reset_rows()
+
+    def reset_rows(self):
+        """Forget the row buffer (the next set_rows starts from a blank image)"""
+        self._buffer = None
+        self._buffer_range = [np.inf, -np.inf]
+        self._buffer_id = None
+
     @property
     def aspectLocked(self):
         return self.w.getView().state['aspectLocked']
@@ -222,7 +245,9 @@ class HeatmapPlotWidget(BasePlotWidget):
 
     @im_pos.setter
     def im_pos(self, pos):
-        self._pos = pos
+        if not np.array_equal(pos, self._pos):
+            self._pos = pos
+            self._apply_transform()
 
     @property
     def im_scale(self):
@@ -230,9 +255,73 @@ class HeatmapPlotWidget(BasePlotWidget):
 
     @im_scale.setter
     def im_scale(self, scale):
-        self._scale = scale
+        if not np.array_equal(scale, self._scale):
+            self._scale = scale
+            self._apply_transform()
+
+    def _apply_transform(self):
+        # Apply the position and scale without having to set the image again
+        item = self.w.getImageItem()
+        if item.image is None:
+            return
+        tr = QtGui.QTransform()
+        if not self._pos is None:
+            tr.translate(*self._pos)
+        if not self._scale is None:
+            tr.scale(*self._scale)
+        item.setTransform(tr)
+
+    def set_rows(self, rows, shape, buffer_id=None):
+        """
+        Write some rows of an image of size <shape> in place.  rows is a dict of {row_index: row_data}.
+        The buffer is (re)allocated when the shape changes (keeping the overlapping rows) or when buffer_id changes (starting from a
+        blank image, for example on a new sweep).  Otherwise only the new rows are written and the image is redrawn from the buffer
+        without recomputing the levels and histogram (which are refreshed at most every levels_interval seconds).
+        The redraw still processes the whole image, so its cost grows with the size of the image rather than with the number of rows.
+        """
+        shape = tuple(int(x) for x in shape)
+        item = self.w.getImageItem()
+        if self._buffer is None or buffer_id != self._buffer_id:
+            self._buffer = np.zeros(shape)
+            self._buffer_range = [np.inf, -np.inf]
+            new_buffer = True
+        elif self._buffer.shape != shape:
+            old = self._buffer
+            self._buffer = np.zeros(shape)
+            h, w = min(old.shape[0], shape[0]), min(old.shape[1], shape[1])
+            self._buffer[:h, :w] = old[:h, :w]
+            new_buffer = True
+        else:
+            new_buffer = False
+        self._buffer_id = buffer_id
+
+        for idx, row in rows.items():
+            row = np.asarray(row)[:shape[1]]
+            self._buffer[int(idx), :len(row)] = row
+            if len(row):
+                self._buffer_range = [min(self._buffer_range[0], np.nanmin(row)), max(self._buffer_range[1], np.nanmax(row))]
+
+        if new_buffer or item.image is None or not np.shares_memory(item.image, self._buffer):
+            self.set(self._buffer, keep_buffer=True)
+            self._last_levels_update = time.time()
+            return
 
-    def set(self, im):
+        # The ImageItem displays (a view of) the buffer, so redraw it without emitting sigImageChanged (which recomputes the histogram)
+        item.blockSignals(True)
+        try:
+            item.updateImage(autoLevels=False)
+        finally:
+            item.blockSignals(False)
+
+        if time.time() - self._last_levels_update > self.levels_interval:
+            self._last_levels_update = time.time()
+            if self.plot_opts_checkboxes['autoLevels'].isChecked() and np.isfinite(self._buffer_range).all():
+                self.w.setLevels(*self._buffer_range)
+            item.sigImageChanged.emit()
+
+    def set(self, im, keep_buffer=False):
+        if not keep_buffer:
+            self.reset_rows()
         self.w.setImage(im, pos=self._pos, scale=self._scale,
                         autoRange=self.plot_opts_checkboxes['autoRange'].isChecked(),
                         autoLevels=self.plot_opts_checkboxes['autoLevels'].isChecked(),
@@ -243,21 +332,118 @@ class HeatmapPlotWidget(BasePlotWidget):
         return self.w.getImageItem().image
 
 
+class Decimated_Trace():
+    """
+    Multi-resolution min/max pyramid of a trace used for peak preserving decimation.
+
+    Level i holds the min and max of buckets of BUCKET**(i+1) consecutive points.  When the new data only extends the
+    previous data (same first point and same previous last point), only the buckets touched by the new points are recomputed.
+    Decimation (and clipping) requires monotonic x values, otherwise the full data is rendered.
+    """
+    BUCKET = 4
+    MIN_LEVEL_SIZE = 256
+
+    def __init__(self):
+        self.xs = np.zeros(0)
+        self.ys = np.zeros(0)
+        self.levels = list() # list of [mins, maxs]
+        self.monotonic = True
+
+    def _is_append(self, xs, ys):
+        n = len(self.xs)
+        return n > 0 and len(xs) >= n and xs[0] == self.xs[0] and xs[n-1] == self.xs[-1] and ys[n-1] == self.ys[-1]
+
+    def set(self, xs, ys):
+        xs, ys = np.asarray(xs, dtype=float), np.asarray(ys, dtype=float)
+        start = len(self.xs) if self._is_append(xs, ys) else 0
+        if start == 0:
+            self.levels = list()
+            self.monotonic = True
+        if self.monotonic:
+            self.monotonic = bool(np.all(np.diff(xs[max(start-1, 0):]) >= 0))
+        self.xs, self.ys = xs, ys
+        if self.monotonic:
+            self._update_levels(start)
+
+    def _update_levels(self, start):
+        mins, maxs = self.ys, self.ys
+        first = start # First modified element of the previous level
+        level = 0
+        while len(mins) > self.MIN_LEVEL_SIZE:
+            if level >= len(self.levels):
+                # New level, which has to be built from the start
+                first = 0
+            j0 = first // self.BUCKET
+            idx = np.arange(j0*self.BUCKET, len(mins), self.BUCKET)
+            # fmin/fmax ignore NaNs
+            new_mins = np.fmin.reduceat(mins, idx) if len(idx) else np.zeros(0)
+            new_maxs = np.fmax.reduceat(maxs, idx) if len(idx) else np.zeros(0)
+            if level < len(self.levels):
+                old_mins, old_maxs = self.levels[level]
+                self.levels[level] = [np.concatenate([old_mins[:j0], new_mins]), np.concatenate([old_maxs[:j0], new_maxs])]
+            else:
+                self.levels.append([new_mins, new_maxs])
+            mins, maxs = self.levels[level]
+            first = j0
+            level += 1
+        del self.levels[level:]
+
+    def render(self, x_range=None, width=1000):
+        """
+        Returns the (xs, ys) to plot for the visible x_range (or all the data if None) with roughly 2 points (min and max) per pixel
+        """
+        n = len(self.xs)
+        if not self.monotonic or n == 0:
+            return self.xs, self.ys
+        i0, i1 = 0, n
+        if not x_range is None:
+            i0 = max(int(np.searchsorted(self.xs, x_range[0], side='left'))-1, 0)
+            i1 = min(int(np.searchsorted(self.xs, x_range[1], side='right'))+1, n)
+        n_visible = i1 - i0
+        # Pick the coarsest level which still has at least one bucket per pixel
+        level = -1
+        while level+1 < len(self.levels) and n_visible/self.BUCKET**(level+2) >= width:
+            level += 1
+        if level < 0:
+            return self.xs[i0:i1], self.ys[i0:i1]
+        bucket = self.BUCKET**(level+1)
+        j0, j1 = i0 // bucket, -(-i1 // bucket)
+        mins, maxs = self.levels[level]
+        bucket_xs = self.xs[np.arange(j0, j1)*bucket]
+        xs = np.repeat(bucket_xs, 2)
+        ys = np.empty(2*(j1-j0))
+        ys[0::2], ys[1::2] = mins[j0:j1], maxs[j0:j1]
+        return xs, ys
+
+
 class LinePlotWidget(BasePlotWidget):
 
     plots_updated = QtCore.pyqtSignal(list)
 
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, decimation='minmax', decimation_threshold=20000, clip_to_view=True):
+        """
+        Traces with more than <decimation_threshold> points are decimated (decimation='minmax' keeps the min and max of each
+        pixel bucket, None disables it) and recomputed on zoom/pan.  With clip_to_view only the visible part of the trace is
+        drawn when the x axis is not auto-ranging.
+        """
         super().__init__(parent=parent)
         self.legend = self.w.addLegend()
         self.grid(True)
         self._colors = it.cycle(cyclic_colors)
+        self.decimation = decimation
+        self.decimation_threshold = decimation_threshold
+        self.clip_to_view = clip_to_view
+        self.decimated = dict()
+        self._rendering = False
+        self.plot_item.getViewBox().sigXRangeChanged.connect(self.render_decimated)
+        self.plot_item.getViewBox().sigResized.connect(self.render_decimated)
         self.install_fitter()
         return
 
     def install_fitter(self):
         self.fitter = FitterWidget(self.w)
         self.fitter.traces = self.traces
+        self.fitter.data_getter = self.get
         self.toolbox.addItem(self.fitter, "Fitter")
         return
 
@@ -288,6 +474,7 @@ class LinePlotWidget(BasePlotWidget):
         return
 
     def remove_trace(self, tracename):
+        self.decimated.pop(tracename, None)
         for item in self.traces.pop(tracename):
             self.plot_item.removeItem(item)
         self.legend.removeItem(tracename)
@@ -319,7 +506,15 @@ class LinePlotWidget(BasePlotWidget):
             ys = np.array(ys)
         elif not isinstance(ys, np.ndarray):
             ys = ys.values
-        trace.setData(x=xs, y=ys, **kwargs)
+        if not self.decimation is None and len(xs) > self.decimation_threshold:
+            if not tracename in self.decimated:
+                self.decimated[tracename] = [Decimated_Trace(), kwargs]
+            self.decimated[tracename][0].set(xs, ys)
+            self.decimated[tracename][1] = kwargs
+            self.render_decimated(tracenames=[tracename])
+        else:
+            self.decimated.pop(tracename, None)
+            trace.setData(x=xs, y=ys, **kwargs)
         if yerrs is not None:
             if trace_err is None:
                 error_bar_params = {
@@ -340,7 +535,27 @@ class LinePlotWidget(BasePlotWidget):
                 trace_err.setData(x=xs, y=ys, top=ytops, bottom=ybottoms, beam=0.0)
         return
 
+    def render_decimated(self, *args, tracenames=None):
+        """Redraw the decimated traces for the current view range"""
+        if self._rendering or len(self.decimated) == 0:
+            return
+        self._rendering = True
+        try:
+            vb = self.plot_item.getViewBox()
+            # When the x axis is auto-ranging, the range follows the data so it can't be used for clipping
+            x_range = vb.viewRange()[0] if self.clip_to_view and not vb.state['autoRange'][0] else None
+            width = max(int(vb.width()), 100)
+            for tracename in (self.decimated if tracenames is None else tracenames):
+                dec, kwargs = self.decimated[tracename]
+                xs, ys = dec.render(x_range=x_range, width=width)
+                self.traces[tracename][0].setData(x=xs, y=ys, **kwargs)
+        finally:
+            self._rendering = False
+
     def get(self, tracename):
+        if tracename in self.decimated:
+            dec = self.decimated[tracename][0]
+            return dec.xs.astype(np.float64), dec.ys.astype(np.float64)
         pditem, _ = self.traces[tracename]
         x, y = pditem.getData()
         if x is None or y is None:
@@ -599,6 +814,8 @@ def fit_func(xs, m=1, y0=0):
         self.w = w
         self.traces = dict()
         self.fits = dict()
+        # Callable returning the full (xs, ys) of a trace (the plotted data might be decimated)
+        self.data_getter = None
         self.init_ui()
         return
 
@@ -692,8 +909,11 @@ def fit_func(xs, m=1, y0=0):
 
     def compile_and_fit(self):
         selected_trace_name = self.traces_list.currentText()
-        trace, _ = self.traces[selected_trace_name]
-        plot_xs, plot_ys = trace.xData, trace.yData
+        if self.data_getter is None:
+            trace, _ = self.traces[selected_trace_name]
+            plot_xs, plot_ys = trace.xData, trace.yData
+        else:
+            plot_xs, plot_ys = self.data_getter(selected_trace_name)
 
         # Execute the code
         glob = globals()
@@ -26,7 +26,7 @@ class SpinBox(_SpinBox):
             kwargs.update(opts)
             value *= factor
         super().__init__(parent=parent, value=value, **kwargs)
-        self.setMaximumHeight(1e6)
+        self.setMaximumHeight(int(1e6))
         return
 
     def getValue(self):
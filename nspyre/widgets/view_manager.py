@@ -5,8 +5,8 @@ from nspyre.widgets.plotting import LinePlotWidget, HeatmapPlotWidget
 from nspyre.widgets.splitter_widget import Splitter, SplitterOrientation
 # from nspyre.utils import connect_to_master
 from nspyre.mongo_listener import Synched_Mongo_Database
-from nspyre.views import Spyrelet_Views
-from nspyre.utils import cleanup_register, join_nspyre_path, custom_decode
+from nspyre.views import Spyrelet_Views, Incremental_State
+from nspyre.utils import cleanup_register, join_nspyre_path, custom_decode, get_class_from_str
 from nspyre.widgets.image import ImageWidget
 from nspyre.widgets.code_editor import Scintilla_Code_Editor, Monokai_Python_Lexer
 import pymongo
@@ -17,6 +17,99 @@ import time
 import inspect
 import traceback
 import textwrap
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+def run_spyrelet_view(spyrelet_class, view_name, df, cache):
+    """Evaluate a view by name (this is used by the process pool, since the view functions can't be pickled directly)"""
+    view = getattr(get_class_from_str(spyrelet_class), view_name)
+    return view.update_fun(df, cache)
+
+def run_custom_view(source, df, cache):
+    """Evaluate the plot function of a custom view from its source (used by the process pool)"""
+    namespace = dict()
+    exec(source, namespace)
+    return namespace['plot'](df, cache)
+
+
+def set_heatmap(w, result):
+    """
+    Plot2D views return either a full image or a dict {'shape':(rows, columns), 'rows':{row_index:row_data}} of rows to update
+    (with an optional 'id', the image is cleared when the id changes)
+    """
+    if isinstance(result, dict) and 'rows' in result:
+        w.set_rows(result['rows'], result['shape'], buffer_id=result.get('id'))
+    else:
+        w.set(np.array(result))
+
+
+class View_Executor(QtCore.QObject):
+    """
+    Evaluates the view functions either synchronously on the GUI thread (mode='gui'), in a thread pool (mode='thread')
+    or in a process pool (mode='process', for GIL bound code).
+
+    In the worker modes the view function receives a snapshot of the DataFrame and of the cache, and only the result is
+    posted back to the GUI thread where the view renders it.  A computation which is superseded by a newer one for the same view
+    is cancelled if it has not started yet, and its result is discarded otherwise.
+    """
+    finished = QtCore.pyqtSignal(object, object, object, object, object) # (view, job_id, future, df, cache)
+
+    def __init__(self, mode='gui', max_workers=None, parent=None):
+        super().__init__(parent=parent)
+        if not mode in ['gui', 'thread', 'process']:
+            raise ValueError("Invalid execution mode: {} (must be 'gui', 'thread' or 'process')".format(mode))
+        self.mode = mode
+        if mode == 'thread':
+            self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        elif mode == 'process':
+            self.pool = ProcessPoolExecutor(max_workers=max_workers)
+        else:
+            self.pool = None
+        self.job_count = 0
+        self.pending = dict() # view -> (job_id, future)
+        self.stats = {'submitted':0, 'completed':0, 'superseded':0}
+        self.finished.connect(self._deliver, QtCore.Qt.QueuedConnection)
+
+    def submit(self, view, df, cache):
+        # Incremental views only process the new rows (and keep a state), so they are always evaluated inline
+        if self.pool is None or getattr(view, 'incremental', False):
+            view.update(df, cache)
+            return
+        if view in self.pending:
+            _, old = self.pending.pop(view)
+            old.cancel()
+            self.stats['superseded'] += 1
+        if self.mode == 'thread':
+            # The cached DataFrame is shared with the synched database, so give the worker its own copy
+            df = df.copy() if not df is None else None
+            fun, args = view.update_fun, (df, cache)
+        else:
+            fun, args = view.process_job(df, cache)
+        self.job_count += 1
+        job_id = self.job_count
+        future = self.pool.submit(fun, *args)
+        self.pending[view] = (job_id, future)
+        self.stats['submitted'] += 1
+        future.add_done_callback(lambda f: self.finished.emit(view, job_id, f, df, cache))
+
+    @QtCore.pyqtSlot(object, object, object, object, object)
+    def _deliver(self, view, job_id, future, df, cache):
+        if not view in self.pending or self.pending[view][0] != job_id or future.cancelled():
+            return
+        self.pending.pop(view)
+        self.stats['completed'] += 1
+        if not future.exception() is None:
+            traceback.print_exception(type(future.exception()), future.exception(), future.exception().__traceback__)
+            return
+        if view.is_updating:
+            try:
+                view.render(future.result(), df, cache)
+            except:
+                traceback.print_exc()
+
+    def shutdown(self):
+        if not self.pool is None:
+            self.pool.shutdown(wait=False)
+
 
 class CustomView():
     def __init__(self, code_editor, w1D, w2D, plot_layout, initial_df, initial_cache):
@@ -71,23 +164,31 @@ class CustomView():
         self.valid_code = True
         self.update(self.last_df, self.last_cache)
 
+    def process_job(self, df, cache):
+        return run_custom_view, (self._source, df, cache)
+
     def update(self, df, cache):
         self.last_df = df
         self.last_cache = cache
         if self.is_updating and self.valid_code:
-            if self.plot_type == '1D':
-                traces = self.update_fun(df, cache)
-                for name, data in traces.items():
-                    self.w.set(name, xs=data[0], ys=data[1])
-            elif self.plot_type == '2D':
-                im = np.array(self.update_fun(df, cache))
-                self.w.set(im)
+            self.render(self.update_fun(df, cache), df, cache)
+
+    def render(self, result, df, cache):
+        self.last_df = df
+        self.last_cache = cache
+        if self.plot_type == '1D':
+            for name, data in result.items():
+                self.w.set(name, xs=data[0], ys=data[1])
+        elif self.plot_type == '2D':
+            set_heatmap(self.w, result)
 
 class BaseView():
     def __init__(self, view, w):
         self.view = view
         self.is_updating = False
         self.update_fun = view.update_fun
+        self.incremental = view.incremental
+        self.reset_state()
         self.init_formatter = view.get_formatter(self.w, 'init')
         self.update_formatter = view.get_formatter(self.w, 'update')
         # if not self.init_formatter is None:
@@ -97,18 +198,41 @@ class BaseView():
         self.w.clear()
         if not self.init_formatter is None:
             self.init_formatter(self.w)
+        # The widget is shared between views, so an incremental view needs to start from scratch
+        self.reset_state()
         self.is_updating = True
 
     def stop_updating(self):
         self.is_updating = False
 
-    # def update(self, df):
-    #     if self.is_updating:
-    #         traces = self.update_fun(df)
-    #         for name, data in traces.items():
-    #             self.w.set(name, xs=data[0], ys=data[1])
-    #         if not self.update_formatter is None:
-    #             self.update_formatter(self.w, df)
+    def reset_state(self):
+        """Forget the state of an incremental view (the next update will process all the rows)"""
+        self.state = Incremental_State()
+        self.n_seen = 0
+        self.data_version = None
+
+    def process_job(self, df, cache):
+        return run_spyrelet_view, (self.view.spyrelet_class, self.view.name, df, cache)
+
+    def update(self, df, cache):
+        if self.is_updating:
+            if self.incremental:
+                n = 0 if df is None else len(df)
+                version = None if df is None else df.attrs.get('version')
+                if n < self.n_seen or (self.n_seen and version != self.data_version):
+                    # The data was cleared or some rows were modified (not only appended), so start over
+                    self.reset_state()
+                new_rows = None if df is None else df.iloc[self.n_seen:]
+                self.n_seen = n
+                self.data_version = version
+                self.state.next_batch(new_rows, df)
+                result = self.update_fun(new_rows, self.state, cache)
+            else:
+                result = self.update_fun(df, cache)
+            self.render(result, df, cache)
+
+    def render(self, result, df, cache):
+        raise NotImplementedError
 
     def get_source(self):
         return textwrap.dedent(inspect.getsource(self.update_fun))
@@ -123,13 +247,11 @@ class LinePlotView(BaseView):
             self.w = w
         super().__init__(view, self.w)
             
-    def update(self, df, cache):
-        if self.is_updating:
-            traces = self.update_fun(df, cache)
-            for name, data in traces.items():
-                self.w.set(name, xs=data[0], ys=data[1])
-            if not self.update_formatter is None:
-                self.update_formatter(self.w, df, cache)
+    def render(self, traces, df, cache):
+        for name, data in traces.items():
+            self.w.set(name, xs=data[0], ys=data[1])
+        if not self.update_formatter is None:
+            self.update_formatter(self.w, df, cache)
 
 class HeatmapPlotView(BaseView):
     def __init__(self, view, w=None):
@@ -140,20 +262,35 @@ class HeatmapPlotView(BaseView):
         else:
             self.w = w
         super().__init__(view, self.w)
-            
-    def update(self, df, cache):
+
+    def reset_state(self):
+        super().reset_state()
         if self.is_updating:
-            im = np.array(self.update_fun(df, cache))
-            self.w.set(im)
-            if not self.update_formatter is None:
-                self.update_formatter(self.w, df, cache)
+            # The rows written in place belong to the previous state
+            self.w.reset_rows()
+            
+    def render(self, im, df, cache):
+        set_heatmap(self.w, im)
+        if not self.update_formatter is None:
+            self.update_formatter(self.w, df, cache)
 
 # class CustomView(QtWidgets.QWidget):
 #     def __init__(self, )
 
 
 class View_Manager(QtWidgets.QWidget):
-    def __init__(self, mongodb_addr=None, parent=None, db_name='Spyre_Live_Data', react_to_drop=False, db=None):
+    """
+    Widget which displays the views of the spyrelets in the live database.
+
+    Row updates coming from the database only mark the collection as dirty.  A timer running at <update_rate> Hz then re-evaluates
+    the visible views of the dirty collections once per tick, so a burst of acquired rows results in a single redraw.
+    The number of received, rendered and merged (coalesced) updates is available from get_update_stats.
+
+    The view functions are evaluated on the GUI thread by default.  With exec_mode='thread' or 'process' they are evaluated
+    in a pool of workers instead (see View_Executor), which keeps the GUI responsive with heavy views.
+    """
+    def __init__(self, mongodb_addr=None, parent=None, db_name='Spyre_Live_Data', react_to_drop=False, db=None, update_rate=20,
+                 exec_mode='gui', max_workers=None):
         super().__init__(parent=parent)
         if db is None:
             self.db = Synched_Mongo_Database(db_name, mongodb_addr=mongodb_addr)
@@ -168,6 +305,14 @@ class View_Manager(QtWidgets.QWidget):
         self.timer.timeout.connect(self.update_colors)
         self.timer.start(100)
         self.fade_rate = 2
+
+        # Coalesce the row updates and refresh the views at most at update_rate
+        self.dirty = set()
+        self.update_stats = {'received':0, 'rendered':0, 'merged':0}
+        self.update_timer = QtCore.QTimer(self)
+        self.update_timer.timeout.connect(self.process_dirty)
+        self.set_update_rate(update_rate)
+        self.executor = View_Executor(mode=exec_mode, max_workers=max_workers, parent=self)
         
         layout = QtWidgets.QHBoxLayout()
         # Build tree
@@ -229,34 +374,79 @@ class View_Manager(QtWidgets.QWidget):
         #Connect db signals
         self.db.col_added.connect(self.add_col)
         self.db.updated_row.connect(self._update_plot)
+        self.db.col_dropped.connect(self.reset_col_state)
+        self.db.db_dropped.connect(self.reset_all_states)
         if react_to_drop:
             self.db.col_dropped.connect(self.del_col)
 
+    def set_update_rate(self, update_rate):
+        """Set the maximum rate (in Hz) at which the views are re-evaluated"""
+        self.update_rate = update_rate
+        self.update_timer.start(int(1000/update_rate))
+
+    def get_update_stats(self):
+        """Returns the number of row updates received, the number of view evaluations and the number of updates which were merged"""
+        stats = dict(self.update_stats)
+        stats.update({'executor_'+k:val for k, val in self.executor.stats.items()})
+        return stats
+
     def _update_plot(self, col_name, row):
-        if col_name != 'Register':
-            self.last_updated[col_name] = time.time()
-        self.update_plot(col_name, row)
+        if col_name == 'Register':
+            self.add_col(row.name)
+            return
+        self.last_updated[col_name] = time.time()
+        self.update_stats['received'] += 1
+        if col_name in self.dirty:
+            self.update_stats['merged'] += 1
+        else:
+            self.dirty.add(col_name)
+
+    def process_dirty(self):
+        dirty, self.dirty = self.dirty, set()
+        for col_name in dirty:
+            if col_name in self.views:
+                try:
+                    self.update_plot(col_name, None)
+                except:
+                    traceback.print_exc()
+
+    def reset_col_state(self, col_name):
+        """Reset the state of the incremental views of a collection (when it is dropped)"""
+        for view in self.views.get(col_name, {}).values():
+            if isinstance(view, BaseView):
+                view.reset_state()
+
+    def reset_all_states(self):
+        for col_name in self.views:
+            self.reset_col_state(col_name)
+
+    def get_cache(self, col_name):
+        reg = self.db.get_df('Register')
+        if col_name in reg.index and 'cache' in reg.loc[col_name] and not reg.loc[col_name]['cache'] is np.nan:
+            return custom_decode(reg.loc[col_name]['cache'])
+        return {}
 
     def update_plot(self, col_name, row):
         if col_name == 'Register':
             self.add_col(row.name)
             return
-        for name, view in self.views[col_name].items():
-            if col_name in self.db.get_df('Register').index and 'cache' in self.db.get_df('Register').loc[col_name] and not self.db.get_df('Register').loc[col_name]['cache'] is np.nan:
-                cache = custom_decode(self.db.get_df('Register').loc[col_name]['cache'])
-            else:
-                cache = {}
-            view.update(self.db.get_df(col_name), cache)
+        visible = [view for view in self.views[col_name].values() if view.is_updating]
+        if len(visible) == 0:
+            return
+        df, cache = self.db.get_df(col_name), self.get_cache(col_name)
+        for view in visible:
+            self.executor.submit(view, df, cache)
+            self.update_stats['rendered'] += 1
         
         
     def add_col(self, col_name, try_update=True):
         if col_name == 'Register':
             return
+        if col_name in self.views:
+            return
         sclass = self.db.get_df('Register').loc[col_name]['class']
         spyrelet_views = Spyrelet_Views(sclass)
         
-        if col_name in self.views:
-            return
         top = QtWidgets.QTreeWidgetItem(self.tree, [col_name])
         self.default_color = top.background(0) # This is used to remember the default color when instanciating (to restore in update_color)
 
@@ -287,10 +477,7 @@ class View_Manager(QtWidgets.QWidget):
         for i in range(100):
             name = name_template.format(i)
             if not name in self.views[col_name]:
-                if col_name in self.db.get_df('Register').index and 'cache' in self.db.get_df('Register').loc[col_name] and not self.db.get_df('Register').loc[col_name]['cache'] is np.nan:
-                    cache = custom_decode(self.db.get_df('Register').loc[col_name]['cache'])
-                else:
-                    cache = {}
+                cache = self.get_cache(col_name)
                 self.views[col_name][name] = CustomView(self.code_editor, self.common_lineplotwidget, self.common_heatmapplotwidget, self.plot_layout, self.db.get_df(col_name), cache)
                 self.items[col_name][name] = QtWidgets.QTreeWidgetItem(0)
                 self.items[col_name][name].setText(0, name)
@@ -310,6 +497,7 @@ class View_Manager(QtWidgets.QWidget):
         self.views.pop(col_name)
         self.items.pop(col_name)
         self.last_updated.pop(col_name)
+        self.dirty.discard(col_name)
     
     def get_view_name(self, item):
             if item is None:
@@ -351,6 +539,10 @@ class View_Manager(QtWidgets.QWidget):
         except:
             pass
 
+    def closeEvent(self, ev):
+        self.executor.shutdown()
+        super().closeEvent(ev)
+
     def keyPressEvent(self, ev):
         if type(ev)==QtGui.QKeyEvent:
             sname, vname = self.get_view_name(self.tree.currentItem())
@@ -0,0 +1,100 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from nspyre.columnar import Columnar_Buffer, Keyed_Columnar_Buffer
+
+
+ROWS = {
+    'int': [{'x':1}, {'x':2}],
+    'float': [{'x':1.0}, {'x':2.5}],
+    'int_float': [{'x':1}, {'x':2.5}],
+    'float_none': [{'x':1.0}, {'x':None}],
+    'int_none': [{'x':1}, {'x':None}, {'x':3}],
+    'none_float': [{'x':None}, {'x':2.0}],
+    'bool': [{'x':True}, {'x':False}],
+    'bool_none': [{'x':True}, {'x':None}],
+    'str': [{'x':'a'}, {'x':'b'}],
+    'int_str': [{'x':1}, {'x':'b'}],
+    'missing': [{'x':1}, {'y':2.0}, {'x':3, 'y':4.0}],
+    'late_int': [{'y':0.5}, {'x':1, 'y':0.5}],
+}
+
+
+@pytest.mark.parametrize('name', sorted(ROWS))
+def test_dtypes_match_pandas(name):
+    rows = ROWS[name]
+    buf = Columnar_Buffer()
+    for row in rows:
+        buf.append(row)
+    df = buf.to_dataframe()
+    expected = pd.DataFrame(rows)
+    assert list(df.columns) == list(expected.columns)
+    for col in expected.columns:
+        assert df[col].dtype == expected[col].dtype, col
+    pd.testing.assert_frame_equal(df, expected, check_like=True)
+
+
+def test_none_in_numeric_column_is_nan():
+    buf = Columnar_Buffer()
+    for x in [1, None, 3]:
+        buf.append({'x':x, 'g':x is None})
+    df = buf.to_dataframe()
+    assert df['x'].dtype == np.float64
+    assert np.isnan(df['x'][1])
+    assert df.groupby('g')['x'].mean()[False] == 2
+
+
+def test_growth():
+    buf = Columnar_Buffer()
+    for i in range(1000):
+        buf.append({'i':i, 'f':i/2})
+        if i % 97 == 0:
+            assert len(buf.to_dataframe()) == i+1
+    df = buf.to_dataframe()
+    assert df['i'].tolist() == list(range(1000))
+    assert df['f'].tolist() == [i/2 for i in range(1000)]
+    assert list(df.index) == list(range(1000))
+
+
+def test_to_dataframe_does_not_copy():
+    buf = Columnar_Buffer()
+    for i in range(10):
+        buf.append({'i':i})
+    df = buf.to_dataframe()
+    assert np.shares_memory(df['i'].to_numpy(), buf.column('i'))
+    assert np.shares_memory(buf.to_dataframe()['i'].to_numpy(), df['i'].to_numpy())
+    buf.append({'i':10})
+    df2 = buf.to_dataframe()
+    assert len(df) == 10 and len(df2) == 11
+
+
+def test_modifying_the_dataframe_does_not_change_the_buffer():
+    buf = Columnar_Buffer()
+    for i in range(3):
+        buf.append({'x':float(i), 's':str(i)})
+    df = buf.to_dataframe()
+    df.loc[0, 'x'] = 99
+    df.loc[1, 's'] = 'z'
+    df['y'] = 1
+    with pytest.raises(ValueError):
+        df['x'].to_numpy()[2] = 5
+    assert buf.column('x').tolist() == [0.0, 1.0, 2.0]
+    assert buf.column('s').tolist() == ['0', '1', '2']
+    df = buf.to_dataframe()
+    assert list(df.columns) == ['x', 's']
+    assert df['x'].tolist() == [0.0, 1.0, 2.0]
+
+
+def test_keyed_update_does_not_change_returned_dataframe():
+    buf = Keyed_Columnar_Buffer()
+    for i in range(5):
+        buf.append({'_id':i, 'x':float(i)})
+    df = buf.to_dataframe()
+    buf.set_value(2, 'x', 20.0)
+    buf.append({'_id':3, 'x':30.0})
+    assert df.loc[2, 'x'] == 2.0 and df.loc[3, 'x'] == 3.0
+    df2 = buf.to_dataframe()
+    assert df2.loc[2, 'x'] == 20.0 and df2.loc[3, 'x'] == 30.0
+    buf.delete(0)
+    assert list(buf.to_dataframe().index) == [1, 2, 3, 4]
@@ -0,0 +1,61 @@
+import json
+import numpy as np
+import pandas as pd
+import pytest
+
+from nspyre import data_handling
+from nspyre.utils import decode_row
+
+
+class Fake_Collection(list):
+    def update_one(self, filter, update, upsert=False):
+        self.append(update['$set'])
+
+    def insert_many(self, docs):
+        self.extend(docs)
+
+
+class Fake_Database(dict):
+    def __missing__(self, name):
+        return self.setdefault(name, Fake_Collection())
+
+
+class Fake_Client(dict):
+    def __missing__(self, name):
+        return self.setdefault(name, Fake_Database())
+
+    def drop_database(self, name):
+        self.pop(name, None)
+
+
+@pytest.mark.parametrize('array_encoding', ['binary', 'list'])
+def test_load_data_keeps_ragged_and_mixed_lists(tmp_path, monkeypatch, array_encoding):
+    data = pd.DataFrame({'x':[0, 1, 2], 'trace':[[1.0, 2.0], [3.0, 4.0], [5.0, 6.0]], 'ragged':[[1, 2], [3], [[4, 5], [6]]],
+                         'mixed':[[1, 'a'], [2, 'b'], [3, None]]})
+    filename = str(tmp_path/'data.json')
+    with open(filename, 'w') as f:
+        json.dump({'spyrelet_name':'s', 'spyrelet_class':'module.S', 'data_col':list(data.columns), 'children':{},
+                   'data':data.to_json(orient='values')}, f)
+    client = Fake_Client()
+    monkeypatch.setattr(data_handling, 'get_mongo_client', lambda addr=None: client)
+
+    data_handling.load_data(filename, load_to_mongo=True, array_encoding=array_encoding)
+    docs = client['Spyre_Data_Loaded']['s']
+    assert client['Spyre_Data_Loaded']['Register'] == [{'_id':'s', 'class':'module.S'}]
+    assert len(docs) == 3
+    for doc, (_, row) in zip(docs, data.iterrows()):
+        decoded = decode_row(dict(doc))
+        for col in ['trace', 'ragged', 'mixed']:
+            val = decoded[col]
+            assert (val.tolist() if isinstance(val, np.ndarray) else val) == row[col]
+        assert isinstance(decoded['trace'], np.ndarray) == (array_encoding == 'binary')
+    # The lists which aren't rectangular numeric arrays are kept as they are
+    assert docs[2]['ragged'] == [[4, 5], [6]]
+    assert [doc['mixed'] for doc in docs] == [[1, 'a'], [2, 'b'], [3, None]]
+
+def test_encode_record():
+    record = data_handling.encode_record({'a':np.arange(3), 'b':np.array([1, 'a'], dtype=object), 'c':[True, False], 'd':'text'})
+    assert record['a']['__type__'] == 'ndarray'
+    assert record['b'] == [1, 'a']
+    assert record['c']['dtype'] == np.dtype(bool).str
+    assert record['d'] == 'text'
@@ -0,0 +1,68 @@
+import threading
+
+from nspyre import instrument_manager
+from nspyre.instrument_manager import Instrument_Manager
+
+
+class Fake_Client():
+    def __init__(self):
+        self.reset_threads = list()
+
+    def describe(self):
+        return {'name':'test', 'mongodb':None, 'instr':{}}
+
+    def reset_socket(self):
+        self.reset_threads.append(threading.current_thread())
+
+
+def test_describe_keeps_the_socket_of_the_caller():
+    client = Fake_Client()
+    manager = Instrument_Manager([client])
+    manager.refresh()
+    assert client.reset_threads == []
+
+
+def test_parallel_describe_resets_the_pool_sockets():
+    clients = [Fake_Client(), Fake_Client()]
+    manager = Instrument_Manager(clients)
+    for client in clients:
+        assert len(client.reset_threads) == 1
+        assert not client.reset_threads[0] is threading.current_thread()
+
+
+class Fake_Watcher():
+    def __init__(self):
+        self.stopped = False
+
+    def stop(self, wait=True):
+        self.stopped = True
+
+
+def test_close_stops_the_watchers():
+    manager = Instrument_Manager([Fake_Client()])
+    watcher = Fake_Watcher()
+    manager.clients[0]['watcher'] = watcher
+    manager.close()
+    assert watcher.stopped and not 'watcher' in manager.clients[0]
+
+
+class Fake_Device():
+    def __init__(self, info, schema):
+        self.info, self.schema = info, schema
+        self._cache = Fake_Watcher()
+
+
+def test_proxies_are_replaced_when_the_schema_changes(monkeypatch):
+    monkeypatch.setattr(instrument_manager, 'load_remote_device', lambda zmq, dname, mongo_col=None, info=None, schema=None: Fake_Device(info, schema))
+    manager = Instrument_Manager([Fake_Client()])
+    client = manager.clients[0]
+    desc = {'name':'test', 'mongodb':None, 'instr':{'dev':{'info':{'class':'a.B'}, 'schema':{'feats':{'idn':{'read_once':True}}}}}}
+    manager.load_description(client, desc)
+    dev = manager.instr['dev']['dev']
+    # Same device, the proxy (and its cached values) is kept
+    manager.load_description(client, desc)
+    assert manager.instr['dev']['dev'] is dev
+    # Same info but a different schema
+    desc['instr']['dev'] = {'info':{'class':'a.B'}, 'schema':{'feats':{'idn':{'read_once':True}, 'power':{}}}}
+    manager.load_description(client, desc)
+    assert not manager.instr['dev']['dev'] is dev and dev._cache.stopped
@@ -0,0 +1,805 @@
+import concurrent.futures
+import queue
+import socket
+import threading
+import time
+import numpy as np
+import pytest
+import zmq
+from lantz import Q_, Driver, Feat, DictFeat, Action
+
+from nspyre import instrument_server
+from nspyre.instrument_server import Instrument_Server, Instrument_Server_Client, Mirror_Writer, Feat_Cache
+from nspyre.instrument_server import serialize, serialize_frames, deserialize_frames, MULTIPART_MIN_BYTES
+
+
+class Guarded_Driver(Driver):
+    """Driver which counts the calls overlapping with another call (to the same device or lock group)"""
+    def __init__(self, guard=None, delay=0.001):
+        super().__init__()
+        self.guard = {'active':0, 'overlaps':0, 'calls':0, 'lock':threading.Lock()} if guard is None else guard
+        self.delay = delay
+        self._frequency = 1.0
+
+    def _call(self):
+        g = self.guard
+        with g['lock']:
+            g['active'] += 1
+            g['calls'] += 1
+            if g['active'] > 1:
+                g['overlaps'] += 1
+        time.sleep(self.delay)
+        with g['lock']:
+            g['active'] -= 1
+
+    @Feat(units='Hz')
+    def frequency(self):
+        self._call()
+        return self._frequency
+
+    @frequency.setter
+    def frequency(self, val):
+        self._call()
+        self._frequency = val
+
+    @Action()
+    def double(self, x):
+        return 2*x
+
+    @Action()
+    def trace(self, n):
+        return np.arange(n, dtype=float)
+
+    @Action()
+    def wait(self, t):
+        time.sleep(t)
+        return t
+
+
+def free_port():
+    # Two consecutive free ports (the PUB socket of the monitors uses port+1)
+    while True:
+        with socket.socket() as s:
+            s.bind(('', 0))
+            port = s.getsockname()[1]
+        try:
+            with socket.socket() as s:
+                s.bind(('', port+1))
+            return port
+        except OSError:
+            pass
+
+
+def start_server(devices, **kwargs):
+    server = Instrument_Server('test', free_port(), **kwargs)
+    for dname, dev in devices.items():
+        server.publish_instr(dname, dev, {'class':'Guarded_Driver', 'args':[], 'kwargs':{}})
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, Instrument_Server_Client('localhost', server.port, recv_timeout=5000)
+
+
+def test_serialize_frames_round_trip():
+    big = np.arange(1000, dtype=np.float32).reshape(10, 100)
+    obj = {'small':np.arange(3), 'big':big, 'strided':big[:, ::2], 'q':Q_(np.linspace(0, 1, 500), 'V'),
+           'nested':[{'x':np.ones(200, dtype=complex)}, (1, 'a')], 'objects':np.array([1, 'a'], dtype=object), 'n':None}
+    frames = serialize_frames(obj)
+    # Only the large (non object) arrays get their own frame
+    assert len(frames) == 5
+    assert all(len(memoryview(f).cast('B')) >= MULTIPART_MIN_BYTES for f in frames[1:])
+    ans = deserialize_frames(frames)
+    for key in ['small', 'big', 'strided', 'objects']:
+        np.testing.assert_array_equal(ans[key], obj[key])
+        assert ans[key].dtype == obj[key].dtype and ans[key].shape == obj[key].shape
+    assert ans['q'].units == obj['q'].units
+    np.testing.assert_array_equal(ans['q'].m, obj['q'].m)
+    np.testing.assert_array_equal(ans['nested'][0]['x'], obj['nested'][0]['x'])
+    assert ans['nested'][1] == [1, 'a'] and ans['n'] is None
+
+
+def test_deserialize_frames_accepts_single_blobs_and_zmq_frames():
+    obj = {'a':np.arange(1000.0), 'b':'text'}
+    ans = deserialize_frames([serialize(obj)])
+    np.testing.assert_array_equal(ans['a'], obj['a'])
+    frames = [zmq.Frame(f) for f in serialize_frames(obj)]
+    ans = deserialize_frames(frames)
+    np.testing.assert_array_equal(ans['a'], obj['a'])
+    assert ans['b'] == 'text'
+
+
+@pytest.mark.parametrize('concurrent', [False, True])
+def test_multipart_client(concurrent):
+    server, client = start_server({'dev':Guarded_Driver()}, concurrent=concurrent)
+    client.multipart = True
+    np.testing.assert_array_equal(client.run_action('dev', 'trace', 100000), np.arange(100000, dtype=float))
+    client.multipart = False
+    np.testing.assert_array_equal(client.run_action('dev', 'trace', 100000), np.arange(100000, dtype=float))
+
+
+@pytest.mark.parametrize('concurrent', [False, True])
+def test_concurrent_mode_runs_devices_in_parallel(concurrent):
+    server, client = start_server({'a':Guarded_Driver(delay=0.2), 'b':Guarded_Driver(delay=0.2)}, concurrent=concurrent)
+    def get(dname):
+        Instrument_Server_Client('localhost', server.port, recv_timeout=5000).get_feat(dname, 'frequency')
+    threads = [threading.Thread(target=get, args=(dname,)) for dname in ['a', 'b']]
+    t = time.perf_counter()
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    dt = time.perf_counter() - t
+    assert (dt < 0.35) if concurrent else (dt >= 0.4)
+
+
+def test_concurrent_mode_keeps_the_order_of_a_device():
+    server, client = start_server({'dev':Guarded_Driver(delay=0)}, concurrent=True)
+    for i in range(50):
+        client.set_feat('dev', 'frequency', i)
+        assert client.get_feat('dev', 'frequency').m == i
+    assert client.run_action('dev', 'double', 21) == 42
+
+
+@pytest.mark.parametrize('concurrent', [False, True])
+def test_device_lock_shared_with_monitors(concurrent):
+    dev = Guarded_Driver()
+    server, client = start_server({'dev':dev}, concurrent=concurrent)
+    client.subscribe('dev', 'frequency', rate=1000)
+    for i in range(100):
+        client.get_feat('dev', 'frequency')
+        client.set_feat('dev', 'frequency', 1)
+    assert dev.guard['calls'] > 200
+    assert dev.guard['overlaps'] == 0
+
+
+@pytest.mark.parametrize('kwargs', [{'feat':'frequency', 'rate':0}, {'feat':'frequency', 'rate':-1}, {'feat':'nothing'},
+                                    {'feat':'frequency', 'key':1}, {'feat':'power'}, {'feat':'power', 'key':3}])
+def test_subscribe_rejects_invalid_requests(kwargs):
+    server, client = start_server({'dev':Schema_Driver()})
+    with pytest.raises(instrument_server.InstrumentServerError):
+        client.subscribe('dev', **kwargs)
+    with pytest.raises(instrument_server.InstrumentServerError):
+        client.subscribe('nodev', 'frequency')
+    assert client.list_subscriptions() == {}
+    # The server still works
+    client.subscribe('dev', 'power', key=1, rate=100)
+    assert client.get_feat('dev', 'frequency').m == 1.0
+
+
+def test_device_lock_shared_with_sequences():
+    dev = Guarded_Driver()
+    server, client = start_server({'dev':dev})
+    steps = [{'op':'loop', 'count':100, 'steps':[{'op':'get', 'dev':'dev', 'feat':'frequency'}, {'op':'emit'}]}]
+    seq = client.run_sequence(steps)
+    for i in range(50):
+        client.get_feat('dev', 'frequency')
+    assert len(seq.wait()) == 100
+    assert dev.guard['overlaps'] == 0
+
+
+def test_fetch_sequence_does_not_block_the_server():
+    server, client = start_server({'dev':Guarded_Driver()})
+    seq = client.run_sequence([{'op':'sleep', 'time':0.5}, {'op':'get', 'dev':'dev', 'feat':'frequency'}, {'op':'emit'}])
+    t = time.perf_counter()
+    for i in range(10):
+        assert seq.fetch() == []
+        client.ping()
+    assert time.perf_counter() - t < 0.2
+    assert len(seq.wait()) == 1 and seq.done
+    assert client.list_sequences() == []
+
+
+def test_sequence_blocks():
+    server, client = start_server({'dev':Guarded_Driver()})
+    steps = [{'op':'loop', 'var':'i', 'values':list(range(25)), 'steps':[{'op':'emit', 'vars':['i']}]}]
+    seq = client.run_sequence(steps, block_size=10)
+    time.sleep(0.1)
+    assert [len(rows) for rows in seq] == [10, 10, 5]
+
+
+def test_lock_groups_in_concurrent_mode():
+    guard = {'active':0, 'overlaps':0, 'calls':0, 'lock':threading.Lock()}
+    server, client = start_server({'a':Guarded_Driver(guard), 'b':Guarded_Driver(guard)}, concurrent=True, lock_groups={'a':'bus', 'b':'bus'})
+    def hammer(dname):
+        c = Instrument_Server_Client('localhost', server.port, recv_timeout=5000)
+        for i in range(50):
+            c.get_feat(dname, 'frequency')
+    threads = [threading.Thread(target=hammer, args=(dname,)) for dname in ['a', 'b', 'a', 'b']]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert guard['calls'] == 200 and guard['overlaps'] == 0
+
+
+class Fake_Collection():
+    def __init__(self, db, name):
+        self.db, self.name = db, name
+
+    def bulk_write(self, requests, ordered=True):
+        self.db.started.set()
+        self.db.release.wait()
+        if self.name in self.db.fail:
+            raise RuntimeError('write failed')
+        for req in requests:
+            doc = self.db.docs.setdefault(self.name, dict()).setdefault(req._filter['name'], dict())
+            doc.update(req._doc['$set'])
+
+    def drop(self):
+        self.db.docs.pop(self.name, None)
+
+
+class Fake_Database():
+    def __init__(self):
+        self.docs = dict()
+        self.fail = set()
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+    def __getitem__(self, name):
+        return Fake_Collection(self, name)
+
+
+def test_mirror_writer_coalesces_updates():
+    db = Fake_Database()
+    writer = Mirror_Writer(db, max_lag=0.05)
+    for i in range(100):
+        writer.set('sg', 'frequency', 'value', i)
+    writer.set('sg', 'volt', 'value', [0, 0])
+    writer.set('sg', 'volt', 'value.1', 5)
+    writer.flush()
+    assert db.docs['sg'] == {'frequency':{'value':99}, 'volt':{'value':[0, 5]}}
+    assert writer.n_updates == 102 and writer.n_writes == 1
+
+
+def test_mirror_writer_discard_waits_for_write_in_progress():
+    db = Fake_Database()
+    writer = Mirror_Writer(db, max_lag=0)
+    db.release.clear()
+    writer.set('sg', 'frequency', 'value', 1)
+    assert db.started.wait(5)
+    writer.set('sg', 'frequency', 'value', 2)
+    discarded = threading.Event()
+    def discard():
+        writer.discard('sg')
+        db['sg'].drop()
+        discarded.set()
+    threading.Thread(target=discard, daemon=True).start()
+    time.sleep(0.05)
+    # The write of the first update is still in progress
+    assert not discarded.is_set()
+    db.release.set()
+    assert discarded.wait(5)
+    writer.flush()
+    # Neither the update being written nor the pending one came back after the drop
+    assert not 'sg' in db.docs
+
+
+def test_mirror_writer_reports_errors_on_flush():
+    db = Fake_Database()
+    db.fail.add('bad')
+    writer = Mirror_Writer(db, max_lag=0)
+    writer.set('bad', 'frequency', 'value', 1)
+    writer.set('good', 'frequency', 'value', 1)
+    with pytest.raises(RuntimeError):
+        writer.flush()
+    assert db.docs['good'] == {'frequency':{'value':1}}
+    writer.flush()
+
+
+class Fake_Change_Stream():
+    def __init__(self, changes):
+        self.changes = changes
+        self.alive = True
+        self.resume_token = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.alive = False
+
+    def try_next(self):
+        try:
+            return self.changes.get(timeout=0.01)
+        except queue.Empty:
+            return None
+
+
+class Fake_Mirror_Database():
+    def __init__(self):
+        self.client = object()
+        self.name = 'Instrument_Server[test]'
+        self.changes = queue.Queue()
+        self.n_watch = 0
+
+    def watch(self, **kwargs):
+        self.n_watch += 1
+        return Fake_Change_Stream(self.changes)
+
+    def __getitem__(self, name):
+        col = type('Fake_Mirror_Collection', (), {})()
+        col.database, col.name = self, name
+        return col
+
+
+def wait_for(condition, timeout=5):
+    t = time.time()
+    while not condition():
+        assert time.time() - t < timeout
+        time.sleep(0.01)
+
+
+def test_feat_cache_shares_one_watcher_per_database():
+    db = Fake_Mirror_Database()
+    constant = Feat_Cache('a', mongo_col=db['a'])
+    constant.enable('idn', ttl=None)
+    caches = [Feat_Cache(dname, mongo_col=db[dname]) for dname in ['a', 'b']]
+    for cache in caches:
+        cache.enable('frequency', ttl=60)
+        cache.enable('power', ttl=60)
+        cache.put('frequency', 1.0)
+    assert len(instrument_server._MIRROR_WATCHERS) == 1
+    wait_for(lambda: db.n_watch == 1)
+
+    # Only the cache of the changed device is invalidated
+    db.changes.put({'ns':{'db':db.name, 'coll':'b'}, 'fullDocument':{'name':'frequency', 'value':2.0}})
+    wait_for(lambda: not caches[1].get('frequency')[0])
+    assert caches[0].get('frequency') == (True, 1.0)
+    # Unchanged values (like the mirror of our own set) stay cached
+    db.changes.put({'ns':{'db':db.name, 'coll':'a'}, 'fullDocument':{'name':'frequency', 'value':1.0}})
+    db.changes.put({'ns':{'db':db.name, 'coll':'b'}, 'fullDocument':None})
+    time.sleep(0.1)
+    assert caches[0].get('frequency') == (True, 1.0)
+
+    # The read_once values are only invalidated when the device is removed or added back
+    constant.put('idn', 'old')
+    db.changes.put({'ns':{'db':db.name, 'coll':'a'}, 'operationType':'update', 'fullDocument':{'name':'idn', 'value':'new'}})
+    time.sleep(0.1)
+    assert constant.get('idn') == (True, 'old')
+    db.changes.put({'ns':{'db':db.name, 'coll':'a'}, 'operationType':'insert', 'fullDocument':{'name':'idn', 'value':None}})
+    wait_for(lambda: not constant.get('idn')[0])
+    constant.put('idn', 'old')
+    db.changes.put({'ns':{'db':db.name, 'coll':'a'}, 'operationType':'drop'})
+    wait_for(lambda: not constant.get('idn')[0])
+
+    watcher = instrument_server.get_mirror_watcher(db)
+    constant.stop()
+    caches[0].stop()
+    assert watcher._thread.is_alive()
+    caches[1].stop()
+    assert instrument_server._MIRROR_WATCHERS == {}
+    assert not watcher._thread.is_alive()
+
+
+class Schema_Driver(Guarded_Driver):
+    def __init__(self):
+        super().__init__()
+        self._power = dict()
+
+    @Feat()
+    def idn(self):
+        return 'test'
+
+    @DictFeat(keys=[1, 2])
+    def power(self, key):
+        return self._power.get(key, 0)
+
+    @power.setter
+    def power(self, key, val):
+        self._power[key] = val
+
+
+class Fake_Schema_Client():
+    """Records the requests of a Remote_Device"""
+    def __init__(self):
+        self.calls = list()
+        self.values = {'frequency':Q_(1.0, 'Hz'), 'idn':'test'}
+
+    def get_feat(self, dname, feat):
+        self.calls.append(('get_feat', dname, feat))
+        return self.values[feat]
+
+    def set_feat(self, dname, feat, val):
+        self.calls.append(('set_feat', dname, feat, val))
+        self.values[feat] = val
+
+    def get_dictfeat(self, dname, feat, key):
+        self.calls.append(('get_dictfeat', dname, feat, key))
+        return 3
+
+    def set_dictfeat(self, dname, feat, key, val):
+        self.calls.append(('set_dictfeat', dname, feat, key, val))
+
+    def run_action(self, dname, action, *args, **kwargs):
+        self.calls.append(('run_action', dname, action, args, kwargs))
+        return 2*args[0]
+
+    def get_schema(self, dname):
+        raise AssertionError('The schema was given')
+
+
+def test_build_schema():
+    schema = instrument_server.build_schema(Schema_Driver)
+    assert schema['class'] == __name__ + '.Schema_Driver'
+    assert __name__ + '.Guarded_Driver' in schema['mro']
+    assert sorted(schema['actions']) == ['double', 'trace', 'wait']
+    assert schema['feats']['frequency']['type'] == 'feat'
+    assert schema['feats']['frequency']['units'] == 'Hz'
+    assert not schema['feats']['frequency']['readonly']
+    assert schema['feats']['idn']['readonly']
+    assert schema['feats']['power']['type'] == 'dictfeat'
+    assert schema['feats']['power']['keys'] == [1, 2]
+    # The schema is sent to the clients
+    assert instrument_server.deserialize(instrument_server.serialize(schema)) == schema
+
+
+class Loaded_Driver(Driver):
+    """Driver which records when it is initialized (or fails to)"""
+    def __init__(self, name, log, fail=False, delay=0.05):
+        super().__init__()
+        self.name, self.log, self.fail, self.delay = name, log, fail, delay
+
+    def initialize(self):
+        self.log.append(('start', self.name))
+        time.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError('{} failed'.format(self.name))
+        self.log.append(('end', self.name))
+
+
+def loaded_spec(name, log, depends_on=None, fail=False):
+    spec = {'class':__name__ + '.Loaded_Driver', 'kwargs':{'name':name, 'log':log, 'fail':fail}}
+    if not depends_on is None:
+        spec['depends_on'] = depends_on
+    return spec
+
+
+def test_parse_device_spec():
+    assert instrument_server.parse_device_spec(['a.B']) == {'class':'a.B', 'args':[], 'kwargs':{}, 'depends_on':[]}
+    assert instrument_server.parse_device_spec(['a.B', [1], {'x':2}]) == {'class':'a.B', 'args':[1], 'kwargs':{'x':2}, 'depends_on':[]}
+    spec = instrument_server.parse_device_spec({'class':'a.B', 'args':(1,), 'depends_on':'c'})
+    assert spec == {'class':'a.B', 'args':[1], 'kwargs':{}, 'depends_on':['c']}
+
+
+def test_load_devices_follows_the_dependencies():
+    server = Instrument_Server('test', free_port())
+    log = list()
+    # The dependent devices come first in the list
+    futures = server.load_devices({'c':loaded_spec('c', log, depends_on=['a', 'b']), 'b':loaded_spec('b', log, depends_on='a'),
+                                   'a':loaded_spec('a', log), 'd':loaded_spec('d', log)}, max_workers=4)
+    concurrent.futures.wait(futures.values())
+    assert all(f.exception() is None for f in futures.values())
+    for dname, deps in [('b', ['a']), ('c', ['a', 'b'])]:
+        for dep in deps:
+            assert log.index(('end', dep)) < log.index(('start', dname))
+    # The independent devices are loaded in parallel
+    assert log.index(('start', 'd')) < log.index(('end', 'a'))
+    assert sorted(server.instr) == ['a', 'b', 'c', 'd']
+    assert all(report['status'] == 'ready' for report in server.load_report.values())
+
+
+def test_load_devices_skips_the_dependents_of_a_failure():
+    server = Instrument_Server('test', free_port())
+    log = list()
+    futures = server.load_devices({'a':loaded_spec('a', log, fail=True), 'b':loaded_spec('b', log, depends_on='a'),
+                                   'c':loaded_spec('c', log, depends_on='b'), 'd':loaded_spec('d', log)})
+    concurrent.futures.wait(futures.values())
+    assert server.load_report['a']['status'] == 'failed' and 'a failed' in server.load_report['a']['error']
+    # The skip propagates through the chain of dependencies
+    assert server.load_report['b']['status'] == 'skipped' and server.load_report['c']['status'] == 'skipped'
+    assert not ('start', 'b') in log and not ('start', 'c') in log
+    assert server.load_report['d']['status'] == 'ready'
+    assert list(server.instr) == ['d']
+
+
+def test_load_devices_rejects_unknown_and_circular_dependencies():
+    server = Instrument_Server('test', free_port())
+    log = list()
+    futures = server.load_devices({'a':loaded_spec('a', log, depends_on='b'), 'b':loaded_spec('b', log, depends_on='a'),
+                                   'c':loaded_spec('c', log, depends_on='nodev'), 'd':loaded_spec('d', log, depends_on='a'),
+                                   'e':loaded_spec('e', log)})
+    concurrent.futures.wait(futures.values())
+    assert list(futures) == ['e']
+    assert 'Circular dependency: a -> b -> a' in server.load_report['a']['error']
+    assert 'Circular dependency: b -> a -> b' in server.load_report['b']['error']
+    assert 'Unknown dependency: nodev' in server.load_report['c']['error']
+    assert 'Circular dependency' in server.load_report['d']['error']
+    assert [server.load_report[dname]['status'] for dname in 'abcde'] == ['failed']*4 + ['ready']
+    assert log == [('start', 'e'), ('end', 'e')]
+
+
+class Units_Driver(Driver):
+    def __init__(self):
+        super().__init__()
+        self._temperature = 300.0
+
+    @Feat(units='K')
+    def temperature(self):
+        return self._temperature
+
+    @temperature.setter
+    def temperature(self, val):
+        self._temperature = val
+
+
+def test_device_dispatch():
+    dev = Schema_Driver()
+    dispatch = instrument_server.Device_Dispatch(dev)
+    assert sorted(dispatch.feats) == ['frequency', 'idn', 'power']
+    assert sorted(dispatch.actions) == ['double', 'trace', 'wait']
+    assert dispatch.actions['double'](2) == 4
+    assert dispatch.schema == instrument_server.build_schema(Schema_Driver)
+
+    # The getter and setter partials go through the driver
+    freq = dispatch.feats['frequency']
+    assert freq.type == 'feat' and freq.keys is None and freq.key_index is None
+    freq.set(Q_(3.0, 'Hz'))
+    assert dev._frequency == 3.0 and freq.get() == Q_(3.0, 'Hz')
+
+    # The dictfeat keys are sorted and indexed (for the mirror)
+    power = dispatch.feats['power']
+    assert power.type == 'dictfeat' and power.keys == [1, 2] and power.key_index == {1:0, 2:1}
+    power.set(2, 5)
+    assert power.get(2) == 5 and dev._power == {2:5}
+
+    # Only the feats without a setter are readonly
+    assert dispatch.feats['idn'].readonly and not freq.readonly and not power.readonly
+    freq.check_writable('dev')
+    with pytest.raises(Exception, match='dev.idn is read-only'):
+        dispatch.feats['idn'].check_writable('dev')
+
+
+def test_feat_entry_to_base():
+    dispatch = instrument_server.Device_Dispatch(Units_Driver())
+    entry = dispatch.feats['temperature']
+    assert entry.to_base(Q_(4.0, 'K')) == 4.0
+    assert entry._factors == {}
+    assert entry.to_base(Q_(5.0, 'mK')) == pytest.approx(0.005)
+    assert entry.to_base(Q_(7.0, 'mK')) == pytest.approx(0.007)
+    # The factor of the multiplicative units is cached, not the one of the offset units
+    assert list(entry._factors.values()) == [pytest.approx(0.001)]
+    assert entry.to_base(Q_(0.0, 'degC')) == pytest.approx(273.15)
+    assert len(entry._factors) == 1
+    # Values without units are returned as they are
+    assert entry.to_base(4.0) == 4.0
+    assert instrument_server.Device_Dispatch(Schema_Driver()).feats['idn'].to_base('test') == 'test'
+
+
+def test_readonly_feats_are_rejected_by_the_server():
+    server, client = start_server({'dev':Schema_Driver()})
+    assert client.get_feat('dev', 'idn') == 'test'
+    with pytest.raises(instrument_server.InstrumentServerError, match='read-only'):
+        client.set_feat('dev', 'idn', 'other')
+    client.set_dictfeat('dev', 'power', 1, 3)
+    assert client.get_dictfeat('dev', 'power', 1) == 3
+
+
+def test_proxy_classes_are_shared():
+    schema = instrument_server.build_schema(Schema_Driver)
+    cls = instrument_server.get_proxy_class(schema)
+    assert instrument_server.get_proxy_class(instrument_server.deserialize(instrument_server.serialize(schema))) is cls
+    assert not instrument_server.get_proxy_class(schema, is_async=True) is cls
+    assert cls.__name__ == 'Remote_Schema_Driver'
+    assert cls.driver_isinstance(Guarded_Driver)
+    assert cls.driver_isinstance(__name__ + '.Schema_Driver')
+    assert not cls.driver_isinstance(Feat_Cache)
+
+
+def test_load_remote_device_from_schema():
+    schema = instrument_server.build_schema(Schema_Driver)
+    schema['class'] = 'not_a_module.Schema_Driver'
+    schema['feats']['idn']['read_once'] = True
+    client = Fake_Schema_Client()
+    dev = instrument_server.load_remote_device(client, 'dev', info={'class':schema['class']}, schema=schema)
+    assert dev.info == {'class':schema['class']}
+
+    assert dev.frequency == Q_(1.0, 'Hz')
+    dev.frequency = Q_(2.0, 'Hz')
+    assert dev.power[1] == 3
+    dev.power[2] = 4
+    assert dev.double(5) == 10
+    assert client.calls == [('get_feat', 'dev', 'frequency'), ('set_feat', 'dev', 'frequency', Q_(2.0, 'Hz')),
+                            ('get_dictfeat', 'dev', 'power', 1), ('set_dictfeat', 'dev', 'power', 2, 4),
+                            ('run_action', 'dev', 'double', (5,), {})]
+
+    # The read_once feats are only read once (without a mirror watcher)
+    del client.calls[:]
+    assert dev.idn == 'test' and dev.idn == 'test'
+    assert client.calls == [('get_feat', 'dev', 'idn')]
+    assert dev._cache.is_cached('idn') and not dev._cache._watched
+
+
+def test_load_remote_device_from_server():
+    server, client = start_server({'dev':Schema_Driver()})
+    dev = instrument_server.load_remote_device(client, 'dev')
+    assert dev.driver_isinstance(Schema_Driver)
+    dev.frequency = Q_(2.0, 'Hz')
+    assert dev.frequency == Q_(2.0, 'Hz')
+    dev.power[1] = 5
+    assert dev.power[1] == 5
+    assert dev.double(3) == 6
+
+
+@pytest.mark.parametrize('concurrent', [False, True])
+def test_async_client_matches_replies(concurrent):
+    server, _ = start_server({'a':Guarded_Driver(), 'b':Guarded_Driver()}, concurrent=concurrent)
+    client = instrument_server.Async_Instrument_Server_Client('localhost', server.port, recv_timeout=5000)
+    slow = client.run_action_async('a', 'wait', 0.2)
+    futures = [client.run_action_async('b', 'double', i) for i in range(50)]
+    assert [f.result() for f in futures] == [2*i for i in range(50)]
+    assert slow.result() == 0.2
+    with pytest.raises(instrument_server.InstrumentServerError):
+        client.run_action_async('nodev', 'double', 1).result()
+    # The blocking API goes through the same socket
+    assert client.get_feat('a', 'frequency').m == 1.0
+    client.close()
+
+
+def test_async_client_timeout():
+    server, _ = start_server({'dev':Guarded_Driver()}, concurrent=True)
+    client = instrument_server.Async_Instrument_Server_Client('localhost', server.port, recv_timeout=100)
+    late = client.run_action_async('dev', 'wait', 0.3)
+    with pytest.raises(instrument_server.ServerUnreachableError):
+        late.result()
+    # The late reply is dropped and doesn't mix with the next request
+    time.sleep(0.3)
+    assert client.run_action_async('dev', 'double', 2).result() == 4
+    client.close()
+
+    client = instrument_server.Async_Instrument_Server_Client('localhost', free_port(), recv_timeout=100)
+    with pytest.raises(instrument_server.ServerUnreachableError):
+        client.get_feat('dev', 'frequency')
+    client.close()
+
+
+def test_async_client_close():
+    server, _ = start_server({'dev':Guarded_Driver()}, concurrent=True)
+    client = instrument_server.Async_Instrument_Server_Client('localhost', server.port, recv_timeout=5000)
+    # The methods of the base class work (used by Instrument_Manager.describe_in_pool)
+    client.reset_socket()
+    pending = client.run_action_async('dev', 'wait', 0.5)
+    time.sleep(0.05)
+    client.close()
+    with pytest.raises(instrument_server.ServerUnreachableError):
+        pending.result(timeout=1)
+    with pytest.raises(instrument_server.ServerUnreachableError):
+        client.get_feat('dev', 'frequency')
+    assert client._wake_r.fileno() == -1 and client._wake_w.fileno() == -1
+    assert client.socket.closed
+    client.close()
+
+
+def test_batch_item_errors():
+    server, client = start_server({'dev':Guarded_Driver()})
+    calls = [['SET_FEAT', ['dev', 'frequency', Q_(2.0, 'Hz')], {}], ['RUN_ACTION', ['dev', 'nothing'], {}],
+             ['RUN_ACTION', ['dev', 'double', 3], {}], ['GET_FEAT', ['nodev', 'frequency'], {}]]
+    # The other calls are still executed
+    results = client.send_batch(calls)
+    assert len(results) == 4 and results[2] == 6
+    assert isinstance(results[1], instrument_server.InstrumentServerError)
+    assert isinstance(results[3], instrument_server.InstrumentServerError)
+    assert client.get_feat('dev', 'frequency') == Q_(2.0, 'Hz')
+
+    calls[0][1][2] = Q_(3.0, 'Hz')
+    results = client.send_batch(calls, stop_on_error=True)
+    assert len(results) == 2 and isinstance(results[1], instrument_server.InstrumentServerError)
+    with pytest.raises(instrument_server.InstrumentServerError):
+        client.send_batch(calls, raise_errors=True)
+    assert client.get_feat('dev', 'frequency') == Q_(3.0, 'Hz')
+
+
+def test_nested_batch_is_rejected():
+    server, client = start_server({'dev':Guarded_Driver()})
+    nested = ['BATCH', [[['RUN_ACTION', ['dev', 'double', 1], {}]]], {}]
+    results = client.send_batch([nested, ['RUN_ACTION', ['dev', 'double', 2], {}]])
+    assert isinstance(results[0], instrument_server.InstrumentServerError) and 'nested' in str(results[0])
+    assert results[1] == 4
+    with pytest.raises(instrument_server.InstrumentServerError, match='nested'):
+        client.send_batch([nested], raise_errors=True)
+
+
+def test_batch_context_manager():
+    server, client = start_server({'dev':Guarded_Driver()})
+    with client.batch() as b:
+        b.set_feat('dev', 'frequency', Q_(2.0, 'Hz'))
+        f = b.get_feat('dev', 'frequency')
+        d = b.run_action('dev', 'double', 4)
+    assert len(b) == 0
+    assert b.results[f] == Q_(2.0, 'Hz') and b.results[d] == 8
+
+    # Nothing is sent if the block raises
+    with pytest.raises(ZeroDivisionError):
+        with client.batch() as b:
+            b.set_feat('dev', 'frequency', Q_(5.0, 'Hz'))
+            1/0
+    assert b.results is None and len(b) == 1
+    assert client.get_feat('dev', 'frequency') == Q_(2.0, 'Hz')
+
+    # An empty batch doesn't send anything
+    with client.batch() as b:
+        pass
+    assert b.results == []
+
+
+def test_stats_include_batched_calls():
+    server, client = start_server({'dev':Guarded_Driver(delay=0.01)})
+    client.reset_stats()
+    client.get_feat('dev', 'frequency')
+    client.send_batch([['GET_FEAT', ['dev', 'frequency'], {}]]*3 + [['RUN_ACTION', ['dev', 'nothing'], {}]])
+    stats = {tuple(entry['key']):entry for entry in client.get_stats()}
+    feat = stats[('dev', 'GET_FEAT', 'frequency')]
+    assert feat['count'] == 4 and feat['errors'] == 0
+    assert feat['phases']['device']['mean'] >= 0.01
+    assert stats[('dev', 'RUN_ACTION', 'nothing')]['errors'] == 1
+    batch = stats[(None, 'BATCH', None)]
+    assert batch['count'] == 1
+    assert batch['phases']['device']['mean'] >= 0.03
+    assert set(batch['phases']) >= {'device', 'deserialize', 'serialize'}
+
+    overhead = {tuple(entry['key']):entry for entry in client.get_overhead()}
+    assert overhead[('dev', 'GET_FEAT', 'frequency')]['count'] == 1
+    assert overhead[('dev', 'GET_FEAT', 'frequency')]['server'] >= 0.01
+
+    client.reset_stats()
+    assert [tuple(entry['key']) for entry in client.get_stats()] == [(None, 'RESET_STATS', None)]
+    assert [tuple(entry['key']) for entry in client.stats.snapshot()] == [(None, 'RESET_STATS', None), (None, 'STATS', None)]
+
+
+def test_client_uses_one_socket_per_thread():
+    server, client = start_server({'a':Guarded_Driver(), 'b':Guarded_Driver()}, concurrent=True)
+    sockets, results = dict(), dict()
+    def run(dname):
+        sockets[dname] = client.get_socket()
+        results[dname] = client.run_action(dname, 'wait', 0.2)
+    threads = [threading.Thread(target=run, args=(dname,)) for dname in ['a', 'b']]
+    t = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Both requests were sent in parallel
+    assert time.time() - t < 0.35
+    assert results == {'a':0.2, 'b':0.2}
+    assert not sockets['a'] is sockets['b']
+    assert client.get_socket() is client.get_socket()
+    assert not client.get_socket() in sockets.values()
+    client.close()
+    # The sockets of the finished threads are closed
+    assert all(sock.closed for sock in sockets.values())
+
+
+def test_client_reconnects_after_a_timeout():
+    server, _ = start_server({'dev':Guarded_Driver()}, concurrent=True)
+    client = Instrument_Server_Client('localhost', server.port, recv_timeout=100)
+    sock = client.get_socket()
+    with pytest.raises(instrument_server.ServerUnreachableError):
+        client.run_action('dev', 'wait', 0.3)
+    assert sock.closed
+    time.sleep(0.3)
+    # A new socket is connected (the late reply isn't received by it)
+    assert client.run_action('dev', 'double', 2) == 4
+    assert not client.get_socket() is sock
+
+
+def test_client_close_does_not_close_the_sockets_in_use():
+    server, client = start_server({'dev':Guarded_Driver()}, concurrent=True)
+    done, results = threading.Event(), list()
+    def run():
+        sock = client.get_socket()
+        results.append(client.run_action('dev', 'wait', 0.2))
+        results.append(sock.closed)
+        done.wait()
+        # The socket is closed by its thread on the next request
+        results.append(client.run_action('dev', 'double', 2))
+        results.append(sock.closed and not client.get_socket() is sock)
+    thread = threading.Thread(target=run)
+    thread.start()
+    time.sleep(0.05)
+    main_sock = client.get_socket()
+    client.close()
+    assert main_sock.closed
+    time.sleep(0.3)
+    done.set()
+    thread.join()
+    assert results == [0.2, False, 4, True]
+    assert client.get_feat('dev', 'frequency').m == 1.0
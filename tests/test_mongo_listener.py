@@ -0,0 +1,141 @@
+import pymongo
+import pytest
+
+from nspyre import mongo_listener
+from nspyre.mongo_listener import Synched_Mongo_Collection
+
+
+# Documents of an Instrument_Server[...] mirror collection
+MIRROR_DOCS = [
+    {'_id':1, 'name':'idn', 'type':'feat', 'value':None, 'units':None},
+    {'_id':2, 'name':'frequency', 'type':'feat', 'value':None, 'units':'Hz'},
+    {'_id':3, 'name':'power', 'type':'dictfeat', 'value':[None, 2.0], 'units':'W'},
+]
+
+
+class Fake_Collection():
+    def __init__(self, docs):
+        self.docs = docs
+
+    def find(self):
+        return [dict(doc) for doc in self.docs]
+
+
+@pytest.fixture
+def synched_mirror(monkeypatch):
+    monkeypatch.setattr(mongo_listener, 'get_mongo_client', lambda addr=None: {'db':{'col':Fake_Collection(MIRROR_DOCS)}})
+    monkeypatch.setattr(mongo_listener.Mongo_Listenner, 'start', lambda self: None)
+    col = Synched_Mongo_Collection('db', 'col')
+    rows = list()
+    col.updated_row.connect(rows.append)
+    return col, rows
+
+
+def update(key, fields):
+    return {'operationType':'update', 'documentKey':{'_id':key}, 'updateDescription':{'updatedFields':fields}}
+
+
+def test_mirror_rows_keep_none(synched_mirror):
+    col, rows = synched_mirror
+    col._update_df(update(2, {'value':1.5}))
+    col._update_df(update(1, {'value':'IDN string'}))
+    col._update_df({'operationType':'insert', 'documentKey':{'_id':4}, 'fullDocument':{'_id':4, 'name':'offset', 'type':'feat', 'value':None, 'units':None}})
+    assert [dict(row) for row in rows] == [
+        {'name':'frequency', 'type':'feat', 'value':1.5, 'units':'Hz'},
+        {'name':'idn', 'type':'feat', 'value':'IDN string', 'units':None},
+        {'name':'offset', 'type':'feat', 'value':None, 'units':None},
+    ]
+    assert rows[0].name == 2
+    assert col.buffer.row(3)['value'] == [None, 2.0]
+
+
+class Fake_Signal():
+    def __init__(self):
+        self.emitted = list()
+
+    def emit(self, *args):
+        self.emitted.append(args)
+
+
+class Fake_Feat_Item():
+    def __init__(self):
+        self.set_requested = Fake_Signal()
+        self.childs = {0:None, 1:None}
+
+
+def test_mirror_rows_in_instrument_manager_widget(synched_mirror):
+    widget = pytest.importorskip('nspyre.widgets.instrument_manager')
+    from lantz import Q_
+    col, rows = synched_mirror
+    items = {name:Fake_Feat_Item() for name in ['idn', 'frequency', 'power']}
+    fake_widget = type('Fake_Widget', (), {'feat_items':{'dev':items}})()
+    col.updated_row.connect(lambda row: widget.Instrument_Manager_Widget._update_feat_value(fake_widget, 'dev', row))
+
+    col._update_df(update(1, {'value':'IDN string'}))
+    col._update_df(update(2, {'units':'Hz'}))
+    col._update_df(update(3, {'value.1':3.0}))
+    col._update_df(update(2, {'value':1.5}))
+    assert items['idn'].set_requested.emitted == [('IDN string',)]
+    # No value yet
+    assert items['frequency'].set_requested.emitted == [(None,), (Q_(1.5, 'Hz'),)]
+    assert items['power'].set_requested.emitted[0][1] == [None, Q_(3.0, 'W')]
+
+
+class Scripted_Change_Stream():
+    """Change stream which returns the changes of a script (None, a change with its token, or an exception to raise)"""
+    def __init__(self, script):
+        self.script = list(script)
+        self.alive = True
+        self.resume_token = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.alive = False
+
+    def try_next(self):
+        step = self.script.pop(0)
+        if isinstance(step, Exception):
+            raise step
+        if callable(step):
+            return step()
+        change, self.resume_token = step
+        return change
+
+
+class Scripted_Collection():
+    def __init__(self, scripts):
+        self.scripts = list(scripts)
+        self.name = 'col'
+        self.watch_kwargs = list()
+
+    def watch(self, **kwargs):
+        self.watch_kwargs.append(kwargs)
+        return Scripted_Change_Stream(self.scripts.pop(0))
+
+
+def test_listener_resumes_after_the_last_token(monkeypatch):
+    changes = [{'_id':{'_data':str(i)}, 'operationType':'insert', 'documentKey':{'_id':i}} for i in range(3)]
+    listener = mongo_listener.Mongo_Listenner('db', col_name='col', retry_delay=0)
+    col = Scripted_Collection([
+        # Network error in the middle of the stream: it is resumed after the last change received
+        [(changes[0], 't0'), (changes[1], 't1'), pymongo.errors.AutoReconnect('connection lost')],
+        # The token can't be used anymore (oplog rolled over): restart from now and resync
+        [(changes[2], 't2'), pymongo.errors.OperationFailure('resume point lost')],
+        # Failure without a token: just retry
+        [pymongo.errors.OperationFailure('not a replica set')],
+        [lambda: listener.stop(wait=False)],
+    ])
+    monkeypatch.setattr(mongo_listener, 'get_mongo_client', lambda addr=None: {'db':{'col':col}})
+    updates, resyncs = list(), list()
+    listener.updated.connect(updates.append)
+    listener.resynced.connect(lambda: resyncs.append(listener.resume_token))
+    # Run in the test thread
+    listener.run()
+
+    assert updates == changes
+    assert col.watch_kwargs == [{'max_await_time_ms':500}, {'max_await_time_ms':500, 'start_after':'t1'},
+                                {'max_await_time_ms':500}, {'max_await_time_ms':500}]
+    assert resyncs == [None]
+    assert listener.resume_token is None and col.scripts == []
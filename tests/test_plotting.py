@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from nspyre.widgets.plotting import Decimated_Trace
+
+
+def build(xs, ys):
+    trace = Decimated_Trace()
+    trace.set(xs, ys)
+    return trace
+
+
+def assert_same_levels(trace, ref):
+    assert len(trace.levels) == len(ref.levels)
+    for (mins, maxs), (ref_mins, ref_maxs) in zip(trace.levels, ref.levels):
+        np.testing.assert_array_equal(mins, ref_mins)
+        np.testing.assert_array_equal(maxs, ref_maxs)
+
+
+@pytest.mark.parametrize('chunk', [1, 37, 1000, 50000])
+def test_incremental_pyramid_matches_one_pass(chunk):
+    rng = np.random.default_rng(0)
+    n = 300000 if chunk > 1 else 5000
+    xs, ys = np.arange(n, dtype=float), rng.normal(size=n)
+    trace = Decimated_Trace()
+    n_levels = set()
+    for stop in range(chunk, n + chunk, chunk):
+        trace.set(xs[:stop], ys[:stop])
+        n_levels.add(len(trace.levels))
+    # The trace grew through several level boundaries
+    assert len(n_levels) > 2
+    ref = build(xs, ys)
+    assert_same_levels(trace, ref)
+    for width in [200, 1000]:
+        for x_range in [None, (1000, n//2)]:
+            for a, b in zip(trace.render(x_range=x_range, width=width), ref.render(x_range=x_range, width=width)):
+                np.testing.assert_array_equal(a, b)
+
+
+def test_render_keeps_extrema():
+    n = 1000000
+    xs, ys = np.arange(n, dtype=float), np.zeros(n)
+    ys[123457], ys[765433] = 5, -3
+    trace = Decimated_Trace()
+    for stop in range(100000, n+1, 100000):
+        trace.set(xs[:stop], ys[:stop])
+    rx, ry = trace.render(width=200)
+    assert len(rx) < n // 100
+    assert ry.max() == 5 and ry.min() == -3
+
+
+def test_non_append_rebuilds():
+    xs = np.arange(5000, dtype=float)
+    trace = build(xs, np.sin(xs))
+    trace.set(xs, np.cos(xs))
+    assert_same_levels(trace, build(xs, np.cos(xs)))
+    trace.set(xs[::-1], np.cos(xs))
+    assert not trace.monotonic
+    rx, ry = trace.render(width=10)
+    assert len(rx) == 5000
@@ -0,0 +1,65 @@
+import threading
+import pytest
+
+from nspyre.spyrelet import Batched_Writer
+
+
+class Fake_Collection():
+    def __init__(self, fail=False):
+        self.docs = list()
+        self.fail = fail
+        self.release = threading.Event()
+        self.release.set()
+
+    def insert_many(self, docs, ordered=True):
+        self.release.wait()
+        if self.fail:
+            raise RuntimeError('insert failed')
+        self.docs += docs
+
+
+def test_batched_writer_flush_and_close():
+    col = Fake_Collection()
+    writer = Batched_Writer(col, flush_interval=0.01, batch_size=7)
+    for i in range(100):
+        writer.put({'i':i})
+    assert writer.flush(timeout=5)
+    assert [d['i'] for d in col.docs] == list(range(100))
+    assert writer.close(timeout=5)
+    assert not writer._thread.is_alive()
+    with pytest.raises(RuntimeError):
+        writer.put({'i':100})
+
+
+def test_batched_writer_close_writes_pending_rows():
+    col = Fake_Collection()
+    col.release.clear()
+    writer = Batched_Writer(col, flush_interval=10, batch_size=1000)
+    for i in range(10):
+        writer.put({'i':i})
+    col.release.set()
+    assert writer.close(timeout=5)
+    assert len(col.docs) == 10
+
+
+def test_batched_writer_flush_timeout():
+    col = Fake_Collection()
+    col.release.clear()
+    writer = Batched_Writer(col, flush_interval=0.01)
+    writer.put({'i':0})
+    assert not writer.flush(timeout=0.05)
+    col.release.set()
+    assert writer.flush(timeout=5)
+    writer.close()
+
+
+def test_batched_writer_errors():
+    writer = Batched_Writer(Fake_Collection(fail=True), flush_interval=0.01)
+    writer.put({'i':0})
+    with pytest.raises(RuntimeError):
+        writer.flush(timeout=5)
+    # The error is only reported once
+    assert writer.flush(timeout=5)
+    writer.put({'i':1})
+    assert writer.flush(timeout=5, raise_errors=False)
+    writer.close()
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from nspyre.utils import encode_ndarray, decode_ndarray, is_encoded_ndarray, decode_row, custom_encode, custom_decode
+
+
+ARRAYS = [
+    np.arange(10, dtype=np.int32),
+    np.linspace(0, 1, 12).reshape(3, 4),
+    np.arange(24, dtype=np.float32).reshape(2, 3, 4)[:, ::2, 1:],
+    np.array([True, False, True]),
+    np.array([1+2j, 3-4j]),
+    np.array(5.0),
+    np.zeros((0, 3)),
+]
+
+
+@pytest.mark.parametrize('arr', ARRAYS, ids=lambda a: '{}{}'.format(a.dtype, a.shape))
+def test_binary_round_trip(arr):
+    enc = encode_ndarray(arr)
+    assert is_encoded_ndarray(enc)
+    dec = decode_ndarray(enc)
+    assert dec.dtype == arr.dtype and dec.shape == arr.shape
+    np.testing.assert_array_equal(dec, arr)
+
+
+def test_decoded_array_is_writable():
+    dec = decode_ndarray(encode_ndarray(np.arange(5.0)))
+    dec[3] = 10
+    assert dec[3] == 10
+
+
+def test_list_encoding_is_a_plain_list():
+    arr = np.arange(6).reshape(2, 3)
+    assert encode_ndarray(arr, array_encoding='list') == [[0, 1, 2], [3, 4, 5]]
+    assert encode_ndarray(np.array(['a', None], dtype=object)) == ['a', None]
+    with pytest.raises(ValueError):
+        encode_ndarray(arr, array_encoding='pickle')
+
+
+def test_decode_row():
+    row = decode_row({'_id':1, 'x':1.5, 'trace':encode_ndarray(np.arange(3)), 'lst':[1, 2]})
+    np.testing.assert_array_equal(row['trace'], np.arange(3))
+    assert row['lst'] == [1, 2] and row['x'] == 1.5
+
+
+def test_custom_encode_keeps_tagged_lists_by_default():
+    arr = np.arange(3.0)
+    enc = custom_encode({'a':arr, 'b':1})
+    assert enc == {'a':{'__type__':'ndarray', 'val':[0.0, 1.0, 2.0]}, 'b':1}
+    np.testing.assert_array_equal(custom_decode(enc)['a'], arr)
+    enc = custom_encode({'a':arr}, array_encoding='binary')
+    np.testing.assert_array_equal(custom_decode(enc)['a'], arr)
@@ -0,0 +1,192 @@
+import os
+import threading
+import time
+import numpy as np
+import pandas as pd
+import pytest
+from PyQt5 import QtCore, QtWidgets
+
+from nspyre.views import Plot1D
+from nspyre.widgets.view_manager import View_Manager, View_Executor, run_spyrelet_view
+
+
+@pytest.fixture(scope='module')
+def app():
+    return QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+
+
+def process_events(duration):
+    t = time.time()
+    while time.time() - t < duration:
+        QtWidgets.QApplication.processEvents()
+        time.sleep(0.005)
+
+
+# Number of rows seen by each evaluation of the view
+CALLS = list()
+
+class Live_Spyrelet():
+    @Plot1D
+    def trace(df, cache):
+        CALLS.append(len(df))
+        return {'y':[df.x.values, df.y.values]}
+
+
+class Fake_Synched_Database(QtCore.QObject):
+    updated_row = QtCore.pyqtSignal(object, object)
+    col_added = QtCore.pyqtSignal(object)
+    col_dropped = QtCore.pyqtSignal(object)
+    db_dropped = QtCore.pyqtSignal()
+
+    def __init__(self):
+        super().__init__()
+        self.dfs = {'Register':pd.DataFrame({'class':[__name__ + '.Live_Spyrelet']}, index=['live']),
+                    'live':pd.DataFrame({'x':[], 'y':[]})}
+
+    def get_df(self, col_name):
+        return self.dfs[col_name]
+
+    def append(self, x, y):
+        self.dfs['live'] = pd.concat([self.dfs['live'], pd.DataFrame({'x':[x], 'y':[y]})], ignore_index=True)
+        self.updated_row.emit('live', self.dfs['live'].iloc[-1])
+
+
+def test_updates_are_rendered_once_per_tick(app):
+    db = Fake_Synched_Database()
+    manager = View_Manager(db=db, update_rate=20)
+    assert manager.update_timer.isActive() and manager.update_timer.interval() == 50
+    view = manager.views['live']['trace']
+    view.start_updating()
+    del CALLS[:]
+
+    # A burst of rows within one tick only marks the collection as dirty
+    for i in range(5):
+        db.append(i, i**2)
+    assert manager.dirty == {'live'} and CALLS == []
+    assert manager.update_stats == {'received':5, 'rendered':0, 'merged':4}
+
+    process_events(0.3)
+    assert CALLS == [5] and manager.dirty == set()
+    assert manager.update_stats == {'received':5, 'rendered':1, 'merged':4}
+    np.testing.assert_array_equal(manager.common_lineplotwidget.traces['y'][0].yData, [0, 1, 4, 9, 16])
+
+    # Nothing is rendered without new rows
+    process_events(0.2)
+    assert CALLS == [5]
+    db.append(5, 25)
+    process_events(0.2)
+    assert CALLS == [5, 6]
+    assert manager.get_update_stats()['rendered'] == 2
+    manager.close()
+
+
+class Executor_Spyrelet():
+    @Plot1D
+    def pid(df, cache):
+        return {'pid':[df.x.values, np.full(len(df), os.getpid())]}
+
+
+class Fake_View():
+    def __init__(self, name='pid', incremental=False):
+        self.view = getattr(Executor_Spyrelet, name)
+        self.incremental = incremental
+        self.is_updating = True
+        self.rendered = list()
+        self.updated = list()
+
+    def update_fun(self, df, cache):
+        if 'gate' in cache:
+            cache['started'].set()
+            cache['gate'].wait(5)
+        return {'n':len(df), 'thread':threading.current_thread().name}
+
+    def process_job(self, df, cache):
+        return run_spyrelet_view, (__name__ + '.Executor_Spyrelet', self.view.name, df, cache)
+
+    def update(self, df, cache):
+        self.updated.append(len(df))
+
+    def render(self, result, df, cache):
+        self.rendered.append(result)
+
+
+def make_df(n):
+    return pd.DataFrame({'x':np.arange(n, dtype=float)})
+
+
+def wait_for_render(view, n=1, timeout=5):
+    t = time.time()
+    while len(view.rendered) < n:
+        assert time.time() - t < timeout
+        QtWidgets.QApplication.processEvents()
+        time.sleep(0.005)
+
+
+def test_executor_gui_mode(app):
+    executor = View_Executor(mode='gui')
+    view = Fake_View()
+    executor.submit(view, make_df(3), {})
+    assert view.updated == [3] and executor.stats['submitted'] == 0
+    with pytest.raises(ValueError):
+        View_Executor(mode='other')
+
+
+def test_executor_cancels_superseded_jobs(app):
+    executor = View_Executor(mode='thread', max_workers=1)
+    blocker, view = Fake_View(), Fake_View()
+    gate, started = threading.Event(), threading.Event()
+    executor.submit(blocker, make_df(1), {'gate':gate, 'started':started})
+    assert started.wait(5)
+    # Queued behind the blocker: the first job is cancelled before it starts
+    executor.submit(view, make_df(2), {})
+    first = executor.pending[view][1]
+    executor.submit(view, make_df(3), {})
+    assert first.cancelled()
+    gate.set()
+    wait_for_render(view)
+    wait_for_render(blocker)
+    process_events(0.1)
+    assert [result['n'] for result in view.rendered] == [3]
+    assert view.rendered[0]['thread'] != threading.current_thread().name
+    assert executor.stats == {'submitted':3, 'completed':2, 'superseded':1}
+
+    # A job which already started can't be cancelled, its result is discarded
+    gate, started = threading.Event(), threading.Event()
+    executor.submit(view, make_df(4), {'gate':gate, 'started':started})
+    assert started.wait(5)
+    running = executor.pending[view][1]
+    executor.submit(view, make_df(5), {})
+    assert not running.cancelled()
+    gate.set()
+    wait_for_render(view, 2)
+    process_events(0.1)
+    assert running.done() and [result['n'] for result in view.rendered] == [3, 5]
+    assert executor.stats == {'submitted':5, 'completed':3, 'superseded':2}
+
+    # The incremental views are evaluated inline
+    incremental = Fake_View(incremental=True)
+    executor.submit(incremental, make_df(6), {})
+    assert incremental.updated == [6] and executor.stats['submitted'] == 5
+    executor.shutdown()
+
+
+def test_executor_process_mode(app):
+    executor = View_Executor(mode='process', max_workers=1)
+    view = Fake_View()
+    view.is_updating = False
+    executor.submit(view, make_df(2), {})
+    # Not rendered while the view isn't visible
+    t = time.time()
+    while executor.stats['completed'] == 0:
+        assert time.time() - t < 10
+        QtWidgets.QApplication.processEvents()
+        time.sleep(0.005)
+    assert view.rendered == []
+    view.is_updating = True
+    executor.submit(view, make_df(3), {})
+    wait_for_render(view, timeout=10)
+    xs, pids = view.rendered[0]['pid']
+    np.testing.assert_array_equal(xs, [0, 1, 2])
+    # Evaluated by the view function in a worker process
+    assert len(set(pids)) == 1 and pids[0] != os.getpid()
+    executor.shutdown()
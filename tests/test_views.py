@@ -0,0 +1,83 @@
+import numpy as np
+import pandas as pd
+
+from nspyre.columnar import Keyed_Columnar_Buffer
+from nspyre.views import Running_Aggregate, Incremental_State, Plot1DIncremental
+
+
+def make_df(n, start=0):
+    rng = np.random.default_rng(start)
+    return pd.DataFrame({'f':rng.integers(0, 5, n), 'ch1':rng.normal(size=n), 'ch2':rng.normal(size=n)}, index=range(start, start+n))
+
+
+def test_running_aggregate_matches_groupby():
+    df = make_df(1000)
+    df.loc[3, 'ch1'] = np.nan
+    agg = Running_Aggregate('f', ['ch1', 'ch2'])
+    for i in range(0, 1000, 97):
+        agg.update(df.iloc[i:i+97])
+    expected = df.groupby('f')[['ch1', 'ch2']]
+    for col in ['ch1', 'ch2']:
+        pd.testing.assert_series_equal(agg.mean(col), expected.mean()[col], check_dtype=False)
+        pd.testing.assert_series_equal(agg.count(col), expected.count()[col], check_dtype=False)
+        pd.testing.assert_series_equal(agg.min(col), expected.min()[col], check_dtype=False)
+        pd.testing.assert_series_equal(agg.max(col), expected.max()[col], check_dtype=False)
+
+
+def test_aggregates_are_fed_on_every_batch():
+    df = make_df(300)
+    state = Incremental_State()
+    state.next_batch(df.iloc[:100], df.iloc[:100])
+    g = state.groupby('f', ['ch1'])
+    # groupby isn't called for these batches
+    state.next_batch(df.iloc[100:200], df.iloc[:200])
+    state.next_batch(df.iloc[200:], df)
+    # A new aggregate starts from all the rows received so far
+    late = state.groupby('f', ['ch2'])
+    assert state.groupby('f', ['ch1']) is g
+    expected = df.groupby('f')[['ch1', 'ch2']].sum()
+    np.testing.assert_allclose(g.sum('ch1'), expected['ch1'])
+    np.testing.assert_allclose(late.sum('ch2'), expected['ch2'])
+
+
+class Fake_Widget():
+    def __init__(self):
+        self.traces = dict()
+
+    def clear(self):
+        self.traces.clear()
+
+    def set(self, name, xs, ys):
+        self.traces[name] = (np.asarray(xs), np.asarray(ys))
+
+
+@Plot1DIncremental
+def avg(new_df, state, cache):
+    if state.get('calls', 0) % 2 == 0:
+        g = state.groupby('f', ['ch1'])
+        state['trace'] = {'ch1':[g.keys, g.mean('ch1').values]}
+    state['calls'] = state.get('calls', 0) + 1
+    return state['trace']
+
+
+def test_incremental_view_follows_the_buffer():
+    from nspyre.widgets.view_manager import LinePlotView
+    w = Fake_Widget()
+    view = LinePlotView(avg, w)
+    view.start_updating()
+    buf = Keyed_Columnar_Buffer()
+    df = make_df(200)
+    for i, row in df.iterrows():
+        buf.append({'_id':i, **row.to_dict()})
+        if i % 7 == 0:
+            view.update(buf.to_dataframe(), {})
+    view.update(buf.to_dataframe(), {})
+    view.update(buf.to_dataframe(), {})
+    np.testing.assert_allclose(w.traces['ch1'][1], df.groupby('f')['ch1'].mean())
+
+    # Modifying existing rows resets the state
+    buf.set_value(0, 'ch1', 100.0)
+    buf.delete(1)
+    df = buf.to_dataframe()
+    view.update(df, {})
+    np.testing.assert_allclose(w.traces['ch1'][1], df.groupby('f')['ch1'].mean())